@@ -18,9 +18,13 @@ Mux(a=ab{i}, b=cd{i}, sel=sel[1], out=out[{i}]);
 
 def mux8way16():
     template = '''
-Mux4Way16(a=a[{i}], b=b[{i}], sel=sel[0], out=ab{i});
+Mux(a=a[{i}], b=b[{i}], sel=sel[0], out=ab{i});
 Mux(a=c[{i}], b=d[{i}], sel=sel[0], out=cd{i});
-Mux(a=ab{i}, b=cd{i}, sel=sel[1], out=out[{i}]);
+Mux(a=e[{i}], b=f[{i}], sel=sel[0], out=ef{i});
+Mux(a=g[{i}], b=h[{i}], sel=sel[0], out=gh{i});
+Mux(a=ab{i}, b=cd{i}, sel=sel[1], out=abcd{i});
+Mux(a=ef{i}, b=gh{i}, sel=sel[1], out=efgh{i});
+Mux(a=abcd{i}, b=efgh{i}, sel=sel[2], out=out[{i}]);
     '''.strip()
 
     return '\n'.join((template.format(i=i) for i in range(16)))
@@ -1,5 +1,18 @@
+import argparse
+import glob
+import mmap
 import os
 import re
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(script_dir))
+
+from build_cache import (BuildCache, default_cache_dir, file_hash,
+    tool_version)
 
 
 def peek_line(f):
@@ -14,23 +27,34 @@ a_regex = r'\@([0-9]+|' + valid_symbol + r')'
 l_regex = r'\(\s*(' + valid_symbol + r')\s*\)'
 c_regex = r'.+'
 
-predefined_symbol_table = {
+a_pattern = re.compile(a_regex)
+l_pattern = re.compile(l_regex)
+comment_pattern = re.compile(r'\/\/.*$')
+whitespace_pattern = re.compile(r'\s+')
+
+dest_codes = {
     '': 0,
-    '0': 0,
     'M': 1,
     'D': 2,
     'MD': 3,
     'A': 4,
     'AM': 5,
     'AD': 6,
-    'AMD': 7,
+    'AMD': 7
+}
+
+jump_codes = {
+    '': 0,
     'JGT': 1,
     'JEQ': 2,
     'JGE': 3,
     'JLT': 4,
     'JNE': 5,
     'JLE': 6,
-    'JMP': 7,
+    'JMP': 7
+}
+
+predefined_symbol_table = {
     'SP': 0,
     'LCL': 1,
     'ARG': 2,
@@ -73,9 +97,51 @@ alu_oper_cmds = {
     'D|M': 0b010101
 }
 
+commuted_opers = {
+    'A+D': 'D+A',
+    'M+D': 'D+M',
+    'A&D': 'D&A',
+    'M&D': 'D&M',
+    'A|D': 'D|A',
+    'M|D': 'D|M'
+}
+
+comp_codes = {}
+for oper, code in alu_oper_cmds.items():
+    comp_codes[oper] = code + (0b1000000 if 'M' in oper else 0)
+for oper, same_oper in commuted_opers.items():
+    comp_codes[oper] = comp_codes[same_oper]
+
+
+def c_instruction_code(dest, comp, jump):
+    return (0b111 << 13) + (comp << 6) + (dest << 3) + jump
+
+
+def c_instruction_text(dest, comp, jump):
+    text = f'{dest}={comp}' if dest else comp
+    return f'{text};{jump}' if jump else text
+
+
+c_instruction_table = {
+    c_instruction_text(dest, comp, jump): c_instruction_code(d, c, j)
+    for dest, d in dest_codes.items()
+    for comp, c in comp_codes.items()
+    for jump, j in jump_codes.items()
+}
+
+
+def split_c_instruction(text):
+    text = text.replace(' ', '')
+    dest, comp = text.split('=', 1) if '=' in text else ('', text)
+    comp, jump = comp.split(';', 1) if ';' in comp else (comp, '')
+    # accept destinations written in any order, e.g. DM for MD
+    if set(dest) <= set('AMD') and len(set(dest)) == len(dest):
+        dest = ''.join(reg for reg in 'AMD' if reg in dest)
+    return dest, comp, jump
+
 
 class LabelSymParser:
-    sym_table = {}
+    sym_table = None
     cur_address = 0
     instruction_num = 0
 
@@ -93,7 +159,7 @@ class LabelSymParser:
         #         print(symbol, self.cur_address)
         #         self.cur_address += 1
         
-        if match := re.match(l_regex, line):
+        if match := l_pattern.match(line):
             symbol = match.group(1)
             self.sym_table[symbol] = self.instruction_num
         else:
@@ -103,7 +169,7 @@ class LabelSymParser:
 
 
 class SymTable:
-    sym_table = {}
+    sym_table = None
     cur_address = 0
 
     def __init__(self, sym_table, start_address=0x10):
@@ -137,13 +203,18 @@ class Command:
         self.set_command_type()
 
     def set_command_type(self):
-        if match := re.match(a_regex, self.text):
+        if self.text in c_instruction_table:
+            self.command_type = 'C'
+            self.set_c_params()
+            return
+
+        if match := a_pattern.match(self.text):
             self.command_type = 'A'
             self.symbol = match.group(1)
             self.sym_table.add(self.symbol)
             return
         
-        if match := re.match(l_regex, self.text):
+        if match := l_pattern.match(self.text):
             self.command_type = 'L'
             self.symbol = match.group(1)
             return
@@ -154,38 +225,69 @@ class Command:
 
 
     def set_c_params(self):
-        equality = self.text.split('=')
-        if len(equality) == 2:
-            self.set_equality(equality[0], equality[1])
-            return
-
-        jump = self.text.split(';')
-        if len(jump) == 2:
-            self.set_jump(jump[0], jump[1])
-            return
+        dest, comp, jump = split_c_instruction(self.text)
+        if dest not in dest_codes or comp not in comp_codes \
+                or jump not in jump_codes:
+            raise Exception(f'Invalid C command: {self.text}')
 
-        raise Exception('Invalid C command')
+        self.dest = dest_codes[dest]
+        self.comp = comp_codes[comp]
+        self.jump = jump_codes[jump]
 
-    def set_equality(self, reg, oper):
-        self.jump = 0
-        self.dest = self.sym_table.get(reg)
-        self.comp = alu_oper_cmds[oper]
-        if 'M' in oper:
-            self.comp += 0b1000000
+    def code(self):
+        if self.command_type == 'A':
+            return self.sym_table.get(self.symbol)
 
-    def set_jump(self, reg, code):
-        self.dest = 0
-        self.jump = self.sym_table.get(code)
-        self.comp = alu_oper_cmds[reg]
+        return c_instruction_code(self.dest, self.comp, self.jump)
 
     def __str__(self):
-        if self.command_type == 'A':
-            return format(self.sym_table.get(self.symbol), '016b')
         if self.command_type == 'L':
             return ''
+        return format(self.code(), '016b')
+
+
+class SinglePassParser:
+    words = None
+    fixups = None
+    labels = None
+
+    def __init__(self, start_address=0x10, words=None):
+        self.labels = dict(**predefined_symbol_table)
+        self.sym_table = SymTable(self.labels, start_address)
+        self.words = [] if words is None else words
+        self.fixups = []
+
+    def parse(self, line):
+        if line in c_instruction_table:
+            self.words.append(c_instruction_table[line])
+            return
+
+        if match := l_pattern.match(line):
+            self.labels[match.group(1)] = len(self.words)
+            return
+
+        if match := a_pattern.match(line):
+            symbol = match.group(1)
+            if symbol.isdigit():
+                self.words.append(int(symbol))
+            elif symbol in self.labels:
+                self.words.append(self.labels[symbol])
+            else:
+                # label may still be defined further down, patch it at the end
+                self.fixups.append((len(self.words), symbol))
+                self.words.append(0)
+            return
+
+        self.words.append(Command(line, self.sym_table).code())
 
-        instruction = (0b111 << 13) + (self.comp << 6) + (self.dest << 3) + self.jump
-        return format(instruction, '016b')
+    def backpatch(self):
+        # fixups are in order of first use, so variables get the same
+        # addresses as they would in the two pass assembler
+        for i, symbol in self.fixups:
+            self.sym_table.add(symbol)
+            self.words[i] = self.sym_table.get(symbol)
+        self.fixups = []
+        return self.words
 
 
 class CommandLineParser:
@@ -216,18 +318,35 @@ class Parser:
                 return
         self.cur_command = None
 
+    def parse(self):
+        for line in self.f:
+            cmd = self.clean_line(line)
+            if cmd != '':
+                yield self.line_parser.parse(cmd)
+
     def clean_line(self, line):
-        return re.sub(r'\s+', ' ',
-            re.sub(r'\/\/.*$', '', line)).strip()
+        return whitespace_pattern.sub(' ',
+            comment_pattern.sub('', line)).strip()
     
 
 
-def assemble_asm(filename):
+def change_ext(filename, ext):
     basename = os.path.basename(filename)
     basename = basename.split('.')[0]
-    out_file = os.path.join(os.path.dirname(filename), f'{basename}.hack')
+    return os.path.join(os.path.dirname(filename), f'{basename}.{ext}')
+
+
+def assemble_single_pass(filename):
+    line_parser = SinglePassParser()
+    with open(filename, 'r') as f:
+        for _ in Parser(f, line_parser).parse():
+            pass
+
+    return line_parser.backpatch()
+
 
-    lines = []
+def assemble_two_pass(filename):
+    words = []
     sym = LabelSymParser()
     with open(filename, 'r') as f:
         sym_parser = Parser(f, sym)
@@ -240,18 +359,228 @@ def assemble_asm(filename):
         parser = Parser(f, CommandLineParser(sym_table))
         parser.advance()
         while parser.has_more_commands():
-            line = str(parser.cur_command)
-            if line:
-                lines.append(line)
+            if parser.cur_command.command_type != 'L':
+                words.append(parser.cur_command.code())
             parser.advance()
 
+    return words
+
+
+def write_hack(words, out_file):
     with open(out_file, 'w') as f:
-        f.write('\n'.join(lines))
+        f.write('\n'.join(format(w, '016b') for w in words))
 
-if __name__ == '__main__':
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    
-    files = [
+
+def write_binary(words, out_file):
+    rom = array('H', words)
+    if sys.byteorder == 'big':
+        rom.byteswap()
+    with open(out_file, 'wb') as f:
+        rom.tofile(f)
+
+
+output_formats = {
+    'hack': write_hack,
+    'bin': write_binary
+}
+
+
+class WordStream:
+    # list-like sink for SinglePassParser that writes words to the output
+    # file as they come instead of keeping them. Every word has a fixed size
+    # in both formats, so backpatching seeks back and overwrites the word
+    f = None
+    output_format = ''
+    buffer = None
+    flushed = 0
+    flush_words = 0
+
+    def __init__(self, f, output_format='hack', flush_words=4096):
+        if output_format not in output_formats:
+            raise Exception(f'Unknown output format: {output_format}')
+        self.f = f
+        self.output_format = output_format
+        self.buffer = []
+        self.flushed = 0
+        self.flush_words = flush_words
+
+    def __len__(self):
+        return self.flushed + len(self.buffer)
+
+    def append(self, word):
+        self.buffer.append(word)
+        if len(self.buffer) >= self.flush_words:
+            self.flush()
+
+    def __setitem__(self, i, word):
+        if i >= self.flushed:
+            self.buffer[i - self.flushed] = word
+            return
+
+        self.f.seek(self.offset(i))
+        self.f.write(self.encode([word]))
+        self.f.seek(0, os.SEEK_END)
+
+    def offset(self, i):
+        return i * (17 if self.output_format == 'hack' else 2)
+
+    def encode(self, words):
+        if self.output_format == 'hack':
+            return '\n'.join(format(w, '016b') for w in words).encode()
+        rom = array('H', words)
+        if sys.byteorder == 'big':
+            rom.byteswap()
+        return rom.tobytes()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        # .hack files have newlines between words but not after the last
+        if self.output_format == 'hack' and self.flushed:
+            self.f.write(b'\n')
+        self.f.write(self.encode(self.buffer))
+        self.flushed += len(self.buffer)
+        self.buffer = []
+
+
+def assemble_lines(lines, out_file, output_format='hack'):
+    # single pass assembly of clean lines, e.g. straight from the VM
+    # translator, without reading or writing a .asm file
+    with open(out_file, 'w+b') as f:
+        line_parser = SinglePassParser(words=WordStream(f, output_format))
+        for line in lines:
+            if line:
+                line_parser.parse(line)
+        words = line_parser.backpatch()
+        words.flush()
+        return len(words)
+
+
+def assemble_asm(filename, single_pass=True, output_format='hack'):
+    if output_format not in output_formats:
+        raise Exception(f'Unknown output format: {output_format}')
+
+    if single_pass:
+        words = assemble_single_pass(filename)
+    else:
+        words = assemble_two_pass(filename)
+
+    output_formats[output_format](words, change_ext(filename, output_format))
+    carry_source_map(filename)
+    return words
+
+
+def rom_source_map(asm_file, map_file):
+    # turns the translator's map of .asm lines into a map of ROM addresses,
+    # the lines that are not instructions do not get an address
+    sources = {}
+    with open(map_file, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            asm_line, source = line.rstrip('\n').split('\t', 1)
+            sources[int(asm_line)] = source
+
+    rom_map = []
+    address = 0
+    with open(asm_file, 'r') as f:
+        parser = Parser(f, None)
+        for line_no, line in enumerate(f, 1):
+            cmd = parser.clean_line(line)
+            if cmd == '' or l_pattern.match(cmd):
+                continue
+            if line_no in sources:
+                rom_map.append(f'{address}\t{sources[line_no]}')
+            address += 1
+    return rom_map
+
+
+def source_map_hash(map_file):
+    with open(map_file, 'r') as f:
+        header = f.readline()
+    return header[2:].strip() if header.startswith('# ') else None
+
+
+def carry_source_map(filename):
+    # a .asm.map written for another version of the .asm is stale, and so is
+    # any .hack.map carried from it before
+    map_file = change_ext(filename, 'asm.map')
+    rom_map_file = change_ext(filename, 'hack.map')
+    if (not os.path.exists(map_file)
+            or source_map_hash(map_file) != file_hash(filename)):
+        if os.path.exists(rom_map_file):
+            os.remove(rom_map_file)
+        return False
+
+    with open(rom_map_file, 'w') as f:
+        f.write('\n'.join(rom_source_map(filename, map_file)))
+    return True
+
+
+def load_binary(filename):
+    # maps the ROM read only, words are little endian uint16
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return array('H')
+        rom = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    if sys.byteorder == 'big':
+        words = array('H', rom.tobytes())
+        words.byteswap()
+        return words
+    return rom.cast('H')
+
+
+def expand_paths(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '**', '*.asm'),
+                recursive=True))
+        elif glob.has_magic(path):
+            files += sorted(glob.glob(path, recursive=True))
+        else:
+            files.append(path)
+    return list(dict.fromkeys(files))
+
+
+def assemble_cached(filename, cache, single_pass=True, output_format='hack'):
+    out_file = change_ext(filename, output_format)
+    cached = cache.build([filename], out_file,
+        lambda: assemble_asm(filename, single_pass, output_format),
+        tool_version(__file__), output_format)
+    if cached:
+        carry_source_map(filename)
+    return cached
+
+
+def assemble_timed(filename, single_pass=True, output_format='hack',
+        cache_dir=None):
+    start = time.perf_counter()
+    cached = False
+    try:
+        if cache_dir:
+            cached = assemble_cached(filename, BuildCache(cache_dir),
+                single_pass, output_format)
+        else:
+            assemble_asm(filename, single_pass, output_format)
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return filename, time.perf_counter() - start, cached, error
+
+
+def assemble_batch(files, jobs=None, single_pass=True, output_format='hack',
+        cache_dir=None):
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(assemble_timed, f, single_pass,
+            output_format, cache_dir) for f in files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv=None):
+    default_files = [
         'add/Add.asm', 
         'max/Max.asm', 
         'max/MaxL.asm', 
@@ -260,12 +589,48 @@ if __name__ == '__main__':
         'rect/Rect.asm',
         'rect/RectL.asm'
     ]
-    # files = [
-    #     'pong/Pong.asm',
-    # ]
 
-    for asm in files:
-        filename = os.path.join(script_dir, asm)
-        assemble_asm(filename)
-    
-    
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(
+        description='Assemble Hack .asm files in parallel')
+    arg_parser.add_argument('paths', nargs='*',
+        help='.asm files, globs or directories to search for .asm files')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of worker processes (default: cpu count)')
+    arg_parser.add_argument('-f', '--format', choices=output_formats.keys(),
+        default='hack', help='output format')
+    arg_parser.add_argument('--two-pass', action='store_true',
+        help='use the two pass assembler')
+    arg_parser.add_argument('--cache', action='store_true',
+        help='reuse outputs of unchanged inputs from the build cache')
+    arg_parser.add_argument('--cache-dir', default=default_cache_dir(),
+        help='build cache directory (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+    cache_dir = args.cache_dir if args.cache else None
+
+    paths = args.paths or [os.path.join(script_dir, f) for f in default_files]
+    files = expand_paths(paths)
+    if not files:
+        print('no .asm files found', file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    failures = 0
+    for filename, elapsed, cached, error in assemble_batch(files, args.jobs,
+            not args.two_pass, args.format, cache_dir):
+        if error:
+            failures += 1
+            print(f'FAIL   {filename} ({elapsed * 1000:.1f} ms): {error}')
+        else:
+            status = 'cached' if cached else 'ok'
+            print(f'{status:<6} {filename} ({elapsed * 1000:.1f} ms)')
+
+    if cache_dir:
+        BuildCache(cache_dir).evict()
+
+    total = time.perf_counter() - start
+    print(f'{len(files) - failures}/{len(files)} assembled in {total:.2f} s')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,436 @@
+import argparse
+import time
+from array import array
+
+from assembler import (LabelSymParser, Parser, comp_codes, load_binary,
+    predefined_symbol_table)
+
+
+rom_size = 0x8000
+ram_size = 0x8000
+kbd_address = 0x6000
+
+jump_conditions = {
+    1: 'v > 0',
+    2: 'v == 0',
+    3: 'v >= 0',
+    4: 'v < 0',
+    5: 'v != 0',
+    6: 'v <= 0'
+}
+
+
+class Halt(Exception):
+    pass
+
+
+def wrap16(value):
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+def comp_expr(mnemonic, a='a'):
+    # a is the python expression for the A register
+    expr = ''.join({'!': '~', 'D': 'd', 'A': a, 'M': f'ram[{a}]'}.get(c, c)
+        for c in mnemonic)
+    # only addition, subtraction and negation can leave the int16 range
+    if mnemonic not in ('-1', '0', '1') and ('+' in expr or '-' in expr):
+        expr = f'(({expr}) + 0x8000 & 0xFFFF) - 0x8000'
+    return expr
+
+
+comp_mnemonics = {code: mnemonic for mnemonic, code in comp_codes.items()}
+comp_exprs = {code: comp_expr(mnemonic) for code, mnemonic in comp_mnemonics.items()}
+
+
+def alu(x, y, control):
+    # generic ALU for comp bits the assembler never emits
+    if control & 0b100000:
+        x = 0
+    if control & 0b010000:
+        x = ~x
+    if control & 0b001000:
+        y = 0
+    if control & 0b000100:
+        y = ~y
+    out = x + y if control & 0b000010 else x & y
+    if control & 0b000001:
+        out = ~out
+    return wrap16(out)
+
+
+def c_handler_source(comp, dest, jump):
+    if comp in comp_exprs:
+        expr = comp_exprs[comp]
+    else:
+        y = 'ram[a]' if comp & 0b1000000 else 'a'
+        expr = f'alu(d, {y}, {comp & 0b111111})'
+
+    new_a = 'v' if dest & 0b100 else 'a'
+    new_d = 'v' if dest & 0b010 else 'd'
+    lines = [
+        'def factory(ram, nxt):',
+        '    def handler(a, d):',
+        f'        v = {expr}'
+    ]
+    if dest & 0b001:
+        lines.append('        ram[a] = v')
+    # jumps go to the A value from before this instruction
+    if jump == 7:
+        lines.append(f'        return {new_a}, {new_d}, a')
+    else:
+        if jump:
+            lines.append(f'        if {jump_conditions[jump]}:')
+            lines.append(f'            return {new_a}, {new_d}, a')
+        lines.append(f'        return {new_a}, {new_d}, nxt')
+    lines.append('    return handler')
+    return '\n'.join(lines)
+
+
+c_handler_factories = {}
+
+
+def c_handler_factory(word):
+    key = word & 0x1FFF
+    if key not in c_handler_factories:
+        source = c_handler_source((key >> 6) & 0x7F, (key >> 3) & 0b111,
+            key & 0b111)
+        namespace = {'alu': alu}
+        exec(compile(source, f'<hack {format(word, "016b")}>', 'exec'),
+            namespace)
+        c_handler_factories[key] = namespace['factory']
+    return c_handler_factories[key]
+
+
+def a_handler(value, nxt):
+    def handler(a, d):
+        return value, d, nxt
+    return handler
+
+
+def halt_handler(a, d):
+    raise Halt()
+
+
+def decode(word, address, ram):
+    if word & 0x8000:
+        return c_handler_factory(word)(ram, address + 1)
+    return a_handler(word, address + 1)
+
+
+def halt_loops(rom):
+    # the usual end of a program: (END) @END 0;JMP
+    jmp = comp_codes['0'] << 6 | 0b1110000000000111
+    return {i for i in range(len(rom) - 1)
+        if rom[i] == i and rom[i + 1] == jmp}
+
+
+def load_hack(filename):
+    with open(filename, 'r') as f:
+        return [int(line, 2) for line in f if line.strip()]
+
+
+def load_rom(filename):
+    if filename.endswith('.hack'):
+        return load_hack(filename)
+    return load_binary(filename)
+
+
+class Emulator:
+    rom = None
+    ram = None
+    program = None
+    halts = None
+    a = 0
+    d = 0
+    pc = 0
+    cycles = 0
+
+    def __init__(self, rom):
+        if len(rom) > rom_size:
+            raise Exception(f'Program of {len(rom)} words does not fit in ROM')
+
+        self.rom = list(rom)
+        # index wraps like the 15 bit address bus: ram[-1] is ram[0x7FFF]
+        self.ram = array('h', bytes(2 * ram_size))
+        self.program = [decode(word, i, self.ram)
+            for i, word in enumerate(self.rom)]
+        self.program += [halt_handler] * (rom_size - len(self.program))
+        self.halts = halt_loops(self.rom)
+
+    @classmethod
+    def from_file(cls, filename):
+        return cls(load_rom(filename))
+
+    def reset(self):
+        self.pc = 0
+
+    def set_key(self, key):
+        self.ram[kbd_address] = key
+
+    def step(self):
+        try:
+            self.a, self.d, self.pc = self.program[self.pc](self.a, self.d)
+        except Halt:
+            return False
+        self.cycles += 1
+        return True
+
+    def run(self, cycles=None, chunk=4096):
+        # without a cycle limit, run until the program falls off the end of
+        # the ROM or reaches its terminating infinite loop, whose first
+        # instruction then halts instead so no cycles are counted spinning
+        program = self.program
+        if cycles is None:
+            program = list(program)
+            for address in self.halts:
+                program[address] = halt_handler
+        a, d, pc = self.a, self.d, self.pc
+        remaining = cycles
+        done = 0
+        try:
+            while remaining is None or remaining > 0:
+                n = chunk if remaining is None else min(chunk, remaining)
+                done = 0
+                for done in range(1, n + 1):
+                    a, d, pc = program[pc](a, d)
+                self.cycles += n
+                done = 0
+                if remaining is not None:
+                    remaining -= n
+        except Halt:
+            self.cycles += done - 1
+        self.a, self.d, self.pc = a, d, pc
+        return self.cycles
+
+
+def block_comp_expr(comp, a):
+    if comp in comp_mnemonics:
+        return comp_expr(comp_mnemonics[comp], a)
+    y = f'ram[{a}]' if comp & 0b1000000 else a
+    return f'alu(d, {y}, {comp & 0b111111})'
+
+
+def is_jump(word):
+    return word & 0x8000 and word & 0b111
+
+
+def block_length(rom, start, leaders):
+    # a basic block runs straight through until its first jump, the next
+    # leader or the end of the ROM
+    address = start
+    while address < len(rom):
+        word = rom[address]
+        address += 1
+        if is_jump(word) or address in leaders:
+            break
+    return address - start
+
+
+def trace_addresses(rom, start, leaders, max_length=256):
+    # a trace is a chain of basic blocks: conditional jumps become side exits
+    # and @k followed by 0;JMP is followed straight to k
+    addresses = []
+    address = start
+    while address < len(rom) and len(addresses) < max_length:
+        if address in addresses:
+            break
+        addresses.append(address)
+        word = rom[address]
+        address += 1
+        if is_jump(word) and word & 0b111 == 7:
+            previous = rom[addresses[-2]] if len(addresses) > 1 else 0x8000
+            if previous & 0x8000 or previous >= len(rom):
+                break
+            address = previous
+        elif address in leaders:
+            break
+    return addresses
+
+
+def block_source(rom, addresses):
+    # the A register is tracked as a constant after @k and only materialized
+    # when it leaves the block. Jumps back to the start of the trace loop
+    # inside the block for as long as the cycle budget allows
+    start = addresses[0]
+    length = len(addresses)
+    lines = [
+        'def block(a, d, budget, ram=ram, alu=alu):',
+        '    n = 0',
+        '    while True:'
+    ]
+
+    def loop_back(indent, i):
+        if a != 'a':
+            lines.append(f'{indent}a = {a}')
+        lines.append(f'{indent}n += {i}')
+        lines.append(f'{indent}if n + {length} > budget:')
+        lines.append(f'{indent}    return a, d, {start}, n')
+        lines.append(f'{indent}continue')
+
+    a = 'a'
+    for i, address in enumerate(addresses, 1):
+        word = rom[address]
+        if not word & 0x8000:
+            a = str(word)
+            continue
+
+        expr = block_comp_expr((word >> 6) & 0x7F, a)
+        dest = (word >> 3) & 0b111
+        jump = word & 0b111
+        if not jump and dest in (0b001, 0b010, 0b100):
+            target = {0b001: f'ram[{a}]', 0b010: 'd', 0b100: 'a'}[dest]
+            lines.append(f'        {target} = {expr}')
+            if dest == 0b100:
+                a = 'a'
+            continue
+
+        lines.append(f'        v = {expr}')
+        if dest & 0b001:
+            lines.append(f'        ram[{a}] = v')
+        target = a
+        if jump and dest & 0b100 and a == 'a':
+            lines.append('        target = a')
+            target = 'target'
+        if dest & 0b100:
+            lines.append('        a = v')
+            a = 'a'
+        if dest & 0b010:
+            lines.append('        d = v')
+        if jump == 7 and i == length:
+            if target == str(start):
+                loop_back('        ', i)
+            else:
+                lines.append(f'        return {a}, d, {target}, n + {i}')
+        elif jump and jump != 7:
+            lines.append(f'        if {jump_conditions[jump]}:')
+            if target == str(start):
+                loop_back('            ', i)
+            else:
+                lines.append(f'            return {a}, d, {target}, n + {i}')
+
+    if not (is_jump(word) and word & 0b111 == 7):
+        lines.append(f'        return {a}, d, {addresses[-1] + 1}, n + {length}')
+    return '\n'.join(lines)
+
+
+def asm_leaders(filename):
+    sym = LabelSymParser()
+    with open(filename, 'r') as f:
+        for _ in Parser(f, sym).parse():
+            pass
+    return {address for label, address in sym.sym_table.items()
+        if label not in predefined_symbol_table}
+
+
+class BlockEmulator(Emulator):
+    blocks = None
+    block_lengths = None
+    trace_lengths = None
+    entries = None
+    leaders = None
+    hot_threshold = 0
+
+    def __init__(self, rom, leaders=None, hot_threshold=8):
+        super().__init__(rom)
+        self.blocks = [None] * rom_size
+        self.block_lengths = [0] * rom_size
+        self.trace_lengths = [0] * rom_size
+        self.entries = [0] * rom_size
+        # blocks end before a halt loop, so run() sees it before spinning
+        self.leaders = set(leaders or ()) | self.halts
+        self.hot_threshold = hot_threshold
+
+    @classmethod
+    def from_file(cls, filename, asm_file=None, hot_threshold=8):
+        leaders = asm_leaders(asm_file) if asm_file else None
+        return cls(load_rom(filename), leaders, hot_threshold)
+
+    def compile_block(self, start):
+        addresses = trace_addresses(self.rom, start, self.leaders)
+        namespace = {'ram': self.ram, 'alu': alu}
+        source = block_source(self.rom, addresses)
+        exec(compile(source, f'<hack block {start}>', 'exec'), namespace)
+        self.blocks[start] = namespace['block']
+        self.trace_lengths[start] = len(addresses)
+        return self.blocks[start]
+
+    def run(self, cycles=None):
+        # code is compiled once its entry point has been reached
+        # hot_threshold times, colder code goes through the plain decoder one
+        # basic block at a time. Near the cycle limit the plain decoder takes
+        # over so the emulator stops exactly where it was asked to
+        program = self.program
+        blocks = self.blocks
+        lengths = self.block_lengths
+        trace_lengths = self.trace_lengths
+        entries = self.entries
+        halts = self.halts
+        rom_length = len(self.rom)
+        limit = float('inf') if cycles is None else self.cycles + cycles
+        a, d, pc = self.a, self.d, self.pc
+        done = 0
+        try:
+            while True:
+                pc &= 0x7FFF
+                if cycles is None and pc in halts:
+                    break
+
+                block = blocks[pc]
+                if block is None:
+                    entries[pc] += 1
+                    if entries[pc] >= self.hot_threshold and pc < rom_length:
+                        block = self.compile_block(pc)
+
+                if block is not None \
+                        and self.cycles + trace_lengths[pc] <= limit:
+                    budget = min(limit - self.cycles, 1 << 16)
+                    a, d, pc, n = block(a, d, budget)
+                    self.cycles += n
+                    continue
+
+                length = lengths[pc]
+                if not length:
+                    if pc >= rom_length:
+                        raise Halt()
+                    length = lengths[pc] = block_length(self.rom, pc,
+                        self.leaders)
+                if self.cycles + length > limit:
+                    break
+                for done in range(length):
+                    a, d, pc = program[pc](a, d)
+                done = 0
+                self.cycles += length
+        except Halt:
+            self.cycles += done
+            limit = self.cycles
+
+        self.a, self.d, self.pc = a, d, pc
+        if cycles is not None and self.cycles < limit:
+            super().run(limit - self.cycles)
+        return self.cycles
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Run a Hack program')
+    arg_parser.add_argument('program', help='.hack or packed .bin ROM image')
+    arg_parser.add_argument('cycles', type=int, nargs='?', default=None,
+        help='number of instructions to run (default: until the program halts)')
+    arg_parser.add_argument('--jit', action='store_true',
+        help='compile basic blocks to python functions')
+    arg_parser.add_argument('--asm', default=None,
+        help='source .asm file whose labels split the basic blocks')
+    args = arg_parser.parse_args()
+
+    if args.jit:
+        emulator = BlockEmulator.from_file(args.program, args.asm)
+    else:
+        emulator = Emulator.from_file(args.program)
+
+    start = time.perf_counter()
+    emulator.run(args.cycles)
+    elapsed = time.perf_counter() - start
+
+    print(f'{emulator.cycles} cycles in {elapsed:.3f} s '
+        f'({emulator.cycles / elapsed / 1e6:.2f} M instructions/s)')
+    print(f'A={emulator.a} D={emulator.d} PC={emulator.pc}')
+    print(' '.join(f'R{i}={emulator.ram[i]}' for i in range(16)))
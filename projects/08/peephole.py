@@ -0,0 +1,184 @@
+import re
+
+
+# Rules are tried in order, each one over the whole program, and the table is
+# repeated until nothing changes. Every rule is written against the output of
+# the rules above it. Patterns are regexes matched against whole lines,
+# replacements are format strings filled from the named groups or functions
+# of the match groups. D holds no value across VM commands, so a rule may
+# drop a D load whose value is only used inside the pattern.
+
+def small_offset(seg, i):
+    lines = [f'@{seg}', 'A=M' if i == 0 else 'A=M+1']
+    lines += ['A=A+1'] * (i - 1)
+    return lines
+
+
+def pop_segment(groups):
+    i = int(groups['i'])
+    if i > 6:
+        return None
+    return ['@SP', 'AM=M-1', 'D=M'] + small_offset(groups['seg'], i) + ['M=D']
+
+
+def segment_address(groups):
+    i = int(groups['i'])
+    if i > 3:
+        return None
+    return small_offset(groups['seg'], i) + [groups['use']]
+
+
+def const_one(groups):
+    if groups['k'] not in ('0', '1'):
+        return None
+    if groups['k'] == '0':
+        return ['@SP', 'A=M-1'] if groups['op'] in '+-|' else None
+    return ['@SP', 'A=M-1', f'M=M{groups["op"]}1'] \
+        if groups['op'] in '+-' else None
+
+
+rules = [
+    ('push_tail',
+        ['@SP', 'A=M', 'M=D', '@SP', r'M=M\+1'],
+        ['@SP', 'M=M+1', 'A=M-1', 'M=D']),
+    ('pop_tail',
+        ['@SP', 'M=M-1', '@SP', 'A=M', 'D=M'],
+        ['@SP', 'AM=M-1', 'D=M']),
+    ('pop_top',
+        ['@SP', 'M=M-1', 'A=M', 'D=M'],
+        ['@SP', 'AM=M-1', 'D=M']),
+    ('binary_op',
+        ['@SP', 'AM=M-1', 'D=M', '@SP', 'M=M-1', 'A=M',
+            r'M=M(?P<op>[-+&|])D', '@SP', r'M=M\+1'],
+        ['@SP', 'AM=M-1', 'D=M', 'A=A-1', 'M=M{op}D']),
+    ('unary_op',
+        ['@SP', 'M=M-1', 'A=M', r'M=(?P<op>[-!])M', '@SP', r'M=M\+1'],
+        ['@SP', 'A=M-1', 'M={op}M']),
+    ('push_then_pop',
+        ['@SP', r'M=M\+1', 'A=M-1', 'M=D', '@SP', 'AM=M-1', 'D=M'],
+        ['@SP', 'A=M']),
+    ('dead_a_load',
+        [r'@\S+', r'(?P<next>@\S+)'],
+        ['{next}']),
+    ('dead_a_deref',
+        [r'@\S+', 'A=M', r'(?P<next>@\S+)'],
+        ['{next}']),
+    ('pop_fixed',
+        [r'@(?P<x>\S+)', 'D=A', '@R13', 'M=D', '@SP', 'AM=M-1', 'D=M',
+            '@R13', 'A=M', 'M=D'],
+        ['@SP', 'AM=M-1', 'D=M', '@{x}', 'M=D']),
+    ('pop_segment',
+        [r'@(?P<i>\d+)', 'D=A', r'@(?P<seg>\S+)', r'A=M\+D', 'D=A', '@R13',
+            'M=D', '@SP', 'AM=M-1', 'D=M', '@R13', 'A=M', 'M=D'],
+        pop_segment),
+    ('address_to_d',
+        [r'A=M\+D', 'D=A', r'(?P<next>@\S+)'],
+        ['D=M+D', '{next}']),
+    ('segment_address',
+        [r'@(?P<i>\d+)', 'D=A', r'@(?P<seg>\S+)', r'A=M\+D',
+            r'(?P<use>D=[AM])'],
+        segment_address),
+    ('stack_top',
+        ['A=M', 'A=A-1'],
+        ['A=M-1']),
+    ('const_one',
+        [r'@(?P<k>\d+)', 'D=A', '@SP', 'A=M-1', r'M=M(?P<op>[-+&|])D'],
+        const_one),
+    ('push_small_constant',
+        [r'@(?P<k>[01])', 'D=A', '@SP', r'M=M\+1', 'A=M-1', 'M=D'],
+        ['@SP', 'M=M+1', 'A=M-1', 'M={k}']),
+]
+
+
+class Rule:
+    name = ''
+    patterns = None
+    replacement = None
+
+    def __init__(self, name, patterns, replacement):
+        self.name = name
+        self.patterns = [re.compile(p) for p in patterns]
+        self.replacement = replacement
+
+    def match(self, lines, i):
+        if i + len(self.patterns) > len(lines):
+            return None
+        groups = {}
+        for pattern, line in zip(self.patterns, lines[i:]):
+            if not (match := pattern.fullmatch(line)):
+                return None
+            groups.update(match.groupdict())
+        return groups
+
+    def replace(self, groups):
+        if callable(self.replacement):
+            return self.replacement(groups)
+        return [line.format(**groups) for line in self.replacement]
+
+    def apply(self, lines, sources=None):
+        # sources, if given, runs parallel to lines, replacement lines take
+        # the source of the first line they replace
+        out = []
+        out_sources = []
+        hits = 0
+        i = 0
+        first = self.patterns[0]
+        while i < len(lines):
+            if first.fullmatch(lines[i]) \
+                    and (groups := self.match(lines, i)) is not None \
+                    and (new_lines := self.replace(groups)) is not None:
+                out += new_lines
+                if sources is not None:
+                    out_sources += [sources[i]] * len(new_lines)
+                i += len(self.patterns)
+                hits += 1
+            else:
+                out.append(lines[i])
+                if sources is not None:
+                    out_sources.append(sources[i])
+                i += 1
+        return out, hits, out_sources if sources is not None else None
+
+
+compiled_rules = [Rule(*rule) for rule in rules]
+
+
+def optimize_lines(lines, hits=None, sources=None):
+    hits = {} if hits is None else hits
+    if sources is not None:
+        sources = [s for s, line in zip(sources, lines) if line]
+    lines = [line for line in lines if line]
+
+    changed = True
+    while changed:
+        changed = False
+        for rule in compiled_rules:
+            lines, n, sources = rule.apply(lines, sources)
+            if n:
+                hits[rule.name] = hits.get(rule.name, 0) + n
+                changed = True
+    return lines, hits, sources
+
+
+def optimize(asm, hits=None):
+    lines, hits, _ = optimize_lines(asm.split('\n'), hits)
+    return '\n'.join(lines), hits
+
+
+def optimize_stream(lines, hits=None):
+    # no rule matches across a label, so optimizing the lines between two
+    # labels at a time gives the same result as the whole program at once
+    segment = []
+    for line in lines:
+        if line.startswith('('):
+            yield from optimize_lines(segment, hits)[0]
+            segment = []
+            yield line
+        else:
+            segment.append(line)
+    yield from optimize_lines(segment, hits)[0]
+
+
+def hits_report(hits):
+    return '\n'.join(f'{name:<20} {count}'
+        for name, count in sorted(hits.items(), key=lambda h: -h[1]))
@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import peephole
+from translator import asm_lines, command_stream, folder_vm_files, script_dir
+
+sys.path.append(os.path.join(os.path.dirname(script_dir), '06'))
+
+from assembler import assemble_lines, output_formats
+
+
+# VM commands -> asm lines -> words, each stage a generator. Nothing holds
+# the whole program, only the assembler's labels and forward references
+# grow with it, so a whole OS build runs in about the memory of a test.
+
+def tee_lines(lines, f):
+    # writes the lines exactly like translate_files writes the .asm
+    first = True
+    for line in lines:
+        f.write(line if first else f'\n{line}')
+        first = False
+        yield line
+
+
+def build_files(vm_files, basename, out_file, output_format='hack',
+        asm_file=None, shared_frames=False, optimize=False,
+        compact_conditionals=False, hits=None, prune=False):
+    lines = asm_lines(command_stream(vm_files, basename, shared_frames,
+        compact_conditionals, prune))
+    if optimize:
+        lines = peephole.optimize_stream(lines, hits)
+
+    if asm_file is None:
+        return assemble_lines(lines, out_file, output_format)
+    with open(asm_file, 'w') as f:
+        return assemble_lines(tee_lines(lines, f), out_file, output_format)
+
+
+def build_folder(name, output_format='hack', write_asm=True,
+        shared_frames=False, optimize=False, compact_conditionals=False,
+        hits=None, prune=False):
+    folder = os.path.join(script_dir, name)
+    basename = os.path.basename(folder)
+    out_file = os.path.join(folder, f'{basename}.{output_format}')
+    asm_file = os.path.join(folder, f'{basename}.asm') if write_asm else None
+    return build_files(folder_vm_files(folder), basename, out_file,
+        output_format, asm_file, shared_frames, optimize,
+        compact_conditionals, hits, prune)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Translate and assemble folders of .vm files in one pass')
+    arg_parser.add_argument('folders', nargs='*',
+        default=['FunctionCalls/StaticsTest'],
+        help='folders relative to this script or absolute paths')
+    arg_parser.add_argument('-f', '--format', choices=output_formats.keys(),
+        default='hack', help='output format')
+    arg_parser.add_argument('--no-asm', action='store_true',
+        help='do not write the intermediate .asm file')
+    arg_parser.add_argument('--shared-frames', action='store_true',
+        help='call and return through shared $$CALL/$$RETURN routines')
+    arg_parser.add_argument('-O', '--optimize', action='store_true',
+        help='run the peephole optimizer over the generated assembly')
+    arg_parser.add_argument('--compact-conditionals', action='store_true',
+        help='short eq/gt/lt code, fused with a following if-goto')
+    arg_parser.add_argument('--prune', action='store_true',
+        help='leave out functions that Sys.init can never call')
+    arg_parser.add_argument('--memory', action='store_true',
+        help='report peak Python memory of each build')
+    args = arg_parser.parse_args()
+
+    for name in args.folders:
+        if args.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        words = build_folder(name, args.format, not args.no_asm,
+            args.shared_frames, args.optimize, args.compact_conditionals,
+            prune=args.prune)
+        elapsed = time.perf_counter() - start
+
+        line = f'{name}: {words} words in {elapsed * 1000:.1f} ms'
+        if args.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            line += f', peak {peak / 1024:.0f} KiB'
+        print(line)
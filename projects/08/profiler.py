@@ -0,0 +1,237 @@
+import argparse
+import os
+import sys
+import time
+
+from translator import change_ext, script_dir, translate_folder
+
+sys.path.append(os.path.join(os.path.dirname(script_dir), '06'))
+
+from assembler import assemble_asm
+from emulator import Emulator, Halt
+
+
+# commands whose code ends in a call, jumps into a function and returns
+call_kinds = {'CallCommand', 'SharedCallCommand', 'InitCommand'}
+enter_kinds = {'CallCommand', 'InitCommand', 'FrameRoutinesCommand'}
+return_kinds = {'ReturnCommand', 'FrameRoutinesCommand'}
+
+
+class RomMap:
+    # the .hack.map written by the assembler, one list entry per ROM address
+    commands = None
+    vm_files = None
+    vm_lines = None
+    kinds = None
+    functions = None
+
+    def __init__(self, size):
+        self.commands = [-1] * size
+        self.vm_files = [''] * size
+        self.vm_lines = [0] * size
+        self.kinds = [''] * size
+        self.functions = [''] * size
+
+    @classmethod
+    def from_file(cls, filename, size):
+        rom_map = cls(size)
+        with open(filename, 'r') as f:
+            for line in f:
+                address, cmd, vm_file, vm_line, kind, function = \
+                    line.rstrip('\n').split('\t')
+                address = int(address)
+                rom_map.commands[address] = int(cmd)
+                rom_map.vm_files[address] = vm_file
+                rom_map.vm_lines[address] = int(vm_line)
+                rom_map.kinds[address] = kind
+                rom_map.functions[address] = function
+        return rom_map
+
+    def entries(self):
+        # first address of every function, also when it has no locals and
+        # its FunctionCommand emits no code
+        return {address: function
+            for address, function in enumerate(self.functions)
+            if function and not function.startswith('$$')
+                and (address == 0 or self.functions[address - 1] != function)}
+
+    def return_addresses(self):
+        return {address for address in range(1, len(self.kinds))
+            if self.kinds[address - 1] in call_kinds
+                and self.commands[address] != self.commands[address - 1]}
+
+
+class Profile:
+    counts = None
+    folded = None
+    edges = None
+    cycles = 0
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.folded = {}
+        self.edges = {}
+
+
+def profile(emulator, rom_map, max_cycles=None):
+    # runs the emulator one instruction at a time, counting executions per
+    # address and cycles per call stack. A call is a jump from call code to
+    # a function entry, a return a jump from return code to a return address
+    program = emulator.program
+    halts = emulator.halts
+    entries = rom_map.entries()
+    returns = rom_map.return_addresses()
+    kinds = rom_map.kinds
+    result = Profile(len(emulator.rom))
+    counts = result.counts
+    folded = result.folded
+    edges = result.edges
+
+    a, d, pc = emulator.a, emulator.d, emulator.pc
+    stack = [rom_map.functions[pc] or '(unmapped)']
+    key = stack[0]
+    n = 0
+    last = 0
+    limit = max_cycles if max_cycles is not None else -1
+    while n != limit:
+        counts[pc] += 1
+        try:
+            a, d, next_pc = program[pc](a, d)
+        except Halt:
+            counts[pc] -= 1
+            break
+        n += 1
+
+        # the bootstrap's jump to Sys.init can land on the next address
+        if next_pc != pc + 1 or next_pc in entries:
+            if next_pc in halts:
+                pc = next_pc
+                break
+            kind = kinds[pc]
+            if next_pc in entries and kind in enter_kinds:
+                callee = entries[next_pc]
+                edge = (stack[-1], callee)
+                edges[edge] = edges.get(edge, 0) + 1
+                stack.append(callee)
+            elif next_pc in returns and kind in return_kinds \
+                    and len(stack) > 1:
+                stack.pop()
+            else:
+                pc = next_pc
+                continue
+            # the cycles so far belong to the stack before the call/return
+            folded[key] = folded.get(key, 0) + n - last
+            last = n
+            key = ';'.join(stack)
+        pc = next_pc
+
+    folded[key] = folded.get(key, 0) + n - last
+    emulator.a, emulator.d, emulator.pc = a, d, pc
+    emulator.cycles += n
+    result.cycles = n
+    return result
+
+
+def by_vm_line(result, rom_map):
+    totals = {}
+    for address, count in enumerate(result.counts):
+        if count:
+            line = (rom_map.vm_files[address], rom_map.vm_lines[address],
+                rom_map.kinds[address])
+            totals[line] = totals.get(line, 0) + count
+    return totals
+
+
+def by_function(result, rom_map):
+    totals = {}
+    for address, count in enumerate(result.counts):
+        if count:
+            function = rom_map.functions[address] or '(unmapped)'
+            totals[function] = totals.get(function, 0) + count
+    return totals
+
+
+def inclusive_edges(result):
+    # cycles spent below each call edge, counted once per stack even when
+    # recursion repeats the edge
+    totals = {}
+    for key, count in result.folded.items():
+        frames = key.split(';')
+        for edge in set(zip(frames, frames[1:])):
+            totals[edge] = totals.get(edge, 0) + count
+    return totals
+
+
+def folded_stacks(result):
+    return '\n'.join(f'{key} {count}'
+        for key, count in sorted(result.folded.items()) if count)
+
+
+def report(result, rom_map, top=20):
+    def percent(count):
+        return 100 * count / result.cycles if result.cycles else 0
+
+    lines = [f'{result.cycles} cycles']
+
+    lines.append('\nfunctions (self cycles)')
+    functions = by_function(result, rom_map)
+    for function, count in sorted(functions.items(),
+            key=lambda f: -f[1])[:top]:
+        lines.append(f'{count:>12} {percent(count):5.1f}%  {function}')
+
+    lines.append('\nVM lines')
+    vm_lines = by_vm_line(result, rom_map)
+    for (vm_file, vm_line, kind), count in sorted(vm_lines.items(),
+            key=lambda l: -l[1])[:top]:
+        source = f'{vm_file}:{vm_line}' if vm_file else '(generated)'
+        lines.append(f'{count:>12} {percent(count):5.1f}%  {source} {kind}')
+
+    lines.append('\ncall edges (calls, inclusive cycles)')
+    inclusive = inclusive_edges(result)
+    for (caller, callee), calls in sorted(result.edges.items(),
+            key=lambda e: -inclusive.get(e[0], 0))[:top]:
+        cycles = inclusive.get((caller, callee), 0)
+        lines.append(f'{calls:>12} {cycles:>12}  {caller} -> {callee}')
+    return '\n'.join(lines)
+
+
+def profile_folder(name, max_cycles=None, shared_frames=False,
+        optimize=False, compact_conditionals=False):
+    folder = os.path.join(script_dir, name)
+    asm_file = os.path.join(folder, f'{os.path.basename(folder)}.asm')
+    translate_folder(name, shared_frames=shared_frames, optimize=optimize,
+        compact_conditionals=compact_conditionals, source_map=True)
+    rom = assemble_asm(asm_file)
+    rom_map = RomMap.from_file(change_ext(asm_file, 'hack.map'), len(rom))
+    return profile(Emulator(rom), rom_map, max_cycles), rom_map
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Profile a folder of .vm files on the Hack emulator')
+    arg_parser.add_argument('folder',
+        help='folder relative to this script or absolute path')
+    arg_parser.add_argument('cycles', type=int, nargs='?', default=None,
+        help='stop after this many cycles (default: until the program halts)')
+    arg_parser.add_argument('--folded',
+        help='write flamegraph folded stacks to this file')
+    arg_parser.add_argument('--top', type=int, default=20,
+        help='rows per table (default: %(default)s)')
+    arg_parser.add_argument('--shared-frames', action='store_true',
+        help='call and return through shared $$CALL/$$RETURN routines')
+    arg_parser.add_argument('-O', '--optimize', action='store_true',
+        help='run the peephole optimizer over the generated assembly')
+    arg_parser.add_argument('--compact-conditionals', action='store_true',
+        help='short eq/gt/lt code, fused with a following if-goto')
+    args = arg_parser.parse_args()
+
+    start = time.perf_counter()
+    result, rom_map = profile_folder(args.folder, args.cycles,
+        args.shared_frames, args.optimize, args.compact_conditionals)
+    elapsed = time.perf_counter() - start
+
+    print(report(result, rom_map, args.top))
+    print(f'\nprofiled in {elapsed:.2f} s')
+    if args.folded:
+        with open(args.folded, 'w') as f:
+            f.write(folded_stacks(result))
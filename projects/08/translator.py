@@ -1,18 +1,46 @@
+import argparse
 import os
 import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(script_dir))
+
+from build_cache import file_hash, tool_version
+import peephole
 
 
 def unindent_multiline(s):
     return '\n'.join(line.strip() for line in s.split('\n')).strip()
 
 
-cond_key = 0
-def conditional(cond):
-    global cond_key
-    output = unindent_multiline(f'''
+class LabelGenerator:
+    # a scope, e.g. the .vm file name, keeps the labels of separately
+    # translated files apart
+    cond_key = 0
+    func_usage = None
+    prefix = ''
+
+    def __init__(self, scope=''):
+        self.cond_key = 0
+        self.func_usage = {}
+        self.prefix = f'{scope}.' if scope else ''
+
+    def next_cond_key(self):
+        key = self.cond_key
+        self.cond_key += 1
+        return f'{self.prefix}{key}'
+
+    def return_label(self, func_name):
+        self.func_usage[func_name] = self.func_usage.get(func_name, 0) + 1
+        return f'return${self.prefix}{func_name}.{self.func_usage[func_name]}'
+
+
+def conditional(cond, cond_key):
+    return unindent_multiline(f'''
         M=M-D
         D=A
         @R14
@@ -31,20 +59,50 @@ def conditional(cond):
         A=M
         M=D
         ''')
-    cond_key += 1
-    return output
+
+
+def compact_conditional(cond, cond_key):
+    # leaves -1 on the stack top and overwrites it with 0 when the jump to
+    # the end is not taken, the address stays in A instead of going via R14
+    return unindent_multiline(f'''
+        @SP
+        AM=M-1
+        D=M
+        A=A-1
+        D=M-D
+        M=-1
+        @CONDITIONALJUMP.END.{cond_key}
+        D;J{cond}
+        @SP
+        A=M-1
+        M=0
+        (CONDITIONALJUMP.END.{cond_key})
+        ''')
+
+
+compare_conds = {
+    'gt': 'GT',
+    'lt': 'LT',
+    'eq': 'EQ'
+}
+
+negated_conds = {
+    'GT': 'LE',
+    'LT': 'GE',
+    'EQ': 'NE'
+}
 
 
 operations_dict = {
-    'add': lambda: 'M=M+D',
-    'sub': lambda: 'M=M-D',
-    'neg': lambda: 'M=-M',
-    'and': lambda: 'M=M&D',
-    'or': lambda: 'M=M|D',
-    'not': lambda: 'M=!M',
-    'gt': lambda: conditional('GT'),
-    'lt': lambda: conditional('LT'),
-    'eq': lambda: conditional('EQ')
+    'add': lambda labels: 'M=M+D',
+    'sub': lambda labels: 'M=M-D',
+    'neg': lambda labels: 'M=-M',
+    'and': lambda labels: 'M=M&D',
+    'or': lambda labels: 'M=M|D',
+    'not': lambda labels: 'M=!M',
+    'gt': lambda labels: conditional('GT', labels.next_cond_key()),
+    'lt': lambda labels: conditional('LT', labels.next_cond_key()),
+    'eq': lambda labels: conditional('EQ', labels.next_cond_key())
 }
 
 
@@ -109,8 +167,11 @@ class SymbolFns:
         'pointer': pointer_fn
     }
 
-    def __init__(self, name):
-        self.symbol_fns['static'] = static_fn_wrapper(name)
+    labels = None
+
+    def __init__(self, name, labels=None):
+        self.symbol_fns = {**self.symbol_fns, 'static': static_fn_wrapper(name)}
+        self.labels = labels or LabelGenerator()
 
     def get(self, name):
         return self.symbol_fns.get(name) or (lambda a: symbol_fn(name, a))
@@ -122,6 +183,8 @@ class SymbolFns:
 class Command:
     arg1 = ''
     arg2 = ''
+    source_file = ''
+    source_line = 0
 
     def cmd_str(self, *args, **kwargs):
         raise Exception('cannot call cmd_str on abstract command')
@@ -178,11 +241,14 @@ class IfGotoCommand(LabelCommand):
 
 
 class ArithmeticCommand(Command):
-    def __init__(self, arg):
+    labels = None
+
+    def __init__(self, arg, labels):
         self.arg1 = arg
+        self.labels = labels
 
     def cmd_str(self):
-        operation = operations_dict[self.arg1]()
+        operation = operations_dict[self.arg1](self.labels)
 
         extra_pop = ''
         if 'D' in operation:
@@ -201,6 +267,40 @@ class ArithmeticCommand(Command):
             ''')
 
 
+class CompareCommand(ArithmeticCommand):
+    def cmd_str(self):
+        return compact_conditional(compare_conds[self.arg1],
+            self.labels.next_cond_key())
+
+
+class CompareGotoCommand(IfGotoCommand):
+    # a comparison directly followed by an if-goto, or by not and an if-goto
+    # as every Jack if and while compiles to, jumps on the comparison itself
+    # instead of pushing a boolean and popping it again
+    compare = ''
+    negate = False
+
+    def __init__(self, compare, if_goto, negate=False):
+        super().__init__(if_goto.name, if_goto.arg1)
+        self.compare = compare
+        self.negate = negate
+
+    def cmd_str(self):
+        cond = compare_conds[self.compare]
+        if self.negate:
+            cond = negated_conds[cond]
+        return unindent_multiline(f'''
+            @SP
+            AM=M-1
+            D=M
+            @SP
+            AM=M-1
+            D=M-D
+            @{self.jump_label()}
+            D;J{cond}
+            ''')
+
+
 class StackChangeCommand(Command):
     sym_fns = None
 
@@ -292,10 +392,8 @@ class ReturnCommand(Command):
 
 
 class CallCommand(StackChangeCommand):
-    func_usage = {}
-
     def cmd_str(self):
-        jump_label = self.create_label()
+        jump_label = self.sym_fns.labels.return_label(self.arg1)
         return unindent_multiline(f'''
             @{jump_label}
             D=A
@@ -324,21 +422,120 @@ class CallCommand(StackChangeCommand):
             ({jump_label})
             ''')
 
-    def create_label(self):
-        if self.arg1 not in CallCommand.func_usage:
-            CallCommand.func_usage[self.arg1] = 0
-        CallCommand.func_usage[self.arg1] += 1
-        return f'return${self.arg1}.{CallCommand.func_usage[self.arg1]}'
+
+class SharedCallCommand(CallCommand):
+    # jumps to the $$CALL routine with the function in R13, the number of
+    # arguments in R14 and the return address in D
+    def cmd_str(self):
+        jump_label = self.sym_fns.labels.return_label(self.arg1)
+        return unindent_multiline(f'''
+            @{self.arg1}
+            D=A
+            @R13
+            M=D
+            @{self.arg2}
+            D=A
+            @R14
+            M=D
+            @{jump_label}
+            D=A
+            @$$CALL
+            0;JMP
+            ({jump_label})
+            ''')
+
+
+class SharedReturnCommand(ReturnCommand):
+    def cmd_str(self):
+        return unindent_multiline('''
+            @$$RETURN
+            0;JMP
+            ''')
+
+
+class FrameRoutinesCommand(Command):
+    # the $$CALL and $$RETURN routines used by the shared call and return
+    # commands, emitted once per program
+    def cmd_str(self):
+        push_ptrs = '\n'.join(self.push_pointer(lbl)
+            for lbl in 'LCL ARG THIS THAT'.split())
+        move_ptrs = '\n'.join(self.move_pointer(lbl)
+            for lbl in 'THAT THIS ARG LCL'.split())
+        return unindent_multiline(f'''
+            ($$CALL)
+            @SP
+            A=M
+            M=D
+            {push_ptrs}
+            @SP
+            MD=M+1
+            @LCL
+            M=D
+            @R14
+            D=D-M
+            @5
+            D=D-A
+            @ARG
+            M=D
+            @R13
+            A=M
+            0;JMP
+            ($$RETURN)
+            @LCL
+            D=M
+            @R13
+            M=D
+            @5
+            A=D-A
+            D=M
+            @R14
+            M=D
+            @SP
+            AM=M-1
+            D=M
+            @ARG
+            A=M
+            M=D
+            @ARG
+            D=M+1
+            @SP
+            M=D
+            {move_ptrs}
+            @R14
+            A=M
+            0;JMP
+            ''')
+
+    def push_pointer(self, ptr_label):
+        return unindent_multiline(f'''
+            @{ptr_label}
+            D=M
+            @SP
+            AM=M+1
+            M=D
+            ''')
+
+    def move_pointer(self, ptr_label):
+        return unindent_multiline(f'''
+            @R13
+            AM=M-1
+            D=M
+            @{ptr_label}
+            M=D
+            ''')
 
 
 class InitCommand(Command):
     sym_fns = None
+    shared_frames = False
 
-    def __init__(self, sym_fns):
+    def __init__(self, sym_fns, shared_frames=False):
         self.sym_fns = sym_fns
+        self.shared_frames = shared_frames
 
     def cmd_str(self):
-        caller = CallCommand(['Sys.init', '0'], self.sym_fns)
+        call_command = SharedCallCommand if self.shared_frames else CallCommand
+        caller = call_command(['Sys.init', '0'], self.sym_fns)
         return unindent_multiline(f'''
             @256
             D=A
@@ -352,17 +549,34 @@ class Parser:
     f = None
     sym_fns = None
     name = ''
+    function = ''
+    shared_frames = False
+    compact_conditionals = False
 
-    def __init__(self, f, name):
+    def __init__(self, f, name, labels=None, shared_frames=False,
+            compact_conditionals=False):
         self.f = f
         self.name = name
-        self.sym_fns = SymbolFns(name)
+        self.function = ''
+        self.sym_fns = SymbolFns(name, labels)
+        self.shared_frames = shared_frames
+        self.compact_conditionals = compact_conditionals
 
     def parse(self):
-        for line in self.f:
+        cmds = self.parse_lines()
+        if self.compact_conditionals:
+            cmds = fuse_compare_jumps(cmds)
+        yield from cmds
+
+    def parse_lines(self):
+        source_file = os.path.basename(getattr(self.f, 'name', self.name))
+        for line_no, line in enumerate(self.f, 1):
             cleaned_line = self.clean_line(line)
             if cleaned_line:
-                yield self.create_command(cleaned_line)
+                cmd = self.create_command(cleaned_line)
+                cmd.source_file = source_file
+                cmd.source_line = line_no
+                yield cmd
 
     def clean_line(self, line):
         return re.sub(r'\s+', ' ',
@@ -371,55 +585,568 @@ class Parser:
     def create_command(self, line):
         tokens = line.split()
 
+        if tokens[0] in compare_conds and self.compact_conditionals:
+            return CompareCommand(tokens[0], self.sym_fns.labels)
         if tokens[0] in operations_dict.keys():
-            return ArithmeticCommand(tokens[0])
+            return ArithmeticCommand(tokens[0], self.sym_fns.labels)
         if tokens[0] == 'push':
             return PushCommand(tokens[1:], self.sym_fns)
         if tokens[0] == 'pop':
             return PopCommand(tokens[1:], self.sym_fns)
+        # labels are scoped by function as functionName$label
+        scope = self.function or self.name
         if tokens[0] == 'label':
-            return LabelCommand(self.name, tokens[1])
+            return LabelCommand(scope, tokens[1])
         if tokens[0] == 'goto':
-            return GotoCommand(self.name, tokens[1])
+            return GotoCommand(scope, tokens[1])
         if tokens[0] == 'if-goto':
-            return IfGotoCommand(self.name, tokens[1])
+            return IfGotoCommand(scope, tokens[1])
         if tokens[0] == 'function':
+            self.function = tokens[1]
             return FunctionCommand(tokens[1:], self.sym_fns)
         if tokens[0] == 'return':
+            if self.shared_frames:
+                return SharedReturnCommand(self.sym_fns)
             return ReturnCommand(self.sym_fns)
         if tokens[0] == 'call':
+            if self.shared_frames:
+                return SharedCallCommand(tokens[1:], self.sym_fns)
             return CallCommand(tokens[1:], self.sym_fns)
 
         raise Exception('invalid instruction')
 
 
+def fuse_compare_jumps(cmds):
+    # pending holds a comparison, then maybe a not, waiting for an if-goto
+    pending = []
+    for cmd in cmds:
+        if pending:
+            if type(cmd) is IfGotoCommand:
+                fused = CompareGotoCommand(pending[0].arg1, cmd,
+                    len(pending) == 2)
+                fused.source_file = pending[0].source_file
+                fused.source_line = pending[0].source_line
+                yield fused
+                pending = []
+                continue
+            if (len(pending) == 1 and type(cmd) is ArithmeticCommand
+                    and cmd.arg1 == 'not'):
+                pending.append(cmd)
+                continue
+            yield from pending
+            pending = []
+
+        if isinstance(cmd, CompareCommand):
+            pending = [cmd]
+        else:
+            yield cmd
+
+    yield from pending
+
+
 def translate(commands):
     return '\n'.join(c.cmd_str() for c in commands)
 
 
+routine_names = {
+    'InitCommand': '$$INIT',
+    'FrameRoutinesCommand': '$$FRAMES'
+}
+
+
+def translate_mapped(commands):
+    # the lines of translate() plus, for every line, the command it came
+    # from as (index, vm file, vm line, command class, function)
+    lines = []
+    sources = []
+    function = ''
+    for i, cmd in enumerate(commands):
+        kind = type(cmd).__name__
+        if isinstance(cmd, FunctionCommand):
+            function = cmd.arg1
+        elif kind in routine_names:
+            function = routine_names[kind]
+        elif not function or function in routine_names.values():
+            function = cmd.source_file.split('.')[0]
+
+        cmd_lines = cmd.cmd_str().split('\n')
+        lines += cmd_lines
+        sources += [(i, cmd.source_file, cmd.source_line, kind, function)] \
+            * len(cmd_lines)
+    return lines, sources
+
+
+def write_source_map(sources, out_file, asm_hash):
+    # the first line holds the hash of the .asm the map is for, the assembler
+    # ignores a map left from an earlier translation
+    with open(out_file, 'w') as f:
+        f.write(f'# {asm_hash}\n')
+        f.write('\n'.join('\t'.join(str(field) for field in (i,) + source)
+            for i, source in enumerate(sources, 1)))
+
+
 def change_ext(filename, ext):
     basename = os.path.basename(filename)
     basename = basename.split('.')[0]
     return os.path.join(os.path.dirname(filename), f'{basename}.{ext}')
 
 
-def translate_folder(name):
+def vm_name(filename):
+    # statics of Foo.vm are Foo.0, Foo.1, ...
+    return os.path.basename(filename).split('.')[0]
+
+
+def init_commands(basename, shared_frames=False):
+    yield InitCommand(SymbolFns(basename, LabelGenerator()), shared_frames)
+    if shared_frames:
+        yield FrameRoutinesCommand()
+
+
+def prune_functions(cmds, reachable):
+    # drops the functions not in reachable, code before the first function
+    # of a file is always kept
+    keep = True
+    for cmd in cmds:
+        if isinstance(cmd, FunctionCommand):
+            keep = cmd.arg1 in reachable
+        if keep:
+            yield cmd
+
+
+def file_commands(filename, shared_frames=False, compact_conditionals=False,
+        reachable=None):
+    # every file gets its own label counters in its own scope, so files can
+    # be translated in any order, or in parallel, and give the same labels
+    name = vm_name(filename)
+    with open(filename, 'r') as f:
+        cmds = Parser(f, name, LabelGenerator(name), shared_frames,
+            compact_conditionals).parse()
+        if reachable is not None:
+            cmds = prune_functions(cmds, reachable)
+        yield from cmds
+
+
+def call_graph(vm_files):
+    # the functions each function calls, calls made outside any function
+    # are under ''
+    graph = {'': set()}
+    for filename in vm_files:
+        function = ''
+        for cmd in file_commands(filename):
+            if isinstance(cmd, FunctionCommand):
+                function = cmd.arg1
+                graph.setdefault(function, set())
+            elif isinstance(cmd, CallCommand):
+                graph[function].add(cmd.arg1)
+    return graph
+
+
+def reachable_functions(vm_files, root='Sys.init'):
+    # everything the bootstrap's call to root can reach, calls to functions
+    # that are not defined in vm_files are left alone
+    graph = call_graph(vm_files)
+    if root not in graph:
+        raise Exception(f'Unknown function {root}')
+
+    reachable = {''}
+    pending = [root, *graph['']]
+    while pending:
+        function = pending.pop()
+        if function in reachable or function not in graph:
+            continue
+        reachable.add(function)
+        pending += graph[function]
+    return reachable
+
+
+def command_stream(vm_files, basename, shared_frames=False,
+        compact_conditionals=False, prune=False):
+    reachable = reachable_functions(vm_files) if prune else None
+    yield from init_commands(basename, shared_frames)
+    for filename in vm_files:
+        yield from file_commands(filename, shared_frames, compact_conditionals,
+            reachable)
+
+
+temp_slots = 8
+
+stack_effects = {
+    'add': -1, 'sub': -1, 'and': -1, 'or': -1,
+    'eq': -1, 'gt': -1, 'lt': -1,
+    'neg': 0, 'not': 0
+}
+
+
+def stack_effect(cmd):
+    if isinstance(cmd, PushCommand):
+        return 1
+    if isinstance(cmd, PopCommand):
+        return -1
+    return stack_effects[cmd.arg1]
+
+
+def used_temps(cmds):
+    return {int(cmd.arg2) for cmd in cmds
+        if isinstance(cmd, StackChangeCommand) and cmd.arg1 == 'temp'}
+
+
+def function_bodies(cmds):
+    # the commands of every function up to and including its first return
+    bodies = {}
+    body = None
+    for cmd in cmds:
+        if isinstance(cmd, FunctionCommand):
+            body = bodies[cmd.arg1] = (cmd, [])
+        elif body is not None:
+            body[1].append(cmd)
+            if isinstance(cmd, ReturnCommand):
+                body = None
+    return bodies
+
+
+class InlineCandidate:
+    # a leaf function whose body is straight line code leaving exactly its
+    # return value on the stack
+    name = ''
+    n_vars = 0
+    n_args = 0
+    body = None
+    pointers = None
+    reason = ''
+
+    def __init__(self, function, body, max_size):
+        self.name = function.arg1
+        self.n_vars = int(function.arg2)
+        self.body = body[:-1]
+        self.reason = self.check(body, max_size)
+        if self.reason:
+            return
+
+        # pointer writes are undone afterwards like return would
+        self.pointers = sorted({cmd.arg2 for cmd in self.body
+            if isinstance(cmd, PopCommand) and cmd.arg1 == 'pointer'})
+        self.n_args = max([int(cmd.arg2) + 1 for cmd in self.body
+            if cmd.arg1 == 'argument'], default=0)
+
+    def check(self, body, max_size):
+        if not body or not isinstance(body[-1], ReturnCommand):
+            return 'does not end in return'
+        if any(isinstance(cmd, CallCommand) for cmd in body):
+            return 'calls other functions'
+        if any(isinstance(cmd, LabelCommand) for cmd in body):
+            return 'has branches'
+        if len(body) - 1 > max_size:
+            return f'too large ({len(body) - 1} > {max_size} commands)'
+
+        depth = 0
+        for cmd in body[:-1]:
+            depth += stack_effect(cmd)
+            if depth < 0:
+                return 'pops below its own stack'
+        if depth != 1:
+            return f'leaves {depth} values on the stack'
+        return ''
+
+    def slots_needed(self, n_args):
+        return n_args + self.n_vars + len(self.pointers)
+
+    def commands(self, call, slots):
+        # the body in place of call: arguments and locals live in temp slots
+        # nothing else in the program uses
+        sym_fns = call.sym_fns
+        n_args = int(call.arg2)
+        arg_slots = slots[:n_args]
+        local_slots = slots[n_args:n_args + self.n_vars]
+        save_slots = slots[n_args + self.n_vars:]
+
+        def temp(command, slot, source):
+            cmd = command(['temp', str(slot)], sym_fns)
+            cmd.source_file = source.source_file
+            cmd.source_line = source.source_line
+            return cmd
+
+        cmds = [temp(PopCommand, slot, call) for slot in reversed(arg_slots)]
+        for slot in local_slots:
+            cmds += [PushCommand(['constant', '0'], sym_fns),
+                temp(PopCommand, slot, call)]
+        for pointer, slot in zip(self.pointers, save_slots):
+            cmds += [PushCommand(['pointer', pointer], sym_fns),
+                temp(PopCommand, slot, call)]
+
+        segments = {'argument': arg_slots, 'local': local_slots}
+        for cmd in self.body:
+            if isinstance(cmd, StackChangeCommand) and cmd.arg1 in segments:
+                cmd = temp(type(cmd), segments[cmd.arg1][int(cmd.arg2)], cmd)
+            cmds.append(cmd)
+
+        for pointer, slot in zip(self.pointers, save_slots):
+            cmds += [temp(PushCommand, slot, call),
+                PopCommand(['pointer', pointer], sym_fns)]
+        return cmds
+
+
+def inline_functions(cmds, max_size):
+    # replaces calls of small leaf functions with their bodies, returns the
+    # new commands and what was decided for every function
+    free = [slot for slot in range(temp_slots) if slot not in used_temps(cmds)]
+    candidates = {name: InlineCandidate(function, body, max_size)
+        for name, (function, body) in function_bodies(cmds).items()}
+    decisions = {name: candidate.reason
+        for name, candidate in candidates.items() if candidate.reason}
+    sites = {}
+
+    inlined = []
+    for cmd in cmds:
+        candidate = candidates.get(cmd.arg1) \
+            if isinstance(cmd, CallCommand) else None
+        if candidate is None or candidate.reason:
+            inlined.append(cmd)
+            continue
+
+        n_args = int(cmd.arg2)
+        if n_args < candidate.n_args:
+            decisions[candidate.name] = f'called with {n_args} arguments'
+            inlined.append(cmd)
+        elif candidate.slots_needed(n_args) > len(free):
+            decisions[candidate.name] = (f'needs '
+                f'{candidate.slots_needed(n_args)} temp slots, '
+                f'{len(free)} free')
+            inlined.append(cmd)
+        else:
+            inlined += candidate.commands(cmd, free)
+            sites[candidate.name] = sites.get(candidate.name, 0) + 1
+
+    for name, count in sites.items():
+        size = len(candidates[name].body)
+        skipped = f', {decisions[name]} elsewhere' if name in decisions else ''
+        decisions[name] = f'inlined at {count} call sites ({size} commands)' \
+            f'{skipped}'
+    for name in candidates:
+        decisions.setdefault(name, 'never called')
+    return inlined, decisions
+
+
+def parse_files(vm_files, basename, shared_frames=False,
+        compact_conditionals=False, prune=False, inline=0):
+    # inline is the largest function body, in VM commands, to inline
+    cmds = list(command_stream(vm_files, basename, shared_frames,
+        compact_conditionals, prune))
+    if inline:
+        cmds, _ = inline_functions(cmds, inline)
+    return cmds
+
+
+def asm_lines(commands):
+    # same lines as translate(), one command at a time
+    for cmd in commands:
+        yield from cmd.cmd_str().split('\n')
+
+
+def translate_files(vm_files, basename, out_file, shared_frames=False,
+        optimize=False, compact_conditionals=False, source_map=False,
+        prune=False, inline=0):
+    cmds = parse_files(vm_files, basename, shared_frames,
+        compact_conditionals, prune, inline)
+    if source_map:
+        # the map goes next to the .asm, the assembler carries it to ROM
+        lines, sources = translate_mapped(cmds)
+        if optimize:
+            lines, _, sources = peephole.optimize_lines(lines, sources=sources)
+        asm = '\n'.join(lines)
+    else:
+        asm = translate(cmds)
+        if optimize:
+            asm, _ = peephole.optimize(asm)
+    with open(out_file, 'w') as f:    
+        f.write(asm)
+    if source_map:
+        write_source_map(sources, change_ext(out_file, 'asm.map'),
+            file_hash(out_file))
+    return asm
+
+
+def translate_shard(filename, shared_frames=False, optimize=False,
+        compact_conditionals=False, reachable=None):
+    asm = translate(file_commands(filename, shared_frames,
+        compact_conditionals, reachable))
+    if optimize:
+        asm, _ = peephole.optimize(asm)
+    return asm
+
+
+def translate_parallel(vm_files, basename, out_file, jobs=None,
+        shared_frames=False, optimize=False, compact_conditionals=False,
+        prune=False):
+    # one task per .vm file. Labels are scoped by file and map() returns the
+    # shards in vm_files order, so any number of workers gives the same
+    # output. With optimize the shards are optimized separately, which can
+    # differ from translate_files where a file does not start with a label
+    reachable = reachable_functions(vm_files) if prune else None
+    init = translate(init_commands(basename, shared_frames))
+    if optimize:
+        init, _ = peephole.optimize(init)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        shards = list(executor.map(translate_shard, vm_files,
+            repeat(shared_frames), repeat(optimize),
+            repeat(compact_conditionals), repeat(reachable)))
+
+    asm = '\n'.join(shard for shard in [init] + shards if shard)
+    with open(out_file, 'w') as f:
+        f.write(asm)
+    return asm
+
+
+def rom_words(asm):
+    return sum(1 for line in asm.split('\n')
+        if line and not line.startswith('('))
+
+
+def frame_report(vm_files, basename):
+    inline = rom_words(translate(parse_files(vm_files, basename)))
+    shared = rom_words(translate(parse_files(vm_files, basename, True)))
+    saved = inline - shared
+    percent = 100 * saved / inline if inline else 0
+    return (f'{basename}: {inline} words inline, {shared} words with shared '
+        f'call/return ({saved} saved, {percent:.1f}%)')
+
+
+def conditional_report(vm_files, basename):
+    plain = rom_words(translate(parse_files(vm_files, basename)))
+    compact = rom_words(translate(parse_files(vm_files, basename,
+        compact_conditionals=True)))
+    saved = plain - compact
+    percent = 100 * saved / plain if plain else 0
+    return (f'{basename}: {plain} words, {compact} words with compact '
+        f'comparisons ({saved} saved, {percent:.1f}%)')
+
+
+def prune_report(vm_files, basename):
+    reachable = reachable_functions(vm_files)
+    pruned = {}
+    for filename in vm_files:
+        function = None
+        for cmd in file_commands(filename):
+            if isinstance(cmd, FunctionCommand):
+                function = cmd.arg1 if cmd.arg1 not in reachable else None
+            if function is not None:
+                pruned.setdefault(function, []).append(cmd)
+
+    words = {function: rom_words(translate(cmds))
+        for function, cmds in pruned.items()}
+    total = rom_words(translate(parse_files(vm_files, basename)))
+    saved = sum(words.values())
+    percent = 100 * saved / total if total else 0
+    lines = [f'{basename}: {len(pruned)} unreachable functions, {saved} of '
+        f'{total} words saved ({percent:.1f}%)']
+    lines += [f'{words[function]:>8} {function}' for function in sorted(pruned)]
+    return '\n'.join(lines)
+
+
+def inline_report(vm_files, basename, max_size, shared_frames=False):
+    cmds = parse_files(vm_files, basename, shared_frames)
+    before = rom_words(translate(cmds))
+    inlined, decisions = inline_functions(
+        parse_files(vm_files, basename, shared_frames), max_size)
+    after = rom_words(translate(inlined))
+    lines = [f'{basename}: {before} words, {after} words after inlining '
+        f'functions of up to {max_size} commands']
+    lines += [f'{name}: {decisions[name]}' for name in sorted(decisions)]
+    return '\n'.join(lines)
+
+
+def optimize_report(vm_files, basename, shared_frames=False,
+        compact_conditionals=False):
+    asm = translate(parse_files(vm_files, basename, shared_frames,
+        compact_conditionals))
+    optimized, hits = peephole.optimize(asm)
+    before = rom_words(asm)
+    after = rom_words(optimized)
+    percent = 100 * (before - after) / before if before else 0
+    return (f'{basename}: {before} words, {after} words after peephole '
+        f'({before - after} saved, {percent:.1f}%)\n'
+        f'{peephole.hits_report(hits)}')
+
+
+def folder_vm_files(folder):
+    # sorted so the output does not depend on the directory order
+    return [os.path.join(folder, n)
+        for n in sorted(os.listdir(folder))
+        if n.endswith('.vm') and not n.startswith('.')]
+
+
+def translate_folder(name, cache=None, shared_frames=False, optimize=False,
+        compact_conditionals=False, source_map=False, jobs=None, prune=False,
+        inline=0):
+    # jobs=None translates in this process, otherwise with translate_parallel
+    # and that many workers, 0 meaning one per cpu. Inlining needs the whole
+    # program, so it always translates in this process
     folder = os.path.join(script_dir, name)
     basename = os.path.basename(folder)
     out_file = os.path.join(folder, f'{basename}.asm')
+    vm_files = folder_vm_files(folder)
 
-    vm_files = (os.path.join(folder, n) 
-        for n in os.listdir(folder)
-        if n.endswith('.vm') and not n.startswith('.'))
-    
-    cmds = [InitCommand(SymbolFns(basename))]
-    for filename in vm_files:
-        with open(filename, 'r') as f:
-            cmds += list(Parser(f, basename).parse())
+    def build():
+        if jobs is None or source_map or inline:
+            translate_files(vm_files, basename, out_file, shared_frames,
+                optimize, compact_conditionals, source_map, prune, inline)
+        else:
+            translate_parallel(vm_files, basename, out_file, jobs or None,
+                shared_frames, optimize, compact_conditionals, prune)
 
-    with open(out_file, 'w') as f:    
-        f.write(translate(cmds))
+    # only the .asm goes in the cache, so mapped builds always translate
+    if cache is None or source_map:
+        build()
+        return
+
+    cache.build(vm_files, out_file, build,
+        tool_version(__file__), tool_version(peephole.__file__), basename,
+        shared_frames, optimize, compact_conditionals, jobs is not None,
+        prune, inline)
+    cache.evict()
 
 
 if __name__ == '__main__':
-    translate_folder('FunctionCalls/StaticsTest')
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(
+        description='Translate folders of .vm files to Hack assembly')
+    arg_parser.add_argument('folders', nargs='*',
+        default=['FunctionCalls/StaticsTest'],
+        help='folders relative to this script or absolute paths')
+    arg_parser.add_argument('--shared-frames', action='store_true',
+        help='call and return through shared $$CALL/$$RETURN routines')
+    arg_parser.add_argument('--report', action='store_true',
+        help='print ROM size with inline and shared call/return')
+    arg_parser.add_argument('-O', '--optimize', action='store_true',
+        help='run the peephole optimizer over the generated assembly')
+    arg_parser.add_argument('--compact-conditionals', action='store_true',
+        help='short eq/gt/lt code, fused with a following if-goto')
+    arg_parser.add_argument('--source-map', action='store_true',
+        help='also write a .asm.map of the VM command behind every line')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='translate the files in parallel with this many worker '
+            'processes, 0 for one per cpu')
+    arg_parser.add_argument('--prune', action='store_true',
+        help='leave out functions that Sys.init can never call')
+    arg_parser.add_argument('--inline', type=int, default=0, metavar='N',
+        help='inline leaf functions of up to N commands at their call sites')
+    args = arg_parser.parse_args()
+
+    for name in args.folders:
+        translate_folder(name, shared_frames=args.shared_frames,
+            optimize=args.optimize,
+            compact_conditionals=args.compact_conditionals,
+            source_map=args.source_map, jobs=args.jobs, prune=args.prune,
+            inline=args.inline)
+        if args.report:
+            folder = os.path.join(script_dir, name)
+            vm_files = folder_vm_files(folder)
+            basename = os.path.basename(folder)
+            print(frame_report(vm_files, basename))
+            print(conditional_report(vm_files, basename))
+            if args.prune:
+                print(prune_report(vm_files, basename))
+            if args.inline:
+                print(inline_report(vm_files, basename, args.inline,
+                    args.shared_frames))
+            if args.optimize:
+                print(optimize_report(vm_files, basename, args.shared_frames,
+                    args.compact_conditionals))
\ No newline at end of file
@@ -0,0 +1,285 @@
+import os
+import sys
+import time
+
+from translator import (ArithmeticCommand, CallCommand, FunctionCommand,
+    GotoCommand, IfGotoCommand, LabelCommand, PopCommand, PushCommand,
+    ReturnCommand, file_commands, folder_vm_files, script_dir)
+
+
+ram_size = 0x8000
+static_start = 0x10
+stack_start = 256
+
+# numbered roughly by how often compiled Jack code executes them, which is
+# also the order run() tests for them
+op_push_segment = 0
+op_push_const = 1
+op_pop_segment = 2
+op_push_fixed = 3
+op_pop_fixed = 4
+op_add = 5
+op_sub = 6
+op_if_goto = 7
+op_goto = 8
+op_call = 9
+op_function = 10
+op_return = 11
+op_eq = 12
+op_lt = 13
+op_gt = 14
+op_not = 15
+op_neg = 16
+op_and = 17
+op_or = 18
+op_halt = 19
+
+arithmetic_ops = {
+    'add': op_add,
+    'sub': op_sub,
+    'neg': op_neg,
+    'and': op_and,
+    'or': op_or,
+    'not': op_not,
+    'eq': op_eq,
+    'gt': op_gt,
+    'lt': op_lt
+}
+
+segment_pointers = {
+    'local': 1,
+    'argument': 2,
+    'this': 3,
+    'that': 4
+}
+
+
+def wrap16(value):
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+class VirtualMachine:
+    code = None
+    ram = None
+    pc = 0
+    steps = 0
+    statics = None
+    labels = None
+
+    def __init__(self, commands, bootstrap=True):
+        self.ram = [0] * ram_size
+        self.statics = {}
+        self.labels = {}
+        self.code = []
+        self.resolve(commands)
+        if bootstrap:
+            self.bootstrap()
+
+    def static_address(self, cmd):
+        # statics are named exactly as the translator names them, and get
+        # addresses in order of first use like assembler variables do
+        symbol = cmd.sym_fns.get('static')(cmd.arg2)[1:]
+        if symbol not in self.statics:
+            self.statics[symbol] = static_start + len(self.statics)
+        return self.statics[symbol]
+
+    def fixed_address(self, cmd):
+        if cmd.arg1 == 'temp':
+            return 5 + int(cmd.arg2)
+        if cmd.arg1 == 'pointer':
+            if int(cmd.arg2) >= 2:
+                raise Exception('Cannot have a pointer arg > 1')
+            return 3 + int(cmd.arg2)
+        if cmd.arg1 == 'static':
+            return self.static_address(cmd)
+        return None
+
+    def stack_op(self, cmd, segment_op, fixed_op):
+        if cmd.arg1 in segment_pointers:
+            return (segment_op, segment_pointers[cmd.arg1], int(cmd.arg2))
+        if (address := self.fixed_address(cmd)) is not None:
+            return (fixed_op, address)
+        raise Exception(f'invalid segment {cmd.arg1}')
+
+    def resolve_command(self, cmd):
+        # returns the opcode tuple for cmd, jump targets are still names
+        if isinstance(cmd, ArithmeticCommand):
+            return (arithmetic_ops[cmd.arg1],)
+        if isinstance(cmd, PushCommand):
+            if cmd.arg1 == 'constant':
+                return (op_push_const, int(cmd.arg2))
+            return self.stack_op(cmd, op_push_segment, op_push_fixed)
+        if isinstance(cmd, PopCommand):
+            return self.stack_op(cmd, op_pop_segment, op_pop_fixed)
+        if isinstance(cmd, GotoCommand):
+            return (op_goto, cmd.jump_label())
+        if isinstance(cmd, IfGotoCommand):
+            return (op_if_goto, cmd.jump_label())
+        if isinstance(cmd, FunctionCommand):
+            return (op_function, int(cmd.arg2))
+        if isinstance(cmd, CallCommand):
+            return (op_call, cmd.arg1, int(cmd.arg2))
+        if isinstance(cmd, ReturnCommand):
+            return (op_return,)
+        raise Exception(f'cannot interpret {type(cmd).__name__}')
+
+    def resolve(self, commands):
+        for cmd in commands:
+            if type(cmd) is LabelCommand:
+                self.labels[cmd.jump_label()] = len(self.code)
+                continue
+            if isinstance(cmd, FunctionCommand):
+                self.labels[cmd.arg1] = len(self.code)
+            self.code.append(self.resolve_command(cmd))
+        self.code.append((op_halt,))
+
+        for i, op in enumerate(self.code):
+            if op[0] in (op_goto, op_if_goto, op_call):
+                if op[1] not in self.labels:
+                    raise Exception(f'Unknown jump target {op[1]}')
+                self.code[i] = (op[0], self.labels[op[1]]) + op[2:]
+
+    def bootstrap(self):
+        # same as InitCommand: SP=256, call Sys.init
+        if 'Sys.init' not in self.labels:
+            raise Exception('Unknown jump target Sys.init')
+        self.ram[0] = stack_start
+        self.code.append((op_call, self.labels['Sys.init'], 0))
+        self.pc = len(self.code) - 1
+
+    def run(self, max_steps=None):
+        # runs until control leaves the code, e.g. by returning to an address
+        # that a test script put on the stack, or until max_steps commands
+        # have been executed. A goto to itself is the end of the program
+        code = self.code
+        ram = self.ram
+        pc = self.pc
+        end = len(code)
+        sp = ram[0]
+        limit = self.steps + max_steps if max_steps is not None else -1
+        steps = self.steps
+        if not 0 <= pc < end:
+            limit = steps
+
+        while steps != limit:
+            op = code[pc]
+            kind = op[0]
+            steps += 1
+            pc += 1
+
+            if kind == op_push_segment:
+                ram[sp] = ram[ram[op[1]] + op[2]]
+                sp += 1
+            elif kind == op_push_const:
+                ram[sp] = op[1]
+                sp += 1
+            elif kind == op_pop_segment:
+                sp -= 1
+                ram[ram[op[1]] + op[2]] = ram[sp]
+            elif kind == op_push_fixed:
+                ram[sp] = ram[op[1]]
+                sp += 1
+            elif kind == op_pop_fixed:
+                sp -= 1
+                ram[op[1]] = ram[sp]
+            elif kind == op_add:
+                sp -= 1
+                ram[sp - 1] = wrap16(ram[sp - 1] + ram[sp])
+            elif kind == op_sub:
+                sp -= 1
+                ram[sp - 1] = wrap16(ram[sp - 1] - ram[sp])
+            elif kind == op_if_goto:
+                sp -= 1
+                if ram[sp]:
+                    pc = op[1]
+            elif kind == op_goto:
+                if op[1] == pc - 1:
+                    pc -= 1
+                    break
+                pc = op[1]
+            elif kind == op_call:
+                ram[sp] = pc
+                ram[sp + 1] = ram[1]
+                ram[sp + 2] = ram[2]
+                ram[sp + 3] = ram[3]
+                ram[sp + 4] = ram[4]
+                sp += 5
+                ram[2] = sp - 5 - op[2]
+                ram[1] = sp
+                pc = op[1]
+            elif kind == op_function:
+                for _ in range(op[1]):
+                    ram[sp] = 0
+                    sp += 1
+            elif kind == op_return:
+                frame = ram[1]
+                pc = ram[frame - 5]
+                arg = ram[2]
+                ram[arg] = ram[sp - 1]
+                sp = arg + 1
+                ram[4] = ram[frame - 1]
+                ram[3] = ram[frame - 2]
+                ram[2] = ram[frame - 3]
+                ram[1] = ram[frame - 4]
+                if not 0 <= pc < end:
+                    break
+            elif kind == op_eq:
+                sp -= 1
+                ram[sp - 1] = -1 if ram[sp - 1] == ram[sp] else 0
+            elif kind == op_lt:
+                sp -= 1
+                ram[sp - 1] = -1 if ram[sp - 1] < ram[sp] else 0
+            elif kind == op_gt:
+                sp -= 1
+                ram[sp - 1] = -1 if ram[sp - 1] > ram[sp] else 0
+            elif kind == op_not:
+                ram[sp - 1] = ~ram[sp - 1]
+            elif kind == op_neg:
+                ram[sp - 1] = wrap16(-ram[sp - 1])
+            elif kind == op_and:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+            elif kind == op_or:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+            else:
+                # fell off the end of the code
+                steps -= 1
+                pc -= 1
+                break
+
+        ram[0] = sp
+        self.pc = pc
+        self.steps = steps
+        return steps
+
+
+def folder_commands(folder):
+    # parses the .vm files of a folder the same way translate_folder does
+    cmds = []
+    for filename in folder_vm_files(folder):
+        cmds += list(file_commands(filename))
+    return cmds
+
+
+def load_folder(name, bootstrap=True):
+    folder = os.path.join(script_dir, name)
+    return VirtualMachine(folder_commands(folder), bootstrap)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f'usage: {os.path.basename(__file__)} folder [steps]',
+            file=sys.stderr)
+        sys.exit(2)
+
+    vm = load_folder(sys.argv[1])
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    start = time.perf_counter()
+    vm.run(steps)
+    elapsed = time.perf_counter() - start
+
+    print(f'{vm.steps} VM commands in {elapsed:.3f} s '
+        f'({vm.steps / elapsed / 1e6:.2f} M commands/s)')
+    print(' '.join(f'RAM[{i}]={vm.ram[i]}' for i in range(16)))
+    print(' '.join(f'RAM[{i}]={vm.ram[i]}' for i in range(256, 272)))
@@ -1,6 +1,14 @@
+import argparse
+import glob
+import os
+import random
 import re
+import sys
+import time
 
 
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
 keywords = '''
 class
 constructor
@@ -25,12 +33,636 @@ while
 return
 '''.strip().split('\n')
 
+symbols = '{}()[].,;+-*/&|<>=~'
+
+keyword_pattern = re.compile(r'\b(?:' + '|'.join(keywords) + r')\b')
+comment_pattern = re.compile(r'(?:\/\*[\s\S]*?\*\/)|(?:\/\/.*$)', re.MULTILINE)
+
+# one alternation for the whole lexical grammar, the group that matched is
+# the token type. Keywords come before identifiers and must not run on into
+# a longer identifier
+token_pattern = re.compile('|'.join([
+    r'(?P<newline>\n)',
+    r'(?P<space>[ \t\r\f\v]+)',
+    r'(?P<comment>//[^\n]*|/\*[\s\S]*?\*/)',
+    r'(?P<integerConstant>[0-9]+)',
+    r'"(?P<stringConstant>[^"\n]*)"',
+    r'(?P<keyword>(?:' + '|'.join(keywords) + r')(?![A-Za-z0-9_]))',
+    r'(?P<identifier>[A-Za-z_][A-Za-z0-9_]*)',
+    r'(?P<symbol>[' + re.escape(symbols) + r'])',
+    r'(?P<error>.)'
+]))
+
+xml_escapes = {
+    '<': '&lt;',
+    '>': '&gt;',
+    '&': '&amp;',
+    '"': '&quot;'
+}
+
+# the reference .xml files have Windows line endings
+xml_newline = '\r\n'
+
+
 def match_keyword(token):
-    return re.match(f'\\b({")|(".join(keywords)})\\b', token)
+    return keyword_pattern.match(token)
 
 
 def remove_comments(text):
-    return re.sub(r'(?:\/\*[\s\S]*?\*\/)|(?:\/\/.*$)', '', text)
+    return comment_pattern.sub('', text)
+
+
+class Token:
+    kind = ''
+    value = ''
+    line = 0
+    column = 0
+    start = 0
+    end = 0
+
+    def __init__(self, kind, value, line, column, start=0, end=0):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.column = column
+        # offsets of the whole match in the source, quotes included
+        self.start = start
+        self.end = end
+
+    def xml(self):
+        value = ''.join(xml_escapes.get(c, c) for c in self.value)
+        return f'<{self.kind}> {value} </{self.kind}>'
+
+    def __repr__(self):
+        return f'Token({self.kind}, {self.value!r}, {self.line}:{self.column})'
+
+
+def tokenize(text, start=0, end=None):
+    # yields the tokens of text[start:end] one at a time with 1-based line
+    # and column in the whole text
+    line = text.count('\n', 0, start) + 1
+    line_start = text.rfind('\n', 0, start) + 1
+    end = len(text) if end is None else end
+    for match in token_pattern.finditer(text, start, end):
+        kind = match.lastgroup
+        if kind == 'newline':
+            line += 1
+            line_start = match.end()
+        elif kind == 'comment':
+            newlines = text.count('\n', match.start(), match.end())
+            if newlines:
+                line += newlines
+                line_start = text.rindex('\n', 0, match.end()) + 1
+        elif kind == 'error':
+            raise Exception(f'{line}:{match.start() - line_start + 1}: '
+                f'unexpected character {match.group()!r}')
+        elif kind != 'space':
+            yield Token(kind, match.group(kind), line,
+                match.start() - line_start + 1, match.start(), match.end())
+
+
+def tokenize_file(filename):
+    with open(filename, 'r') as f:
+        text = f.read()
+    return tokenize(text)
+
+
+def write_tokens(tokens, f):
+    f.write('<tokens>\n')
+    for token in tokens:
+        f.write(token.xml())
+        f.write('\n')
+    f.write('</tokens>\n')
+
+
+class CompilationEngine:
+    # recursive descent over the Jack grammar, writing the parse tree as
+    # XML lines while it goes
+    tokens = None
+    write = None
+    lookahead = None
+    depth = 0
+
+    def __init__(self, tokens, write):
+        self.tokens = iter(tokens)
+        self.write = write
+        self.lookahead = []
+        self.depth = 0
+
+    def peek(self, i=0):
+        while len(self.lookahead) <= i:
+            token = next(self.tokens, None)
+            if token is None:
+                return None
+            self.lookahead.append(token)
+        return self.lookahead[i]
+
+    def peek_value(self, i=0):
+        token = self.peek(i)
+        return token.value if token is not None else None
+
+    def error(self, expected):
+        token = self.peek()
+        if token is None:
+            raise Exception(f'expected {expected}, got end of file')
+        raise Exception(f'{token.line}:{token.column}: expected {expected}, '
+            f'got {token.value!r}')
+
+    def eat(self, values=None, kinds=None):
+        token = self.peek()
+        if token is None or (values is not None and token.value not in values) \
+                or (kinds is not None and token.kind not in kinds):
+            self.error(' or '.join(values or kinds))
+        self.lookahead.pop(0)
+        self.write('  ' * self.depth + token.xml())
+        return token
+
+    def open(self, tag):
+        self.write('  ' * self.depth + f'<{tag}>')
+        self.depth += 1
+
+    def close(self, tag):
+        self.depth -= 1
+        self.write('  ' * self.depth + f'</{tag}>')
+
+    def eat_type(self, extra=()):
+        if self.peek_value() in ('int', 'char', 'boolean') + extra:
+            return self.eat(kinds=['keyword'])
+        return self.eat(kinds=['identifier'])
+
+    def eat_names(self):
+        # varName (',' varName)* ';'
+        self.eat(kinds=['identifier'])
+        while self.peek_value() == ',':
+            self.eat([','])
+            self.eat(kinds=['identifier'])
+        self.eat([';'])
+
+    def compile_class(self):
+        self.open('class')
+        self.eat(['class'])
+        self.eat(kinds=['identifier'])
+        self.eat(['{'])
+        while self.peek_value() in ('static', 'field'):
+            self.compile_class_var_dec()
+        while self.peek_value() in ('constructor', 'function', 'method'):
+            self.compile_subroutine()
+        self.eat(['}'])
+        self.close('class')
+        if self.peek() is not None:
+            self.error('end of file')
+
+    def compile_class_var_dec(self):
+        self.open('classVarDec')
+        self.eat(['static', 'field'])
+        self.eat_type()
+        self.eat_names()
+        self.close('classVarDec')
+
+    def compile_subroutine(self):
+        self.open('subroutineDec')
+        self.eat(['constructor', 'function', 'method'])
+        self.eat_type(('void',))
+        self.eat(kinds=['identifier'])
+        self.eat(['('])
+        self.compile_parameter_list()
+        self.eat([')'])
+        self.compile_subroutine_body()
+        self.close('subroutineDec')
+
+    def compile_parameter_list(self):
+        self.open('parameterList')
+        if self.peek_value() != ')':
+            self.eat_type()
+            self.eat(kinds=['identifier'])
+            while self.peek_value() == ',':
+                self.eat([','])
+                self.eat_type()
+                self.eat(kinds=['identifier'])
+        self.close('parameterList')
+
+    def compile_subroutine_body(self):
+        self.open('subroutineBody')
+        self.eat(['{'])
+        while self.peek_value() == 'var':
+            self.compile_var_dec()
+        self.compile_statements()
+        self.eat(['}'])
+        self.close('subroutineBody')
+
+    def compile_var_dec(self):
+        self.open('varDec')
+        self.eat(['var'])
+        self.eat_type()
+        self.eat_names()
+        self.close('varDec')
+
+    def compile_statements(self):
+        statements = {
+            'let': self.compile_let,
+            'if': self.compile_if,
+            'while': self.compile_while,
+            'do': self.compile_do,
+            'return': self.compile_return
+        }
+        self.open('statements')
+        while self.peek_value() in statements:
+            statements[self.peek_value()]()
+        self.close('statements')
+
+    def compile_let(self):
+        self.open('letStatement')
+        self.eat(['let'])
+        self.eat(kinds=['identifier'])
+        if self.peek_value() == '[':
+            self.eat(['['])
+            self.compile_expression()
+            self.eat([']'])
+        self.eat(['='])
+        self.compile_expression()
+        self.eat([';'])
+        self.close('letStatement')
+
+    def compile_block(self):
+        # '{' statements '}'
+        self.eat(['{'])
+        self.compile_statements()
+        self.eat(['}'])
+
+    def compile_if(self):
+        self.open('ifStatement')
+        self.eat(['if'])
+        self.eat(['('])
+        self.compile_expression()
+        self.eat([')'])
+        self.compile_block()
+        if self.peek_value() == 'else':
+            self.eat(['else'])
+            self.compile_block()
+        self.close('ifStatement')
+
+    def compile_while(self):
+        self.open('whileStatement')
+        self.eat(['while'])
+        self.eat(['('])
+        self.compile_expression()
+        self.eat([')'])
+        self.compile_block()
+        self.close('whileStatement')
+
+    def compile_do(self):
+        self.open('doStatement')
+        self.eat(['do'])
+        self.compile_subroutine_call()
+        self.eat([';'])
+        self.close('doStatement')
+
+    def compile_return(self):
+        self.open('returnStatement')
+        self.eat(['return'])
+        if self.peek_value() != ';':
+            self.compile_expression()
+        self.eat([';'])
+        self.close('returnStatement')
+
+    def compile_subroutine_call(self):
+        self.eat(kinds=['identifier'])
+        if self.peek_value() == '.':
+            self.eat(['.'])
+            self.eat(kinds=['identifier'])
+        self.eat(['('])
+        self.compile_expression_list()
+        self.eat([')'])
+
+    def compile_expression(self):
+        self.open('expression')
+        self.compile_term()
+        while self.peek_value() in binary_ops:
+            self.eat(kinds=['symbol'])
+            self.compile_term()
+        self.close('expression')
+
+    def compile_term(self):
+        self.open('term')
+        token = self.peek()
+        if token is None:
+            self.error('a term')
+
+        if token.kind in ('integerConstant', 'stringConstant') \
+                or token.value in keyword_constants:
+            self.eat()
+        elif token.value == '(':
+            self.eat(['('])
+            self.compile_expression()
+            self.eat([')'])
+        elif token.value in unary_ops:
+            self.eat(kinds=['symbol'])
+            self.compile_term()
+        elif token.kind == 'identifier':
+            following = self.peek_value(1)
+            if following in ('(', '.'):
+                self.compile_subroutine_call()
+            else:
+                self.eat()
+                if following == '[':
+                    self.eat(['['])
+                    self.compile_expression()
+                    self.eat([']'])
+        else:
+            self.error('a term')
+        self.close('term')
+
+    def compile_expression_list(self):
+        self.open('expressionList')
+        if self.peek_value() != ')':
+            self.compile_expression()
+            while self.peek_value() == ',':
+                self.eat([','])
+                self.compile_expression()
+        self.close('expressionList')
+
+
+binary_ops = set('+-*/&|<>=')
+unary_ops = set('-~')
+keyword_constants = {'true', 'false', 'null', 'this'}
+
+
+def write_parse_tree(tokens, f):
+    CompilationEngine(tokens, lambda line: f.write(line + '\n')) \
+        .compile_class()
+
+
+subroutine_keywords = ('constructor', 'function', 'method')
+
+
+class Subroutine:
+    # a subroutineDec: where it is in the source and the lines it wrote
+    start = 0
+    end = 0
+    lines = None
+
+    def __init__(self, start, end, lines):
+        self.start = start
+        self.end = end
+        self.lines = lines
+
+
+class RecordingEngine(CompilationEngine):
+    # keeps the lines it writes and the extent of every subroutine
+    lines = None
+    subroutines = None
+    line_ranges = None
+    last_end = 0
+
+    def __init__(self, tokens, depth=0):
+        self.lines = []
+        super().__init__(tokens, self.lines.append)
+        self.depth = depth
+        self.subroutines = []
+        self.line_ranges = []
+        self.last_end = 0
+
+    def eat(self, values=None, kinds=None):
+        token = super().eat(values, kinds)
+        self.last_end = token.end
+        return token
+
+    def compile_subroutine(self):
+        start = self.peek().start
+        first = len(self.lines)
+        super().compile_subroutine()
+        self.line_ranges.append((first, len(self.lines)))
+        self.subroutines.append(
+            Subroutine(start, self.last_end, self.lines[first:]))
+
+    def compile_subroutines(self):
+        # a run of subroutines and nothing else, the unit of re-parsing
+        while self.peek_value() in subroutine_keywords:
+            self.compile_subroutine()
+        if self.peek() is not None:
+            self.error('a subroutine')
+
+
+class IncrementalParser:
+    # the parse tree of one class as the lines before, of and after each
+    # subroutine. An edit re-tokenizes and re-parses only the subroutines it
+    # touches, the boundaries between subroutines are where the parser
+    # resynchronizes with the unchanged tree
+    text = ''
+    header = None
+    subroutines = None
+    footer = None
+    valid = False
+    latencies = None
+
+    def __init__(self, text):
+        self.latencies = []
+        self.text = text
+        self.parse_all()
+
+    def parse_all(self):
+        self.valid = False
+        engine = RecordingEngine(tokenize(self.text))
+        engine.compile_class()
+        ranges = engine.line_ranges
+        self.header = engine.lines[:ranges[0][0]] if ranges else engine.lines
+        self.footer = engine.lines[ranges[-1][1]:] if ranges else []
+        self.subroutines = engine.subroutines
+        self.valid = True
+
+    def affected(self, start, end):
+        # indices of the first and last subroutine whose text an edit of
+        # the old text[start:end] can change, None if it reaches outside
+        subs = self.subroutines
+        if not subs or start < subs[0].start or end > subs[-1].end:
+            return None
+        first = next(i for i, sub in enumerate(subs) if sub.end >= start)
+        last = max(i for i, sub in enumerate(subs) if sub.start <= end)
+        # an edit between two subroutines belongs to both of them
+        first, last = min(first, last), max(first, last)
+        if subs[first].start > start:
+            first -= 1
+        if subs[last].end < end:
+            last += 1
+        return first, last
+
+    def reparse(self, start, end, delta):
+        span = self.affected(start, end)
+        if span is None:
+            return None
+        first, last = span
+        region_start = self.subroutines[first].start
+        region_end = self.subroutines[last].end + delta
+
+        engine = RecordingEngine(
+            tokenize(self.text, region_start, region_end), depth=1)
+        try:
+            engine.compile_subroutines()
+        except Exception:
+            # may be an edit that only makes sense with the text around it,
+            # like an unterminated comment, the full parse will tell
+            return None
+
+        for sub in self.subroutines[last + 1:]:
+            sub.start += delta
+            sub.end += delta
+        self.subroutines[first:last + 1] = engine.subroutines
+        return len(engine.subroutines)
+
+    def edit(self, start, end, new_text):
+        # replaces text[start:end], returns how many subroutines were
+        # parsed again
+        begin = time.perf_counter()
+        self.text = self.text[:start] + new_text + self.text[end:]
+        delta = len(new_text) - (end - start)
+
+        reparsed = self.reparse(start, end, delta) if self.valid else None
+        full = reparsed is None
+        if full:
+            self.parse_all()
+            reparsed = len(self.subroutines)
+
+        self.latencies.append((time.perf_counter() - begin, reparsed, full))
+        return reparsed
+
+    def lines(self):
+        yield from self.header
+        for sub in self.subroutines:
+            yield from sub.lines
+        yield from self.footer
+
+    def write(self, f):
+        for line in self.lines():
+            f.write(line + '\n')
+
+    def latency_report(self):
+        if not self.latencies:
+            return 'no edits'
+        times = sorted(t for t, _, _ in self.latencies)
+        full = sum(1 for _, _, f in self.latencies if f)
+        reparsed = sum(n for _, n, _ in self.latencies) / len(self.latencies)
+        median = times[len(times) // 2]
+        p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+        return (f'{len(times)} edits: median {median * 1000:.2f} ms, '
+            f'p95 {p95 * 1000:.2f} ms, max {times[-1] * 1000:.2f} ms, '
+            f'{reparsed:.1f} subroutines parsed per edit, '
+            f'{full} full parses')
+
+
+def edit_benchmark(filename, edits=200, copies=1, seed=0):
+    # a class made of copies of filename's subroutines, edited by inserting
+    # a space next to a space inside a random subroutine and removing it
+    with open(filename, 'r') as f:
+        text = f.read()
+    subs = IncrementalParser(text).subroutines
+    if not subs:
+        raise Exception(f'{filename} has no subroutines')
+    body = text[subs[0].start:subs[-1].end]
+    text = text[:subs[0].start] + '\n'.join([body] * copies) + \
+        text[subs[-1].end:]
+
+    start = time.perf_counter()
+    parser = IncrementalParser(text)
+    full_time = time.perf_counter() - start
+
+    rng = random.Random(seed)
+    for i in range(edits // 2):
+        sub = rng.choice(parser.subroutines)
+        spaces = [j for j in range(sub.start, sub.end)
+            if parser.text[j] == ' ']
+        if not spaces:
+            continue
+        j = rng.choice(spaces)
+        parser.edit(j, j, ' ')
+        parser.edit(j, j + 1, '')
+
+    lines = parser.text.count('\n') + 1
+    return (f'{lines} lines, {len(parser.subroutines)} subroutines, full '
+        f'parse {full_time * 1000:.1f} ms\n{parser.latency_report()}')
+
+
+def jack_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '*.jack')))
+        else:
+            files.append(path)
+    return files
+
+
+def output_files(filename, out_dir=None):
+    # XxxT.xml and Xxx.xml, by default in an out folder next to the source
+    # so the reference files are not overwritten
+    folder, name = os.path.split(filename)
+    out_dir = out_dir or os.path.join(folder, 'out')
+    name = os.path.splitext(name)[0]
+    return (os.path.join(out_dir, f'{name}T.xml'),
+        os.path.join(out_dir, f'{name}.xml'))
+
+
+def analyze_file(filename, out_dir=None, parse=True):
+    tokens_file, tree_file = output_files(filename, out_dir)
+    os.makedirs(os.path.dirname(tokens_file), exist_ok=True)
+    with open(tokens_file, 'w', newline=xml_newline) as f:
+        write_tokens(tokenize_file(filename), f)
+    if parse:
+        with open(tree_file, 'w', newline=xml_newline) as f:
+            write_parse_tree(tokenize_file(filename), f)
+    return tokens_file, tree_file
+
+
+def same_file(a, b):
+    with open(a, 'rb') as f, open(b, 'rb') as g:
+        return f.read() == g.read()
+
+
+def main(argv=None):
+    default_folders = ['ArrayTest', 'ExpressionLessSquare', 'Square']
+
+    arg_parser = argparse.ArgumentParser(
+        description='Tokenize and parse Jack files to XML')
+    arg_parser.add_argument('paths', nargs='*',
+        help='.jack files or folders of .jack files')
+    arg_parser.add_argument('-o', '--out-dir',
+        help='output folder (default: out/ next to each source file)')
+    arg_parser.add_argument('--tokens-only', action='store_true',
+        help='only write the XxxT.xml token files')
+    arg_parser.add_argument('--check', action='store_true',
+        help='compare the output with the XxxT.xml/Xxx.xml next to the source')
+    arg_parser.add_argument('--edit-bench', type=int, default=0, metavar='N',
+        help='time N incremental re-parses of each file instead')
+    arg_parser.add_argument('--copies', type=int, default=1,
+        help='repeat the subroutines this many times for --edit-bench')
+    args = arg_parser.parse_args(argv)
+
+    paths = args.paths or [os.path.join(script_dir, f) for f in default_folders]
+    files = jack_files(paths)
+
+    if args.edit_bench:
+        for filename in files:
+            print(f'{filename}: '
+                f'{edit_benchmark(filename, args.edit_bench, args.copies)}')
+        return 0
+
+    start = time.perf_counter()
+    tokens = sum(1 for filename in files for _ in tokenize_file(filename))
+    elapsed = time.perf_counter() - start
+    print(f'{tokens} tokens in {len(files)} files in {elapsed * 1000:.1f} ms')
+
+    failures = 0
+    for filename in files:
+        outputs = analyze_file(filename, args.out_dir, not args.tokens_only)
+        if not args.check:
+            continue
+        for out_file in outputs[:1 if args.tokens_only else 2]:
+            reference = os.path.join(os.path.dirname(filename),
+                os.path.basename(out_file))
+            ok = os.path.exists(reference) and same_file(out_file, reference)
+            failures += not ok
+            print(f'{"ok" if ok else "DIFF":<6} {out_file}')
+    return 1 if failures else 0
 
 
-print(match_keyword('class something'))
+if __name__ == '__main__':
+    sys.exit(main())
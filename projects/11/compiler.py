@@ -0,0 +1,579 @@
+import argparse
+import json
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(script_dir))
+sys.path.append(os.path.join(os.path.dirname(script_dir), '10'))
+
+from build_cache import BuildCache, default_cache_dir, tool_version
+import syntax_analyzer
+from syntax_analyzer import CompilationEngine, binary_ops, jack_files, \
+    subroutine_keywords, tokenize_file
+
+
+# the OS classes, only their declarations are used to check calls into them
+default_library = os.path.join(os.path.dirname(script_dir), '12')
+
+op_commands = {
+    '+': 'add',
+    '-': 'sub',
+    '&': 'and',
+    '|': 'or',
+    '<': 'lt',
+    '>': 'gt',
+    '=': 'eq',
+    '*': 'call Math.multiply 2',
+    '/': 'call Math.divide 2'
+}
+
+unary_commands = {
+    '-': 'neg',
+    '~': 'not'
+}
+
+kind_segments = {
+    'static': 'static',
+    'field': 'this',
+    'argument': 'argument',
+    'var': 'local'
+}
+
+
+def skip_block(engine):
+    # eats a '{' ... '}' without looking inside
+    engine.eat(['{'])
+    depth = 1
+    while depth:
+        if engine.peek() is None:
+            engine.error('}')
+        value = engine.eat().value
+        depth += (value == '{') - (value == '}')
+
+
+def class_interface(tokens):
+    # what other classes see of a class: its field count and the kind,
+    # return type and parameter count of every subroutine. Bodies are
+    # skipped, so this is much cheaper than compiling the class
+    engine = CompilationEngine(tokens, lambda line: None)
+    engine.eat(['class'])
+    name = engine.eat(kinds=['identifier']).value
+    engine.eat(['{'])
+
+    fields = 0
+    while engine.peek_value() in ('static', 'field'):
+        kind = engine.eat().value
+        engine.eat_type()
+        engine.eat(kinds=['identifier'])
+        count = 1
+        while engine.peek_value() == ',':
+            engine.eat([','])
+            engine.eat(kinds=['identifier'])
+            count += 1
+        engine.eat([';'])
+        if kind == 'field':
+            fields += count
+
+    subroutines = {}
+    while engine.peek_value() in subroutine_keywords:
+        kind = engine.eat().value
+        returns = engine.eat_type(('void',)).value
+        subroutine = engine.eat(kinds=['identifier']).value
+        engine.eat(['('])
+        params = 0
+        while engine.peek_value() != ')':
+            if params:
+                engine.eat([','])
+            engine.eat_type()
+            engine.eat(kinds=['identifier'])
+            params += 1
+        engine.eat([')'])
+        skip_block(engine)
+        subroutines[subroutine] = [kind, returns, params]
+    engine.eat(['}'])
+
+    return {'name': name, 'fields': fields, 'subroutines': subroutines}
+
+
+class SymbolTable:
+    # name -> (kind, type, index) for the class and the current subroutine
+    class_scope = None
+    subroutine_scope = None
+    counts = None
+
+    def __init__(self):
+        self.class_scope = {}
+        self.subroutine_scope = {}
+        self.counts = dict.fromkeys(kind_segments, 0)
+
+    def start_subroutine(self):
+        self.subroutine_scope = {}
+        self.counts['argument'] = 0
+        self.counts['var'] = 0
+
+    def define(self, name, type_name, kind):
+        scope = self.class_scope if kind in ('static', 'field') \
+            else self.subroutine_scope
+        scope[name] = (kind, type_name, self.counts[kind])
+        self.counts[kind] += 1
+
+    def lookup(self, name):
+        return self.subroutine_scope.get(name) or self.class_scope.get(name)
+
+
+class JackCompiler(CompilationEngine):
+    # the parser of project 10 with every grammar rule emitting VM commands
+    # instead of XML. Calls are checked against the interfaces of the
+    # classes they go to, when those are known
+    interfaces = None
+    symbols = None
+    class_name = ''
+    subroutine_kind = ''
+    labels = 0
+
+    def __init__(self, tokens, write, interfaces=None):
+        super().__init__(tokens, write)
+        self.interfaces = interfaces or {}
+        self.symbols = SymbolTable()
+        self.class_name = ''
+        self.subroutine_kind = ''
+        self.labels = 0
+
+    def eat(self, values=None, kinds=None):
+        token = self.peek()
+        if token is None or (values is not None and token.value not in values) \
+                or (kinds is not None and token.kind not in kinds):
+            self.error(' or '.join(values or kinds or ['a token']))
+        self.lookahead.pop(0)
+        return token
+
+    def fail(self, token, message):
+        raise Exception(f'{token.line}:{token.column}: {message}')
+
+    def label(self, name):
+        self.labels += 1
+        return f'{name}{self.labels - 1}'
+
+    def push_variable(self, token, command='push'):
+        symbol = self.symbols.lookup(token.value)
+        if symbol is None:
+            self.fail(token, f'undefined variable {token.value!r}')
+        kind, _, index = symbol
+        if kind == 'field' and self.subroutine_kind == 'function':
+            self.fail(token, f'field {token.value!r} used in a function')
+        self.write(f'{command} {kind_segments[kind]} {index}')
+
+    def compile_class(self):
+        self.eat(['class'])
+        self.class_name = self.eat(kinds=['identifier']).value
+        self.eat(['{'])
+        while self.peek_value() in ('static', 'field'):
+            self.compile_class_var_dec()
+        while self.peek_value() in subroutine_keywords:
+            self.compile_subroutine()
+        self.eat(['}'])
+        if self.peek() is not None:
+            self.error('end of file')
+
+    def define_names(self, kind):
+        # type varName (',' varName)* ';'
+        type_name = self.eat_type().value
+        self.symbols.define(self.eat(kinds=['identifier']).value,
+            type_name, kind)
+        while self.peek_value() == ',':
+            self.eat([','])
+            self.symbols.define(self.eat(kinds=['identifier']).value,
+                type_name, kind)
+        self.eat([';'])
+
+    def compile_class_var_dec(self):
+        self.define_names(self.eat(['static', 'field']).value)
+
+    def compile_subroutine(self):
+        self.symbols.start_subroutine()
+        self.labels = 0
+        self.subroutine_kind = self.eat(subroutine_keywords).value
+        self.eat_type(('void',))
+        name = self.eat(kinds=['identifier']).value
+        if self.subroutine_kind == 'method':
+            self.symbols.define('this', self.class_name, 'argument')
+        self.eat(['('])
+        self.compile_parameter_list()
+        self.eat([')'])
+
+        self.eat(['{'])
+        while self.peek_value() == 'var':
+            self.compile_var_dec()
+        self.write(f'function {self.class_name}.{name} '
+            f'{self.symbols.counts["var"]}')
+        if self.subroutine_kind == 'constructor':
+            self.write(f'push constant {self.symbols.counts["field"]}')
+            self.write('call Memory.alloc 1')
+            self.write('pop pointer 0')
+        elif self.subroutine_kind == 'method':
+            self.write('push argument 0')
+            self.write('pop pointer 0')
+        self.compile_statements()
+        self.eat(['}'])
+
+    def compile_parameter_list(self):
+        while self.peek_value() != ')':
+            if self.symbols.counts['argument'] > \
+                    (self.subroutine_kind == 'method'):
+                self.eat([','])
+            type_name = self.eat_type().value
+            self.symbols.define(self.eat(kinds=['identifier']).value,
+                type_name, 'argument')
+
+    def compile_var_dec(self):
+        self.eat(['var'])
+        self.define_names('var')
+
+    def compile_statements(self):
+        statements = {
+            'let': self.compile_let,
+            'if': self.compile_if,
+            'while': self.compile_while,
+            'do': self.compile_do,
+            'return': self.compile_return
+        }
+        while self.peek_value() in statements:
+            statements[self.peek_value()]()
+
+    def compile_let(self):
+        self.eat(['let'])
+        target = self.eat(kinds=['identifier'])
+        if self.peek_value() == '[':
+            self.push_variable(target)
+            self.eat(['['])
+            self.compile_expression()
+            self.eat([']'])
+            self.write('add')
+            self.eat(['='])
+            self.compile_expression()
+            # the value goes through temp 0, the right side may use that
+            self.write('pop temp 0')
+            self.write('pop pointer 1')
+            self.write('push temp 0')
+            self.write('pop that 0')
+        else:
+            self.eat(['='])
+            self.compile_expression()
+            self.push_variable(target, 'pop')
+        self.eat([';'])
+
+    def compile_block(self):
+        self.eat(['{'])
+        self.compile_statements()
+        self.eat(['}'])
+
+    def compile_if(self):
+        else_label = self.label('IF_ELSE')
+        end_label = self.label('IF_END')
+        self.eat(['if'])
+        self.eat(['('])
+        self.compile_expression()
+        self.eat([')'])
+        self.write('not')
+        self.write(f'if-goto {else_label}')
+        self.compile_block()
+        if self.peek_value() == 'else':
+            self.eat(['else'])
+            self.write(f'goto {end_label}')
+            self.write(f'label {else_label}')
+            self.compile_block()
+            self.write(f'label {end_label}')
+        else:
+            self.write(f'label {else_label}')
+
+    def compile_while(self):
+        loop_label = self.label('WHILE_EXP')
+        end_label = self.label('WHILE_END')
+        self.write(f'label {loop_label}')
+        self.eat(['while'])
+        self.eat(['('])
+        self.compile_expression()
+        self.eat([')'])
+        self.write('not')
+        self.write(f'if-goto {end_label}')
+        self.compile_block()
+        self.write(f'goto {loop_label}')
+        self.write(f'label {end_label}')
+
+    def compile_do(self):
+        self.eat(['do'])
+        self.compile_subroutine_call()
+        self.eat([';'])
+        self.write('pop temp 0')
+
+    def compile_return(self):
+        self.eat(['return'])
+        if self.peek_value() != ';':
+            self.compile_expression()
+        else:
+            self.write('push constant 0')
+        self.eat([';'])
+        self.write('return')
+
+    def check_call(self, token, class_name, name, args, method):
+        # None when class_name is not a known class
+        interface = self.interfaces.get(class_name)
+        if interface is None:
+            return None
+        signature = interface['subroutines'].get(name)
+        if signature is None:
+            self.fail(token, f'{class_name} has no subroutine {name!r}')
+        kind, _, params = signature
+        if method is not None and method != (kind == 'method'):
+            self.fail(token, f'{class_name}.{name} is a {kind}')
+        if args != params:
+            self.fail(token, f'{class_name}.{name} takes {params} '
+                f'arguments, got {args}')
+        return kind
+
+    def compile_subroutine_call(self):
+        token = self.eat(kinds=['identifier'])
+        if self.peek_value() == '.':
+            self.eat(['.'])
+            name = self.eat(kinds=['identifier']).value
+            symbol = self.symbols.lookup(token.value)
+            if symbol is not None:
+                # a method of the object in the variable
+                self.push_variable(token)
+                class_name = symbol[1]
+                method = True
+            else:
+                class_name = token.value
+                method = False
+        else:
+            # subroutineName(...) is a method of this, unless this class
+            # declares it a function
+            name = token.value
+            class_name = self.class_name
+            kind = self.interfaces.get(class_name, {}) \
+                .get('subroutines', {}).get(name, ['method'])[0]
+            method = kind == 'method'
+            if method:
+                if self.subroutine_kind == 'function':
+                    self.fail(token, f'method {name!r} called from a function')
+                self.write('push pointer 0')
+
+        self.eat(['('])
+        args = self.compile_expression_list()
+        self.eat([')'])
+        self.check_call(token, class_name, name, args, method)
+        self.write(f'call {class_name}.{name} {args + method}')
+
+    def compile_expression(self):
+        self.compile_term()
+        while self.peek_value() in binary_ops:
+            op = self.eat(kinds=['symbol']).value
+            self.compile_term()
+            self.write(op_commands[op])
+
+    def compile_term(self):
+        token = self.peek()
+        if token is None:
+            self.error('a term')
+
+        if token.kind == 'integerConstant':
+            self.eat()
+            if int(token.value) > 32767:
+                self.fail(token, f'integer constant {token.value} too large')
+            self.write(f'push constant {token.value}')
+        elif token.kind == 'stringConstant':
+            self.eat()
+            self.write(f'push constant {len(token.value)}')
+            self.write('call String.new 1')
+            for c in token.value:
+                self.write(f'push constant {ord(c)}')
+                self.write('call String.appendChar 2')
+        elif token.value in ('true', 'false', 'null'):
+            self.eat()
+            self.write('push constant 0')
+            if token.value == 'true':
+                self.write('not')
+        elif token.value == 'this':
+            self.eat()
+            if self.subroutine_kind == 'function':
+                self.fail(token, "'this' used in a function")
+            self.write('push pointer 0')
+        elif token.value == '(':
+            self.eat(['('])
+            self.compile_expression()
+            self.eat([')'])
+        elif token.value in unary_commands and token.kind == 'symbol':
+            self.eat(kinds=['symbol'])
+            self.compile_term()
+            self.write(unary_commands[token.value])
+        elif token.kind == 'identifier':
+            following = self.peek_value(1)
+            if following in ('(', '.'):
+                self.compile_subroutine_call()
+            else:
+                self.eat()
+                self.push_variable(token)
+                if following == '[':
+                    self.eat(['['])
+                    self.compile_expression()
+                    self.eat([']'])
+                    self.write('add')
+                    self.write('pop pointer 1')
+                    self.write('push that 0')
+        else:
+            self.error('a term')
+
+    def compile_expression_list(self):
+        # returns the number of expressions
+        count = 0
+        if self.peek_value() != ')':
+            self.compile_expression()
+            count += 1
+            while self.peek_value() == ',':
+                self.eat([','])
+                self.compile_expression()
+                count += 1
+        return count
+
+
+def vm_file(filename, out_dir=None):
+    folder, name = os.path.split(filename)
+    return os.path.join(out_dir or folder,
+        f'{os.path.splitext(name)[0]}.vm')
+
+
+def compile_file(filename, out_file, interfaces=None):
+    lines = []
+    try:
+        JackCompiler(tokenize_file(filename), lines.append, interfaces) \
+            .compile_class()
+    except Exception as e:
+        raise Exception(f'{filename}:{e}') from e
+    with open(out_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return out_file
+
+
+def tool_versions():
+    return tool_version(__file__), tool_version(syntax_analyzer.__file__)
+
+
+def cached_interface(filename, cache=None):
+    # a class's interface only changes with its file, so it is cached by
+    # the file's hash and nothing else
+    if cache is None:
+        return class_interface(tokenize_file(filename))
+    key = cache.key([filename], *tool_versions(), 'interface')
+    data = cache.load(key)
+    if data is not None:
+        return json.loads(data)
+    interface = class_interface(tokenize_file(filename))
+    cache.save(key, json.dumps(interface).encode())
+    return interface
+
+
+def program_interfaces(files, library=default_library, cache=None):
+    # the program's classes take precedence over library classes of the
+    # same name
+    interfaces = {}
+    library_files = jack_files([library]) if library else []
+    for filename in library_files + files:
+        try:
+            interface = cached_interface(filename, cache)
+        except Exception as e:
+            raise Exception(f'{filename}:{e}') from e
+        interfaces[interface['name']] = interface
+    return interfaces
+
+
+def compile_program(files, out_dir=None, jobs=None, cache=None,
+        library=default_library):
+    # compiles every class to its .vm, with jobs=None in this process and
+    # otherwise in that many workers, 0 meaning one per cpu. A class is
+    # compiled again only when its file or some interface changed, so an
+    # edit that keeps the signatures recompiles just the edited class.
+    # Returns the .vm files compiled and the ones taken from the cache
+    interfaces = program_interfaces(files, library, cache)
+    interfaces_hash = hashlib.sha256(
+        json.dumps(interfaces, sort_keys=True).encode()).hexdigest()
+
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    todo = []
+    cached = []
+    keys = {}
+    for filename in files:
+        out_file = vm_file(filename, out_dir)
+        if cache is not None:
+            keys[out_file] = cache.key([filename], *tool_versions(),
+                interfaces_hash)
+            if cache.fetch(keys[out_file], out_file):
+                cached.append(out_file)
+                continue
+        todo.append((filename, out_file))
+
+    sources = [filename for filename, _ in todo]
+    out_files = [out_file for _, out_file in todo]
+    if jobs is None or len(todo) < 2:
+        compiled = list(map(compile_file, sources, out_files,
+            repeat(interfaces)))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+            compiled = list(executor.map(compile_file, sources, out_files,
+                repeat(interfaces)))
+
+    if cache is not None:
+        for out_file in compiled:
+            cache.store(keys[out_file], out_file)
+        cache.evict()
+    return compiled, cached
+
+
+def main(argv=None):
+    default_folders = ['Seven', 'ConvertToBin', 'Square', 'Average', 'Pong',
+        'ComplexArrays']
+
+    arg_parser = argparse.ArgumentParser(
+        description='Compile Jack programs to .vm files')
+    arg_parser.add_argument('paths', nargs='*',
+        help='program folders or .jack files, each compiled as one program')
+    arg_parser.add_argument('-o', '--out-dir',
+        help='output folder (default: next to each source file)')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='compile the classes with this many worker processes, 0 for '
+            'one per cpu')
+    arg_parser.add_argument('--library', default=default_library,
+        help='folder of OS classes whose declarations calls are checked '
+            'against (default: %(default)s)')
+    arg_parser.add_argument('--cache', action='store_true',
+        help='reuse .vm files and class interfaces of unchanged classes')
+    arg_parser.add_argument('--cache-dir', default=default_cache_dir(),
+        help='build cache directory (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+    cache = BuildCache(args.cache_dir) if args.cache else None
+
+    paths = args.paths or [os.path.join(script_dir, f) for f in default_folders]
+    failures = 0
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            compiled, cached = compile_program(jack_files([path]),
+                args.out_dir, args.jobs, cache, args.library)
+        except Exception as e:
+            failures += 1
+            print(f'FAIL   {path}: {e}')
+            continue
+        elapsed = time.perf_counter() - start
+        print(f'ok     {path}: {len(compiled)} compiled, {len(cached)} '
+            f'cached ({elapsed * 1000:.1f} ms)')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+
+def default_cache_dir():
+    return os.environ.get('N2T_CACHE_DIR') or \
+        os.path.join(os.path.expanduser('~'), '.cache', 'nand2tetris')
+
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tool_version(tool_file):
+    # hashing the tool source means any change to it invalidates the cache
+    return file_hash(os.path.realpath(tool_file))
+
+
+class BuildCache:
+    cache_dir = ''
+    max_bytes = 0
+    max_age = 0
+
+    def __init__(self, cache_dir=None, max_bytes=256 << 20,
+            max_age=30 * 24 * 60 * 60):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, input_files, *options):
+        h = hashlib.sha256()
+        for option in options:
+            h.update(f'{option}\0'.encode())
+        for filename in input_files:
+            h.update(f'{os.path.basename(filename)}\0'.encode())
+            h.update(file_hash(filename).encode())
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, out_file):
+        entry = self.entry_path(key)
+        if not os.path.exists(entry):
+            return False
+
+        shutil.copyfile(entry, out_file)
+        # mtime doubles as last use time for eviction
+        os.utime(entry)
+        return True
+
+    def store(self, key, out_file):
+        entry = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry))
+        os.close(fd)
+        shutil.copyfile(out_file, tmp)
+        os.replace(tmp, entry)
+
+    def load(self, key):
+        # the cached data itself, for entries that are not output files
+        entry = self.entry_path(key)
+        try:
+            with open(entry, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(entry)
+        return data
+
+    def save(self, key, data):
+        entry = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, entry)
+
+    def build(self, input_files, out_file, build_fn, *options):
+        key = self.key(input_files, *options)
+        if self.fetch(key, out_file):
+            return True
+
+        build_fn()
+        self.store(key, out_file)
+        return False
+
+    def entries(self):
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for path, mtime, size in self.entries():
+            if now - mtime > self.max_age:
+                self.remove(path)
+            else:
+                entries.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
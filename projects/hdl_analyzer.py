@@ -0,0 +1,332 @@
+import argparse
+import os
+import sys
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(script_dir)
+
+from hdl_simulator import ChipDef, Library, Netlist
+
+
+# Static timing in Nand gate delays. Every chip gets a model of its pins
+# built from its parts' models, so a RAM16K is analyzed from one RAM4K
+# model instead of flattening a million gates:
+#   arcs     output bit -> input bit -> longest combinational path
+#   launch   output bit -> longest path from a DFF or clocked builtin
+#   capture  input bit -> longest path into a DFF or clocked builtin
+#   internal longest path from one DFF to another inside the chip
+# Each path is (delay, parts it goes through at that chip's level).
+# Builtin chips count as zero delay. sinks keeps the longest path into
+# each of the chip's parts with registers, only for reporting.
+
+
+class TimingModel:
+    name = ''
+    nands = 0
+    dffs = 0
+    builtins = None
+    arcs = None
+    launch = None
+    capture = None
+    internal = None
+    sinks = None
+
+    def __init__(self, name):
+        self.name = name
+        self.builtins = {}
+        self.arcs = {}
+        self.launch = {}
+        self.capture = {}
+        self.internal = None
+        self.sinks = {}
+
+    def paths(self):
+        # every path through the chip as (delay, source, parts, sink),
+        # source and sink being pin bits or None for a register
+        for out, arcs in self.arcs.items():
+            for source, (delay, parts) in arcs.items():
+                yield delay, source, parts, out
+        for out, (delay, parts) in self.launch.items():
+            yield delay, None, parts, out
+        for source, (delay, parts) in self.capture.items():
+            yield delay, source, parts, None
+        if self.internal is not None:
+            yield self.internal[0], None, self.internal[1], None
+
+    def critical_path(self):
+        return max(self.paths(), key=lambda path: path[0], default=None)
+
+    def depth(self):
+        path = self.critical_path()
+        return path[0] if path is not None else 0
+
+
+def longer(a, b):
+    return b if a is None or b[0] > a[0] else a
+
+
+def primitive_model(name):
+    model = TimingModel(name)
+    if name == 'Nand':
+        model.nands = 1
+        model.arcs[('out', 0)] = {('a', 0): (1, ()), ('b', 0): (1, ())}
+    else:
+        model.dffs = 1
+        model.launch[('out', 0)] = (0, ())
+        model.capture[('in', 0)] = (0, ())
+    return model
+
+
+def builtin_model(builtin):
+    model = TimingModel(builtin.__name__)
+    model.builtins[builtin.__name__] = 1
+    inputs = dict(builtin.inputs)
+    comb_bits = [(pin, bit) for pin in builtin.comb_inputs
+        for bit in range(inputs[pin])]
+    for pin, width in builtin.outputs:
+        for bit in range(width):
+            model.arcs[(pin, bit)] = {source: (0, ()) for source in comb_bits}
+            if builtin.clocked or not builtin.comb_inputs:
+                model.launch[(pin, bit)] = (0, ())
+    if builtin.clocked:
+        for pin, width in builtin.inputs:
+            for bit in range(width):
+                model.capture[(pin, bit)] = (0, ())
+    return model
+
+
+class PartsNetlist(Netlist):
+    # wires up one chip's parts without going inside them
+    boxes = None
+
+    def __init__(self, library):
+        super().__init__(library)
+        self.boxes = []
+
+    def instantiate(self, resolved, pins, name=''):
+        self.boxes.append((resolved, pins, name))
+
+
+class PreferLibrary(Library):
+    # looks in the preferred folders before the chip's own one, to try
+    # other versions of some parts in a design
+    prefer = None
+
+    def __init__(self, prefer=(), path=None, structural=True):
+        super().__init__(path, structural)
+        self.prefer = list(prefer)
+
+    def search(self, name, folder):
+        filename = self.find(name, self.prefer)
+        if filename is not None and self.load(filename).parts is not None:
+            return self.load(filename)
+        return super().search(name, folder)
+
+
+class Analyzer:
+    library = None
+    models = None
+
+    def __init__(self, library=None):
+        self.library = library or Library(structural=True)
+        self.models = {}
+
+    def model(self, resolved):
+        if isinstance(resolved, str):
+            key = resolved
+        elif isinstance(resolved, ChipDef):
+            key = resolved.filename
+        else:
+            key = resolved.__name__
+        if key not in self.models:
+            if isinstance(resolved, str):
+                self.models[key] = primitive_model(resolved)
+            elif isinstance(resolved, ChipDef):
+                self.models[key] = self.chip_model(resolved)
+            else:
+                self.models[key] = builtin_model(resolved)
+        return self.models[key]
+
+    def analyze(self, filename):
+        chip = self.library.load(os.path.realpath(filename))
+        if chip.parts is None:
+            raise Exception(f'{filename} is a builtin chip')
+        return self.model(chip)
+
+    def chip_model(self, chip):
+        netlist = PartsNetlist(self.library)
+        pins = {name: netlist.new_nets(width)
+            for name, width in chip.inputs + chip.outputs}
+        netlist.instantiate_chip(chip, pins)
+        find = netlist.find
+
+        model = TimingModel(chip.name)
+        sources = {}
+        for name, _ in chip.inputs:
+            for bit, net in enumerate(pins[name]):
+                sources[find(net)] = (name, bit)
+
+        boxes = []
+        drivers = {}
+        for resolved, part_pins, name in netlist.boxes:
+            part = self.model(resolved)
+            model.nands += part.nands
+            model.dffs += part.dffs
+            for builtin, n in part.builtins.items():
+                model.builtins[builtin] = model.builtins.get(builtin, 0) + n
+            box = (part, {pin: [find(net) for net in nets]
+                for pin, nets in part_pins.items()}, name)
+            boxes.append(box)
+            for pin, width in resolved_outputs(resolved):
+                for bit, net in enumerate(box[1][pin]):
+                    drivers[net] = (box, (pin, bit))
+
+        # longest path to each net, per chip input bit or None for paths
+        # starting at a register
+        arrivals = {}
+
+        def arrival(net):
+            if net in arrivals:
+                return arrivals[net]
+            result = {}
+            if net in sources:
+                result[sources[net]] = (0, ())
+            if net in drivers:
+                (part, part_pins, name), out = drivers[net]
+                for (pin, bit), (delay, _) in part.arcs.get(out, {}).items():
+                    for source, (t, parts) in arrival(part_pins[pin][bit]).items():
+                        result[source] = longer(result.get(source),
+                            (t + delay, parts + (name,)))
+                if out in part.launch:
+                    result[None] = longer(result.get(None),
+                        (part.launch[out][0], (name,)))
+            arrivals[net] = result
+            return result
+
+        for name, _ in chip.outputs:
+            for bit, net in enumerate(pins[name]):
+                for source, path in arrival(find(net)).items():
+                    if source is None:
+                        model.launch[(name, bit)] = path
+                    else:
+                        model.arcs.setdefault((name, bit), {})[source] = path
+
+        for part, part_pins, name in boxes:
+            for (pin, bit), (delay, _) in part.capture.items():
+                for source, (t, parts) in arrival(part_pins[pin][bit]).items():
+                    path = (t + delay, parts + (name,))
+                    if name not in model.sinks or path[0] > model.sinks[name][0]:
+                        model.sinks[name] = (path[0], source, path[1], None)
+                    if source is None:
+                        model.internal = longer(model.internal, path)
+                    else:
+                        model.capture[source] = longer(
+                            model.capture.get(source), path)
+            if part.internal is not None:
+                path = (part.internal[0], (name,))
+                model.internal = longer(model.internal, path)
+                if name not in model.sinks or path[0] > model.sinks[name][0]:
+                    model.sinks[name] = (path[0], None, path[1], None)
+        return model
+
+
+def resolved_outputs(resolved):
+    if isinstance(resolved, str):
+        return [('out', 1)]
+    if isinstance(resolved, ChipDef):
+        return resolved.outputs
+    return list(resolved.outputs)
+
+
+def pin_label(pin_bit, widths):
+    pin, bit = pin_bit
+    return pin if widths.get(pin) == 1 else f'{pin}[{bit}]'
+
+
+def path_text(path, widths):
+    # 'x[0] -> FullAdder x15 -> out[15]', repeated parts counted
+    delay, source, parts, sink = path
+    steps = [pin_label(source, widths)] if source is not None else []
+    previous, count = None, 0
+    for part in parts + (None,):
+        if part == previous:
+            count += 1
+            continue
+        if previous is not None:
+            steps.append(previous if count == 1 else f'{previous} x{count}')
+        previous, count = part, 1
+    if sink is not None:
+        steps.append(pin_label(sink, widths))
+    return ' -> '.join(steps)
+
+
+def hdl_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for folder, dirs, names in os.walk(path):
+            dirs.sort()
+            files += [os.path.join(folder, name) for name in sorted(names)
+                if name.endswith('.hdl')]
+    return files
+
+
+def report(analyzer, filename, verbose=False):
+    model = analyzer.analyze(filename)
+    chip = analyzer.library.load(os.path.realpath(filename))
+    widths = dict(chip.inputs + chip.outputs)
+    counts = f'{model.nands} Nands, {model.dffs} DFFs'
+    if model.builtins:
+        counts += ', ' + ', '.join(f'{n} {name}'
+            for name, n in sorted(model.builtins.items()))
+    lines = [f'{chip.name}: {counts}, depth {model.depth()}']
+    path = model.critical_path()
+    if path is not None:
+        lines.append(f'  critical path: {path_text(path, widths)}')
+    if verbose:
+        # the worst path ending at each output pin and at each part with
+        # registers in it
+        worst = {}
+        for path in model.paths():
+            sink = path[3]
+            if sink is not None and (sink[0] not in worst or
+                    path[0] > worst[sink[0]][0]):
+                worst[sink[0]] = path
+        worst.update(model.sinks)
+        for sink, path in worst.items():
+            lines.append(f'  {sink}: {path[0]}: {path_text(path, widths)}')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description='Count the Nand gates of .hdl chips and find their '
+            'longest paths in Nand delays')
+    arg_parser.add_argument('paths', nargs='*', default=[script_dir],
+        help='.hdl files or folders to search for them (default: all '
+            'projects)')
+    arg_parser.add_argument('--prefer', action='append', default=[],
+        metavar='DIR', help='take parts from DIR before the chip\'s own '
+            'folder, e.g. generated alternatives')
+    arg_parser.add_argument('-v', '--verbose', action='store_true',
+        help='show the worst path to each output and into the registers')
+    args = arg_parser.parse_args(argv)
+
+    analyzer = Analyzer(PreferLibrary(args.prefer))
+    status = 0
+    for filename in hdl_files(args.paths):
+        try:
+            print(report(analyzer, filename, args.verbose))
+        except Exception as e:
+            if 'builtin chip' in str(e):
+                continue
+            print(f'{os.path.relpath(filename)}: {e}', file=sys.stderr)
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
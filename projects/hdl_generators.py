@@ -0,0 +1,333 @@
+import argparse
+import heapq
+import os
+import random
+import sys
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(script_dir)
+
+from hdl_simulator import (Library, exhaustive_lanes, load_chip,
+    max_exhaustive_bits, random_lanes, verify_chip)
+
+
+# Generators of HDL written straight in Nand gates, laid out for the least
+# gate delay rather than from the smaller chips. Each keeps both polarities
+# of a signal where one saves a gate level, e.g. the 2 way mux is
+# Nand(Nand(a, Not(sel)), Nand(b, sel)): 2 Nands from the data, 3 from sel,
+# where Or(And(a, Not(sel)), And(b, sel)) takes 4 and 5.
+
+prefix_networks = ('ripple', 'sklansky', 'kogge-stone')
+
+letters = 'abcdefghijklmnopqrstuvwxyz'
+
+
+class HdlBuilder:
+    # a Nand netlist that shares equal gates and knows each wire's depth
+    gates = None
+    depth = None
+    seen = None
+
+    def __init__(self):
+        self.gates = {}
+        self.depth = {}
+        self.seen = {}
+
+    def nand(self, a, b):
+        key = (a, b) if a <= b else (b, a)
+        if key not in self.seen:
+            wire = f'w{len(self.gates)}'
+            self.gates[wire] = key
+            self.depth[wire] = max(self.depth.get(a, 0),
+                self.depth.get(b, 0)) + 1
+            self.seen[key] = wire
+        return self.seen[key]
+
+    def not_(self, a):
+        return self.nand(a, a)
+
+    def and_(self, a, b):
+        return self.not_(self.nand(a, b))
+
+    def xor(self, a, b):
+        both = self.nand(a, b)
+        return self.nand(self.nand(a, both), self.nand(b, both))
+
+    def mux(self, a, b, sel, nsel):
+        return self.nand(self.nand(a, nsel), self.nand(b, sel))
+
+    def and_all(self, wires):
+        # the two earliest wires first, which gives the shallowest tree
+        heap = [(self.depth.get(w, 0), w) for w in wires]
+        heapq.heapify(heap)
+        while len(heap) > 1:
+            _, a = heapq.heappop(heap)
+            _, b = heapq.heappop(heap)
+            w = self.and_(a, b)
+            heapq.heappush(heap, (self.depth[w], w))
+        return heap[0][1]
+
+    def chip(self, name, inputs, outputs, wires, description):
+        # HDL text with the gates the outputs need. inputs and outputs are
+        # (pin, width) lists, wires maps each output bit like 'out[3]' to
+        # the wire it is
+        needed = set()
+        todo = list(wires.values())
+        while todo:
+            wire = todo.pop()
+            if wire in needed or wire not in self.gates:
+                continue
+            needed.add(wire)
+            todo += self.gates[wire]
+        used = {w for wire in needed for w in self.gates[wire]}
+
+        pins = {}
+        for pin, wire in wires.items():
+            if wire not in self.gates:
+                raise Exception(f'{name}: {pin} is not driven by a gate')
+            pins.setdefault(wire, []).append(pin)
+
+        lines = [f'// {description}',
+            '',
+            f'CHIP {name} {{',
+            f'    IN {", ".join(pin_decl(p, w) for p, w in inputs)};',
+            f'    OUT {", ".join(pin_decl(p, w) for p, w in outputs)};',
+            '',
+            '    PARTS:']
+        for wire, (a, b) in self.gates.items():
+            if wire in needed:
+                outs = ([wire] if wire in used else []) + pins.get(wire, [])
+                lines.append(f'    Nand(a={a}, b={b}, ' +
+                    ', '.join(f'out={out}' for out in outs) + ');')
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+
+def pin_decl(pin, width):
+    return pin if width == 1 else f'{pin}[{width}]'
+
+
+def bits(pin, width):
+    return [pin] if width == 1 else [f'{pin}[{i}]' for i in range(width)]
+
+
+def log2(ways):
+    if ways < 2 or ways & (ways - 1):
+        raise Exception(f'{ways} ways is not a power of two')
+    return ways.bit_length() - 1
+
+
+def prefix(items, combine, network):
+    # running combination item[i] o ... o item[0] for every i, combine
+    # taking the later operand first
+    n = len(items)
+    if network == 'ripple':
+        result = [items[0]]
+        for item in items[1:]:
+            result.append(combine(item, result[-1]))
+        return result
+
+    current = list(items)
+    span = 1
+    while span < n:
+        if network == 'sklansky':
+            # each upper half block takes the end of the lower half
+            current = [combine(current[i], current[(i // span - 1) * span
+                + span - 1]) if i // span % 2 else current[i]
+                for i in range(n)]
+        elif network == 'kogge-stone':
+            current = [combine(current[i], current[i - span])
+                if i >= span else current[i] for i in range(n)]
+        else:
+            raise Exception(f'unknown prefix network {network}')
+        span *= 2
+    return current
+
+
+def mux_name(ways, width):
+    if ways == 2:
+        return 'Mux' if width == 1 else f'Mux{width}'
+    return f'Mux{ways}Way' + (str(width) if width > 1 else '')
+
+
+def mux(ways, width=16):
+    # a tree of 2 way muxes, sel[0] choosing at the leaves
+    select_bits = log2(ways)
+    hdl = HdlBuilder()
+    sel = bits('sel', select_bits)
+    nsel = [hdl.not_(s) for s in sel]
+    data = letters[:ways]
+    outputs = {}
+    for i in range(width):
+        level = [bits(d, width)[i] for d in data]
+        for s, ns in zip(sel, nsel):
+            level = [hdl.mux(level[j], level[j + 1], s, ns)
+                for j in range(0, len(level), 2)]
+        outputs[bits('out', width)[i]] = level[0]
+    inputs = [(d, width) for d in data] + [('sel', select_bits)]
+    return hdl.chip(mux_name(ways, width), inputs, [('out', width)],
+        outputs, f'{ways} way {width} bit multiplexer, Nand mux tree')
+
+
+def dmux(ways):
+    # every output is in And the select literals of its number
+    select_bits = log2(ways)
+    hdl = HdlBuilder()
+    sel = bits('sel', select_bits)
+    nsel = [hdl.not_(s) for s in sel]
+    outputs = {}
+    for k in range(ways):
+        literals = [sel[j] if k >> j & 1 else nsel[j]
+            for j in range(select_bits)]
+        outputs[letters[k]] = hdl.and_all(['in'] + literals)
+    name = 'DMux' if ways == 2 else f'DMux{ways}Way'
+    return hdl.chip(name, [('in', 1), ('sel', select_bits)],
+        [(letter, 1) for letter in letters[:ways]], outputs,
+        f'{ways} way demultiplexer, flat And trees')
+
+
+def xor_gate():
+    hdl = HdlBuilder()
+    return hdl.chip('Xor', [('a', 1), ('b', 1)], [('out', 1)],
+        {'out': hdl.xor('a', 'b')}, 'exclusive or, 4 Nands')
+
+
+def half_adder():
+    hdl = HdlBuilder()
+    total = hdl.xor('a', 'b')
+    return hdl.chip('HalfAdder', [('a', 1), ('b', 1)],
+        [('sum', 1), ('carry', 1)],
+        {'sum': total, 'carry': hdl.not_(hdl.nand('a', 'b'))},
+        'half adder, the carry sharing the Xor\'s first Nand')
+
+
+def full_adder():
+    # carry = (a And b) Or ((a Xor b) And c), both Ands being Nands the
+    # two Xors already have, so the carry is 2 Nands from c
+    hdl = HdlBuilder()
+    partial = hdl.xor('a', 'b')
+    total = hdl.xor(partial, 'c')
+    carry = hdl.nand(hdl.nand('a', 'b'), hdl.nand(partial, 'c'))
+    return hdl.chip('FullAdder', [('a', 1), ('b', 1), ('c', 1)],
+        [('sum', 1), ('carry', 1)], {'sum': total, 'carry': carry},
+        'full adder, 9 Nands')
+
+
+def adder(width=16, network='sklansky'):
+    # carry i is the generate of bits i-1..0: generate g = a And b,
+    # propagate p = a Or b, combined as (g1 Or p1 And g0, p1 And p0).
+    # Groups carry their generate inverted as well, which lets the combine
+    # be Nand(Not(g1), Nand(p1, g0))
+    hdl = HdlBuilder()
+    a, b = bits('a', width), bits('b', width)
+    xs = []
+    groups = []
+    for i in range(width):
+        ngen = hdl.nand(a[i], b[i])
+        xs.append(hdl.nand(hdl.nand(a[i], ngen), hdl.nand(b[i], ngen)))
+        gen = hdl.not_(ngen)
+        propagate = hdl.nand(hdl.not_(a[i]), hdl.not_(b[i]))
+        groups.append((gen, ngen, propagate))
+
+    def combine(hi, lo):
+        gen = hdl.nand(hi[1], hdl.nand(hi[2], lo[0]))
+        return gen, hdl.not_(gen), hdl.and_(hi[2], lo[2])
+
+    carries = prefix(groups[:-1], combine, network)
+    outputs = {'out[0]': xs[0]}
+    for i in range(1, width):
+        outputs[f'out[{i}]'] = hdl.xor(xs[i], carries[i - 1][0])
+    return hdl.chip(f'Add{width}', [('a', width), ('b', width)],
+        [('out', width)], outputs, f'{width} bit adder, {network} carries')
+
+
+def incrementer(width=16, network='sklansky'):
+    # carry i is in[i-1] And ... And in[0]
+    hdl = HdlBuilder()
+    x = bits('in', width)
+    carries = prefix(x[:-1], hdl.and_, network)
+    outputs = {'out[0]': hdl.not_(x[0])}
+    for i in range(1, width):
+        outputs[f'out[{i}]'] = hdl.xor(x[i], carries[i - 1])
+    return hdl.chip(f'Inc{width}', [('in', width)], [('out', width)],
+        outputs, f'{width} bit incrementer, {network} carries')
+
+
+def generators(network):
+    return {
+        'Mux': lambda: mux(2, 1),
+        'Mux16': lambda: mux(2, 16),
+        'Mux4Way16': lambda: mux(4, 16),
+        'Mux8Way16': lambda: mux(8, 16),
+        'DMux': lambda: dmux(2),
+        'DMux4Way': lambda: dmux(4),
+        'DMux8Way': lambda: dmux(8),
+        'Xor': xor_gate,
+        'HalfAdder': half_adder,
+        'FullAdder': full_adder,
+        'Add16': lambda: adder(16, network),
+        'Inc16': lambda: incrementer(16, network)
+    }
+
+
+def verify_file(filename, n=100000, seed=0):
+    # checks a chip against its reference model, on every input if there
+    # are few enough and otherwise on n random ones
+    chip = load_chip(filename, None, Library())
+    if (sum(width for _, width in chip.inputs)
+            <= max_exhaustive_bits):
+        inputs, n = exhaustive_lanes(chip)
+    else:
+        inputs = random_lanes(chip, n, random.Random(seed))
+    return verify_chip(chip, inputs, n)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description='Write depth optimized .hdl for multiplexers, '
+            'demultiplexers, Xor, adders and the incrementer')
+    arg_parser.add_argument('chips', nargs='*',
+        help='chips to write (default: all of them)')
+    arg_parser.add_argument('-o', '--out-dir',
+        help='write CHIP.hdl files into this folder instead of printing')
+    arg_parser.add_argument('--network', choices=prefix_networks,
+        default='sklansky', help='carry network of Add16 and Inc16')
+    arg_parser.add_argument('--verify', action='store_true',
+        help='check the written chips against their reference models')
+    args = arg_parser.parse_args(argv)
+
+    chips = generators(args.network)
+    names = args.chips or list(chips)
+    for name in names:
+        if name not in chips:
+            raise Exception(f'no generator for {name}, '
+                f'choose from {", ".join(chips)}')
+
+    if args.out_dir is None:
+        if args.verify:
+            raise Exception('--verify needs --out-dir')
+        print('\n'.join(chips[name]() for name in names), end='')
+        return 0
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    status = 0
+    for name in names:
+        filename = os.path.join(args.out_dir, f'{name}.hdl')
+        with open(filename, 'w') as f:
+            f.write(chips[name]())
+        if not args.verify:
+            print(filename)
+            continue
+        failure = verify_file(filename)
+        if failure is None:
+            print(f'{filename}: ok')
+        else:
+            print(f'{filename}: FAIL inputs {failure[0]} gave {failure[1]}, '
+                f'expected {failure[2]}')
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
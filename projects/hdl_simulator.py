@@ -0,0 +1,1365 @@
+import argparse
+import marshal
+import os
+import pickle
+import random
+import re
+import sys
+import time
+from array import array
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(script_dir)
+
+from build_cache import BuildCache, default_cache_dir, tool_version
+
+
+# folders searched for a part's .hdl after the folder of the chip using it
+hdl_path = [os.path.join(script_dir, d)
+    for d in ['01', '02', os.path.join('03', 'a'), os.path.join('03', 'b'),
+        '05']]
+
+hdl_token_pattern = re.compile(
+    r'\s+|//[^\n]*|/\*[\s\S]*?\*/'
+    r'|(?P<token>[A-Za-z_][A-Za-z0-9_]*|\d+|\.\.|[{}();,=\[\]:])'
+    r'|(?P<error>.)')
+
+# the two constant nets, every netlist starts with them
+FALSE = 0
+TRUE = 1
+
+
+class Connection:
+    # pin[pin_range]=target[target_range], ranges are (lo, hi) or None
+    pin = ''
+    pin_range = None
+    target = ''
+    target_range = None
+
+    def __init__(self, pin, pin_range, target, target_range):
+        self.pin = pin
+        self.pin_range = pin_range
+        self.target = target
+        self.target_range = target_range
+
+
+class Part:
+    name = ''
+    connections = None
+    line = 0
+
+    def __init__(self, name, connections, line):
+        self.name = name
+        self.connections = connections
+        self.line = line
+
+
+class ChipDef:
+    name = ''
+    filename = ''
+    inputs = None
+    outputs = None
+    parts = None
+
+    def __init__(self, name, filename, inputs, outputs, parts):
+        self.name = name
+        self.filename = filename
+        # lists of (pin, width)
+        self.inputs = inputs
+        self.outputs = outputs
+        self.parts = parts
+
+
+class HdlParser:
+    tokens = None
+    position = 0
+    filename = ''
+
+    def __init__(self, text, filename=''):
+        self.tokens = []
+        self.filename = filename
+        line = 1
+        for match in hdl_token_pattern.finditer(text):
+            if match.lastgroup == 'error':
+                raise Exception(f'{filename}:{line}: unexpected character '
+                    f'{match.group()!r}')
+            if match.lastgroup == 'token':
+                self.tokens.append((match.group('token'), line))
+            line += match.group().count('\n')
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def line(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][1]
+        return self.tokens[-1][1] if self.tokens else 0
+
+    def next(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise Exception(f'{self.filename}:{self.line()}: expected '
+                f'{expected or "a token"}, got {token!r}')
+        self.position += 1
+        return token
+
+    def name(self):
+        token = self.next()
+        if not re.fullmatch(r'[A-Za-z_]\w*', token):
+            raise Exception(f'{self.filename}:{self.line()}: expected a name, '
+                f'got {token!r}')
+        return token
+
+    def number(self):
+        token = self.next()
+        if not token.isdigit():
+            raise Exception(f'{self.filename}:{self.line()}: expected a '
+                f'number, got {token!r}')
+        return int(token)
+
+    def subscript(self):
+        # [i] or [i..j], None without one
+        if self.peek() != '[':
+            return None
+        self.next('[')
+        lo = hi = self.number()
+        if self.peek() == '..':
+            self.next('..')
+            hi = self.number()
+        self.next(']')
+        return lo, hi
+
+    def pin_list(self):
+        pins = []
+        while True:
+            name = self.name()
+            width = 1
+            if self.peek() == '[':
+                self.next('[')
+                width = self.number()
+                self.next(']')
+            pins.append((name, width))
+            if self.peek() != ',':
+                break
+            self.next(',')
+        self.next(';')
+        return pins
+
+    def part(self):
+        line = self.line()
+        name = self.name()
+        self.next('(')
+        connections = []
+        while True:
+            pin = self.name()
+            pin_range = self.subscript()
+            self.next('=')
+            target = self.name()
+            connections.append(
+                Connection(pin, pin_range, target, self.subscript()))
+            if self.peek() != ',':
+                break
+            self.next(',')
+        self.next(')')
+        self.next(';')
+        return Part(name, connections, line)
+
+    def chip(self):
+        self.next('CHIP')
+        name = self.name()
+        self.next('{')
+        inputs = []
+        outputs = []
+        if self.peek() == 'IN':
+            self.next('IN')
+            inputs = self.pin_list()
+        if self.peek() == 'OUT':
+            self.next('OUT')
+            outputs = self.pin_list()
+
+        parts = None
+        if self.peek() == 'PARTS':
+            self.next('PARTS')
+            self.next(':')
+            parts = []
+            while self.peek() != '}':
+                parts.append(self.part())
+        else:
+            # BUILTIN name; and CLOCKED pins; leave the chip to the models
+            while self.peek() != '}':
+                self.next()
+        self.next('}')
+        return ChipDef(name, self.filename, inputs, outputs, parts)
+
+
+def parse_hdl(filename):
+    with open(filename, 'r') as f:
+        return HdlParser(f.read(), filename).chip()
+
+
+class Builtin:
+    # a chip simulated by Python code instead of its parts. comb gets the
+    # comb_inputs and returns the outputs, tick gets all inputs
+    inputs = ()
+    outputs = ()
+    comb_inputs = ()
+    clocked = False
+
+    def comb(self, *values):
+        return ()
+
+    def tick(self, *values):
+        pass
+
+    def tock(self):
+        pass
+
+
+class RAM(Builtin):
+    size = 0
+    memory = None
+    pending = None
+    outputs = (('out', 16),)
+    comb_inputs = ('address',)
+    clocked = True
+
+    def __init__(self):
+        self.memory = [0] * self.size
+        self.pending = None
+
+    def comb(self, address=0):
+        return (self.memory[address],)
+
+    def tick(self, value, load, address=0):
+        # written at tock, out shows the old value until then
+        self.pending = (address, value & 0xffff) if load else None
+
+    def tock(self):
+        if self.pending is not None:
+            address, value = self.pending
+            self.memory[address] = value
+            self.pending = None
+
+    def __getitem__(self, address):
+        # what the chip holds, like a register part's DFF inputs: a value
+        # taken in at tick shows before the tock that puts it on out
+        if self.pending is not None and self.pending[0] == address:
+            return self.pending[1]
+        return self.memory[address]
+
+    def __setitem__(self, address, value):
+        self.memory[address] = value & 0xffff
+
+
+class Register(RAM):
+    size = 1
+    inputs = (('in', 16), ('load', 1))
+    comb_inputs = ()
+
+
+class Bit(Register):
+    inputs = (('in', 1), ('load', 1))
+    outputs = (('out', 1),)
+
+
+class PC(Register):
+    inputs = (('in', 16), ('load', 1), ('inc', 1), ('reset', 1))
+
+    def tick(self, value, load, inc, reset):
+        if reset:
+            self.pending = (0, 0)
+        elif load:
+            self.pending = (0, value & 0xffff)
+        elif inc:
+            self.pending = (0, self.memory[0] + 1 & 0xffff)
+        else:
+            self.pending = None
+
+
+class RAM8(RAM):
+    size = 8
+    inputs = (('in', 16), ('load', 1), ('address', 3))
+
+
+class RAM64(RAM):
+    size = 64
+    inputs = (('in', 16), ('load', 1), ('address', 6))
+
+
+class RAM512(RAM):
+    size = 512
+    inputs = (('in', 16), ('load', 1), ('address', 9))
+
+
+class RAM4K(RAM):
+    size = 4096
+    inputs = (('in', 16), ('load', 1), ('address', 12))
+
+
+class RAM16K(RAM):
+    size = 16384
+    inputs = (('in', 16), ('load', 1), ('address', 14))
+
+
+class Screen(RAM):
+    size = 8192
+    inputs = (('in', 16), ('load', 1), ('address', 13))
+
+
+class Keyboard(Builtin):
+    key = 0
+    outputs = (('out', 16),)
+
+    def comb(self):
+        return (self.key,)
+
+
+class ROM32K(Builtin):
+    memory = None
+    inputs = (('address', 15),)
+    outputs = (('out', 16),)
+    comb_inputs = ('address',)
+
+    def __init__(self):
+        self.memory = [0] * 32768
+
+    def comb(self, address):
+        return (self.memory[address],)
+
+    def load(self, filename):
+        with open(filename, 'r') as f:
+            words = [int(line, 2) for line in f.read().split()]
+        self.memory = words + [0] * (32768 - len(words))
+
+    def __getitem__(self, address):
+        return self.memory[address]
+
+
+# chips the course supplies built in. A chip's own folder is searched before
+# these and the other projects after, like the course simulator does, so
+# the computer runs on a RAM16K model rather than four million gates
+builtin_models = {
+    'RAM16K': RAM16K,
+    'ROM32K': ROM32K,
+    'Screen': Screen,
+    'Keyboard': Keyboard
+}
+
+# chips with a model that behaves like the course's version of them. Unless
+# the library is structural these stand in for any .hdl of the same name
+# below the chip being simulated, so a RAM16K test runs on its own .hdl
+# over four RAM4K models instead of a million gates
+behavioral_models = {
+    'Bit': Bit,
+    'Register': Register,
+    'ARegister': Register,
+    'DRegister': Register,
+    'PC': PC,
+    'RAM8': RAM8,
+    'RAM64': RAM64,
+    'RAM512': RAM512,
+    'RAM4K': RAM4K,
+    'RAM16K': RAM16K,
+    'Screen': Screen,
+    'Keyboard': Keyboard
+}
+
+# the models by class name, which is how a compiled chip refers to them
+model_classes = {model.__name__: model
+    for model in list(builtin_models.values()) +
+        list(behavioral_models.values())}
+
+# Nand and DFF are the nets and gates of the netlist itself
+primitives = {
+    'Nand': ([('a', 1), ('b', 1)], [('out', 1)]),
+    'DFF': ([('in', 1)], [('out', 1)])
+}
+
+# the CPU's registers are plain registers with a name to look them up by
+aliases = {
+    'ARegister': 'Register',
+    'DRegister': 'Register'
+}
+
+
+class Library:
+    # finds and parses each chip once. A structural library builds every
+    # part from its .hdl, down to the course's builtin chips
+    path = None
+    structural = False
+    chips = None
+    resolved = None
+
+    def __init__(self, path=None, structural=False):
+        self.path = hdl_path if path is None else path
+        self.structural = structural
+        self.chips = {}
+        self.resolved = {}
+
+    def find(self, name, folders):
+        for d in folders:
+            filename = os.path.join(d, f'{name}.hdl')
+            if os.path.exists(filename):
+                return os.path.realpath(filename)
+        return None
+
+    def load(self, filename):
+        if filename not in self.chips:
+            self.chips[filename] = parse_hdl(filename)
+        return self.chips[filename]
+
+    def resolve(self, name, folder):
+        # a ChipDef, a Builtin subclass or a primitive name
+        key = (name, folder)
+        if key not in self.resolved:
+            self.resolved[key] = self.search(name, folder)
+        return self.resolved[key]
+
+    def search(self, name, folder):
+        if name in primitives:
+            return name
+        if not self.structural and name in behavioral_models:
+            return behavioral_models[name]
+        for folders in ([folder], None, self.path):
+            if folders is None:
+                if name in builtin_models:
+                    return builtin_models[name]
+                continue
+            filename = self.find(name, folders)
+            if filename is not None and self.load(filename).parts is not None:
+                return self.load(filename)
+        if name in aliases:
+            return self.resolve(aliases[name], folder)
+        raise Exception(f'no chip {name} in {folder} or the hdl path')
+
+    def closure(self, chip):
+        # every .hdl file the chip is built from
+        files = []
+        todo = [chip]
+        while todo:
+            chip = todo.pop()
+            if chip.filename in files:
+                continue
+            files.append(chip.filename)
+            folder = os.path.dirname(chip.filename)
+            for part in chip.parts:
+                resolved = self.resolve(part.name, folder)
+                if isinstance(resolved, ChipDef):
+                    todo.append(resolved)
+        return sorted(files)
+
+
+def pin_widths(resolved):
+    if isinstance(resolved, str):
+        return primitives[resolved]
+    if isinstance(resolved, ChipDef):
+        return resolved.inputs, resolved.outputs
+    return list(resolved.inputs), list(resolved.outputs)
+
+
+class Netlist:
+    # the flattened chip: single bit nets joined by union-find, Nand gates,
+    # DFFs and builtin chips
+    parent = None
+    nands = None
+    dffs = None
+    builtins = None
+    parts = None
+    library = None
+    plans = None
+
+    def __init__(self, library):
+        self.parent = [FALSE, TRUE]
+        self.nands = []
+        self.dffs = []
+        self.builtins = []
+        self.parts = {}
+        self.library = library
+        self.plans = {}
+
+    def new_nets(self, width):
+        start = len(self.parent)
+        self.parent.extend(range(start, start + width))
+        return list(range(start, start + width))
+
+    def find(self, net):
+        parent = self.parent
+        root = net
+        while parent[root] != root:
+            root = parent[root]
+        while parent[net] != root:
+            parent[net], net = root, parent[net]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            # constants stay their own roots
+            if b in (FALSE, TRUE):
+                a, b = b, a
+            self.parent[b] = a
+
+    def instantiate(self, resolved, pins, name=''):
+        # pins maps every input and output pin to its nets
+        if resolved == 'Nand':
+            self.nands.append((pins['out'][0], pins['a'][0], pins['b'][0]))
+        elif resolved == 'DFF':
+            self.dffs.append((pins['out'][0], pins['in'][0]))
+        elif not isinstance(resolved, ChipDef):
+            self.parts.setdefault(name, ('builtin', len(self.builtins)))
+            self.builtins.append((resolved, pins))
+        else:
+            self.instantiate_chip(resolved, pins)
+
+    def plan(self, chip):
+        # what instantiating a chip takes, worked out and checked once per
+        # chip: its internal pin widths and per part the pins and where
+        # each connection goes
+        if chip.filename in self.plans:
+            return self.plans[chip.filename]
+        folder = os.path.dirname(chip.filename)
+        resolved = [self.library.resolve(part.name, folder)
+            for part in chip.parts]
+        widths = dict(chip.inputs + chip.outputs)
+        inputs = {name for name, _ in chip.inputs}
+
+        # internal pins are as wide as the part outputs driving them
+        internal = {}
+        for part, part_chip in zip(chip.parts, resolved):
+            part_outputs = dict(pin_widths(part_chip)[1])
+            for c in part.connections:
+                if c.pin in part_outputs and c.target not in widths:
+                    lo, hi = c.pin_range or (0, part_outputs[c.pin] - 1)
+                    width = hi - lo + 1
+                    if c.target_range is not None:
+                        width = c.target_range[1] + 1
+                    internal[c.target] = max(internal.get(c.target, 0), width)
+        widths.update(internal)
+
+        def error(part, message):
+            raise Exception(f'{chip.filename}:{part.line}: {message}')
+
+        parts = []
+        for part, part_chip in zip(chip.parts, resolved):
+            part_inputs, part_outputs = pin_widths(part_chip)
+            pins = dict(part_inputs + part_outputs)
+            connections = []
+            for c in part.connections:
+                if c.pin not in pins:
+                    error(part, f'{part.name} has no pin {c.pin}')
+                lo, hi = c.pin_range or (0, pins[c.pin] - 1)
+                is_input = c.pin in dict(part_inputs)
+                if c.target in ('true', 'false'):
+                    if not is_input:
+                        error(part, f'{c.target} connected to output {c.pin}')
+                    const = TRUE if c.target == 'true' else FALSE
+                    connections.append((True, c.pin, lo, hi, None,
+                        [const] * (hi - lo + 1)))
+                    continue
+                if c.target not in widths:
+                    error(part, f'{c.target} is never driven')
+                if not is_input and c.target in inputs:
+                    error(part, f'output {c.pin} drives input {c.target}')
+                t_lo, t_hi = c.target_range or (0, widths[c.target] - 1)
+                if t_hi - t_lo != hi - lo or t_hi >= widths[c.target]:
+                    error(part, f'{c.pin} and {c.target} differ in width')
+                connections.append((is_input, c.pin, lo, hi, c.target,
+                    (t_lo, t_hi)))
+            parts.append((part.name, part_chip, part_inputs, part_outputs,
+                connections))
+
+        self.plans[chip.filename] = (list(internal.items()), parts)
+        return self.plans[chip.filename]
+
+    def instantiate_chip(self, chip, pins):
+        internal, parts = self.plan(chip)
+        scope = dict(pins)
+        for name, width in internal:
+            scope[name] = self.new_nets(width)
+
+        for name, part_chip, part_inputs, part_outputs, connections in parts:
+            part_pins = {pin: [FALSE] * width for pin, width in part_inputs}
+            for pin, width in part_outputs:
+                part_pins[pin] = self.new_nets(width)
+
+            for is_input, pin, lo, hi, target, nets in connections:
+                if target is not None:
+                    nets = scope[target][nets[0]:nets[1] + 1]
+                if is_input:
+                    part_pins[pin][lo:hi + 1] = nets
+                else:
+                    for a, b in zip(part_pins[pin][lo:hi + 1], nets):
+                        self.union(a, b)
+
+            if isinstance(part_chip, ChipDef) or part_chip == 'DFF':
+                self.parts.setdefault(name, ('nets', part_pins.get('out', [])))
+            self.instantiate(part_chip, part_pins, name)
+
+
+class CompiledChip:
+    # everything a Simulator needs, a plain dict inside so it pickles
+    # without this module
+    data = None
+    evaluate = None
+    clock = None
+
+    def __init__(self, data):
+        self.data = data
+        namespace = {}
+        exec(marshal.loads(data['code']), namespace)
+        self.evaluate = namespace['evaluate']
+        self.clock = namespace['clock']
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['data'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def topological_order(netlist, root):
+    # the Nand gates and builtin chips in an order where every input is
+    # computed before it is used. Nodes are ('nand', i) and ('builtin', k)
+    nodes = [('nand', i) for i in range(len(netlist.nands))]
+    nodes += [('builtin', k) for k in range(len(netlist.builtins))]
+
+    driver = {}
+    deps = []
+    for node, (kind, i) in enumerate(nodes):
+        if kind == 'nand':
+            out, a, b = netlist.nands[i]
+            driver[root[out]] = node
+            deps.append([root[a], root[b]])
+        else:
+            model, pins = netlist.builtins[i]
+            for pin, _ in model.outputs:
+                for net in pins[pin]:
+                    driver[root[net]] = node
+            deps.append([root[net] for pin in model.comb_inputs
+                for net in pins[pin]])
+
+    users = {}
+    waiting = [0] * len(nodes)
+    for node, nets in enumerate(deps):
+        for net in nets:
+            if net in driver:
+                users.setdefault(net, []).append(node)
+                waiting[node] += 1
+
+    ready = [node for node in range(len(nodes)) if not waiting[node]]
+    order = []
+    while ready:
+        node = ready.pop()
+        order.append(nodes[node])
+        kind, i = nodes[node]
+        if kind == 'nand':
+            outs = [root[netlist.nands[i][0]]]
+        else:
+            model, pins = netlist.builtins[i]
+            outs = {root[net] for pin, _ in model.outputs for net in pins[pin]}
+        for out in outs:
+            for user in users.get(out, ()):
+                waiting[user] -= 1
+                if not waiting[user]:
+                    ready.append(user)
+
+    if len(order) < len(nodes):
+        raise Exception(f'combinational loop through '
+            f'{len(nodes) - len(order)} gates')
+    return order
+
+
+def simplify(netlist, root, order):
+    # constant folding, Not/And/Or recognition and common subexpressions
+    # over the Nand gates. Returns rep, the net each net equals, and op, how
+    # each remaining computed net is computed
+    rep = {}
+    op = {}
+    seen = {}
+
+    def value(net):
+        net = root[net]
+        return rep.get(net, net)
+
+    def define(out, expression):
+        key = expression
+        if expression[0] in ('nand', 'and', 'or') and expression[1] > expression[2]:
+            key = (expression[0], expression[2], expression[1])
+        if key in seen:
+            rep[out] = seen[key]
+        else:
+            seen[key] = out
+            op[out] = key
+
+    def invert(out, x):
+        if x in (FALSE, TRUE):
+            rep[out] = TRUE - x
+            return
+        kind = op.get(x, ('',))
+        if kind[0] == 'not':
+            rep[out] = kind[1]
+        elif kind[0] == 'nand':
+            define(out, ('and', kind[1], kind[2]))
+        elif kind[0] == 'and':
+            define(out, ('nand', kind[1], kind[2]))
+        else:
+            define(out, ('not', x))
+
+    for kind, i in order:
+        if kind == 'builtin':
+            model, pins = netlist.builtins[i]
+            for index, (pin, _) in enumerate(model.outputs):
+                for bit, net in enumerate(pins[pin]):
+                    op[root[net]] = ('bit', i, index, bit)
+            continue
+
+        out, a, b = netlist.nands[i]
+        out, a, b = root[out], value(a), value(b)
+        if a == FALSE or b == FALSE:
+            rep[out] = TRUE
+        elif a == TRUE:
+            invert(out, b)
+        elif b == TRUE or a == b:
+            invert(out, a)
+        elif op.get(a, ('',))[0] == 'not' and op.get(b, ('',))[0] == 'not':
+            define(out, ('or', op[a][1], op[b][1]))
+        else:
+            define(out, ('nand', a, b))
+    return rep, op
+
+
+def compile_netlist(netlist, observable, input_nets):
+    # straight-line Python for one evaluation of the whole netlist. v holds
+    # the observable nets, s the DFF outputs, B the builtin chips and M is
+    # the all-ones value of a net, 1 unless nets carry many vectors at once
+    root = [netlist.find(net) for net in range(len(netlist.parent))]
+    order = topological_order(netlist, root)
+    rep, op = simplify(netlist, root, order)
+
+    def value(net):
+        net = root[net]
+        return rep.get(net, net)
+
+    dff_out = {root[out]: i for i, (out, _) in enumerate(netlist.dffs)}
+    comb_inputs = [[value(net) for pin in model.comb_inputs
+        for net in pins_[pin]] for model, pins_ in netlist.builtins]
+
+    observable = {root[net] for net in observable}
+    observable.update(root[net] for _, net in netlist.dffs)
+    for model, pins_ in netlist.builtins:
+        for pin, _ in model.inputs:
+            observable.update(root[net] for net in pins_[pin])
+    observable -= {FALSE, TRUE}
+
+    # nets the observable ones need
+    live = set()
+    todo = [value(net) for net in observable]
+    while todo:
+        net = todo.pop()
+        if net in live or net in (FALSE, TRUE):
+            continue
+        live.add(net)
+        expression = op.get(net)
+        if expression is None:
+            continue
+        if expression[0] == 'bit':
+            todo += comb_inputs[expression[1]]
+        else:
+            todo += expression[1:]
+
+    def ref(net):
+        if net == FALSE:
+            return '0'
+        if net == TRUE:
+            return 'M'
+        return f'n{net}'
+
+    input_nets = {root[net] for net in input_nets}
+    lines = ['def evaluate(v, s, B, M=1):']
+    for net in sorted(live):
+        if net in dff_out:
+            lines.append(f'    n{net} = s[{dff_out[net]}]')
+        elif net not in op:
+            # chip inputs, anything undriven reads as 0 from v
+            lines.append(f'    n{net} = v[{net}]')
+
+    gates = 0
+    for kind, i in order:
+        if kind == 'builtin':
+            model, pins_ = netlist.builtins[i]
+            outs = [(index, bit, root[net])
+                for index, (pin, _) in enumerate(model.outputs)
+                for bit, net in enumerate(pins_[pin])]
+            if not any(net in live for _, _, net in outs):
+                continue
+            words = []
+            for pin in model.comb_inputs:
+                bits = [f'{ref(value(net))} << {bit}' if bit else
+                    ref(value(net)) for bit, net in enumerate(pins_[pin])
+                    if value(net) != FALSE]
+                words.append(' | '.join(bits) or '0')
+            lines.append(f'    t{i} = B[{i}].comb({", ".join(words)})')
+            for index, bit, net in outs:
+                if net in live and op.get(net, ('',))[0] == 'bit':
+                    lines.append(f'    n{net} = t{i}[{index}] >> {bit} & 1')
+            continue
+
+        out = root[netlist.nands[i][0]]
+        if out not in live or out not in op:
+            continue
+        gates += 1
+        kind, *args = op[out]
+        a = ref(args[0])
+        if kind == 'not':
+            lines.append(f'    n{out} = M ^ {a}')
+        else:
+            b = ref(args[1])
+            lines.append({
+                'nand': f'    n{out} = M ^ ({a} & {b})',
+                'and': f'    n{out} = {a} & {b}',
+                'or': f'    n{out} = {a} | {b}'
+            }[kind])
+
+    for net in sorted(observable):
+        source = value(net)
+        if net in input_nets and source == net:
+            continue
+        lines.append(f'    v[{net}] = {ref(source)}')
+    lines.append('    return')
+
+    # the clocked builtins take in their inputs, which evaluate left in v
+    lines.append('def clock(v, B):')
+    for i, (model, pins_) in enumerate(netlist.builtins):
+        if not model.clocked:
+            continue
+        words = []
+        for pin, _ in model.inputs:
+            bits = [('1' if root[net] == TRUE else f'v[{root[net]}]') +
+                (f' << {bit}' if bit else '')
+                for bit, net in enumerate(pins_[pin]) if root[net] != FALSE]
+            words.append(' | '.join(bits) or '0')
+        lines.append(f'    B[{i}].tick({", ".join(words)})')
+    lines.append('    return')
+
+    source = '\n'.join(lines) + '\n'
+    stats = {
+        'nets': len(netlist.parent),
+        'nands': len(netlist.nands),
+        'gates': gates,
+        'dffs': len(netlist.dffs),
+        'builtins': len(netlist.builtins)
+    }
+    return compile(source, '<netlist>', 'exec'), stats
+
+
+def compile_chip(filename, library=None):
+    library = library or Library()
+    chip = library.load(os.path.realpath(filename))
+    if chip.parts is None:
+        raise Exception(f'{filename} is a builtin chip')
+
+    netlist = Netlist(library)
+    pins = {name: netlist.new_nets(width)
+        for name, width in chip.inputs + chip.outputs}
+    netlist.instantiate_chip(chip, pins)
+
+    # the outputs of named parts are kept for looking at registers
+    observable = [net for nets in pins.values() for net in nets]
+    observable += [net for kind, nets in netlist.parts.values()
+        if kind == 'nets' for net in nets]
+    code, stats = compile_netlist(netlist, observable,
+        [net for name, _ in chip.inputs for net in pins[name]])
+
+    def roots(nets):
+        return [netlist.find(net) for net in nets]
+
+    return {
+        'name': chip.name,
+        'inputs': chip.inputs,
+        'outputs': chip.outputs,
+        'pins': {name: roots(nets) for name, nets in pins.items()},
+        'dff_in': [netlist.find(net) for _, net in netlist.dffs],
+        'dff_out': {netlist.find(out): i
+            for i, (out, _) in enumerate(netlist.dffs)},
+        'builtins': [(model.__name__, {pin: roots(nets)
+            for pin, nets in pins_.items()})
+            for model, pins_ in netlist.builtins],
+        'parts': {name: (kind, roots(value) if kind == 'nets' else value)
+            for name, (kind, value) in netlist.parts.items()},
+        'nets': len(netlist.parent),
+        'code': marshal.dumps(code),
+        'stats': stats
+    }
+
+
+def load_chip(filename, cache=None, library=None):
+    # a CompiledChip, from the cache when no .hdl it is built from changed
+    library = library or Library()
+    if cache is None:
+        return CompiledChip(compile_chip(filename, library))
+
+    chip = library.load(os.path.realpath(filename))
+    files = library.closure(chip)
+    key = cache.key(files, tool_version(__file__), sys.version, chip.name,
+        library.structural)
+    data = cache.load(key)
+    if data is not None:
+        return CompiledChip(pickle.loads(data))
+    data = compile_chip(filename, library)
+    cache.save(key, pickle.dumps(data))
+    return CompiledChip(data)
+
+
+def word(v, nets):
+    value = 0
+    for bit, net in enumerate(nets):
+        value |= v[net] << bit
+    return value
+
+
+class Simulator:
+    chip = None
+    v = None
+    state = None
+    latched = None
+    builtins = None
+    dirty = True
+
+    def __init__(self, chip):
+        self.chip = chip
+        self.dirty = True
+        self.v = [0] * chip.nets
+        self.v[TRUE] = 1
+        self.state = [0] * len(chip.dff_in)
+        self.latched = [0] * len(chip.dff_in)
+        self.builtins = [model_classes[name]() for name, _ in chip.builtins]
+
+    def set(self, pin, value):
+        v = self.v
+        for bit, net in enumerate(self.chip.pins[pin]):
+            v[net] = value >> bit & 1
+        self.dirty = True
+
+    def get(self, pin):
+        return word(self.v, self.chip.pins[pin])
+
+    def eval(self):
+        self.chip.evaluate(self.v, self.state, self.builtins)
+        self.dirty = False
+
+    def tick(self):
+        # clocked parts take in their inputs, their outputs change at tock.
+        # Right after a tock the nets are already up to date
+        if self.dirty:
+            self.eval()
+        v = self.v
+        self.latched = [v[net] for net in self.chip.dff_in]
+        self.chip.clock(v, self.builtins)
+
+    def tock(self):
+        self.state[:] = self.latched
+        for model in self.builtins:
+            model.tock()
+        self.eval()
+
+    def part(self, name):
+        # the builtin chip instance of that name, which the caller may change
+        kind, value = self.chip.parts[name]
+        if kind != 'builtin':
+            raise Exception(f'{name} is not a builtin chip')
+        self.dirty = True
+        return self.builtins[value]
+
+    def part_value(self, name):
+        # the value a register part holds, its DFFs' latest input
+        kind, nets = self.chip.parts[name]
+        if kind == 'builtin':
+            if not isinstance(self.builtins[nets], Register):
+                raise Exception(f'{name} is a builtin chip, index it')
+            return self.builtins[nets][0]
+        dff_out = self.chip.dff_out
+        value = 0
+        for bit, net in enumerate(nets):
+            i = dff_out.get(net)
+            value |= (self.latched[i] if i is not None else self.v[net]) << bit
+        return value
+
+
+# Many test vectors at once: net values are ints with bit j belonging to
+# vector j, so one evaluate runs them all. Pin values travel in lanes, an
+# int with vector j's value in bits 16j to 16j+15, which is also how the
+# reference models below compute whole vector sets with plain int
+# arithmetic. Converting between the two goes through strings so it runs
+# at C speed.
+
+lane_spread = str.maketrans({'0': '0' * 16, '1': '0' * 15 + '1'})
+
+
+def lanes_to_slices(lanes, width, n):
+    # one int per pin bit, bit j of it from lane j
+    s = format(lanes, f'0{16 * n}b')
+    return [int(s[15 - bit::16], 2) for bit in range(width)]
+
+
+def slices_to_lanes(slices, n):
+    lanes = 0
+    for bit, x in enumerate(slices):
+        lanes |= int(format(x, f'0{n}b').translate(lane_spread), 2) << bit
+    return lanes
+
+
+def words_to_lanes(words):
+    return int.from_bytes(array('H', [w & 0xffff for w in words]).tobytes(),
+        'little')
+
+
+def lanes_to_words(lanes, n):
+    return array('H', lanes.to_bytes(2 * n, 'little'))
+
+
+class Lanes:
+    # SWAR helpers for n 16 bit lanes
+    n = 0
+    ones = 0
+    low = 0
+    high = 0
+
+    def __init__(self, n):
+        self.n = n
+        self.ones = (1 << 16 * n) - 1
+        self.low = self.ones // 0xffff
+        self.high = self.low << 15
+
+    def mask(self, bits):
+        # 0xffff in the lanes whose low bit is set
+        return (bits & self.low) * 0xffff
+
+    def bit(self, lanes, i):
+        return lanes >> i & self.low
+
+    def add(self, a, b):
+        # the top bit of each lane is added without its carry out
+        rest = self.ones ^ self.high
+        return ((a & rest) + (b & rest)) ^ ((a ^ b) & self.high)
+
+    def nonzero(self, lanes):
+        rest = self.ones ^ self.high
+        return ((((lanes & rest) + rest) | lanes) & self.high) >> 15
+
+    def select(self, sel, ways):
+        # lanes of ways[sel], sel a lane of log2(len(ways)) bits
+        out = 0
+        for k, way in enumerate(ways):
+            match = self.low
+            for i in range(len(ways).bit_length() - 1):
+                bit = self.bit(sel, i)
+                match &= bit if k >> i & 1 else bit ^ self.low
+            out |= way & self.mask(match)
+        return out
+
+    def demux(self, value, sel, ways):
+        return {name: value & self.select(sel,
+            [self.ones if k == i else 0 for k in range(len(ways))])
+            for i, name in enumerate(ways)}
+
+
+def reference_alu(L, p):
+    x = p['x'] & ~L.mask(p['zx']) & L.ones
+    x ^= L.mask(p['nx'])
+    y = p['y'] & ~L.mask(p['zy']) & L.ones
+    y ^= L.mask(p['ny'])
+    f = L.mask(p['f'])
+    out = (L.add(x, y) & f) | (x & y & ~f & L.ones)
+    out ^= L.mask(p['no'])
+    return {'out': out, 'zr': L.nonzero(out) ^ L.low, 'ng': L.bit(out, 15)}
+
+
+# what the course's combinational chips compute, on lanes
+reference_models = {
+    'Not': lambda L, p: {'out': p['in'] ^ L.low},
+    'And': lambda L, p: {'out': p['a'] & p['b']},
+    'Or': lambda L, p: {'out': p['a'] | p['b']},
+    'Xor': lambda L, p: {'out': p['a'] ^ p['b']},
+    'Mux': lambda L, p: {'out': L.select(p['sel'], [p['a'], p['b']])},
+    'DMux': lambda L, p: L.demux(p['in'], p['sel'], 'ab'),
+    'DMux4Way': lambda L, p: L.demux(p['in'], p['sel'], 'abcd'),
+    'DMux8Way': lambda L, p: L.demux(p['in'], p['sel'], 'abcdefgh'),
+    'Not16': lambda L, p: {'out': p['in'] ^ L.ones},
+    'And16': lambda L, p: {'out': p['a'] & p['b']},
+    'Or16': lambda L, p: {'out': p['a'] | p['b']},
+    'Mux16': lambda L, p: {'out': L.select(p['sel'], [p['a'], p['b']])},
+    'Mux4Way16': lambda L, p: {'out': L.select(p['sel'],
+        [p[w] for w in 'abcd'])},
+    'Mux8Way16': lambda L, p: {'out': L.select(p['sel'],
+        [p[w] for w in 'abcdefgh'])},
+    'Or8Way': lambda L, p: {'out': L.nonzero(p['in'])},
+    'HalfAdder': lambda L, p: {'sum': p['a'] ^ p['b'], 'carry': p['a'] & p['b']},
+    'FullAdder': lambda L, p: {'sum': p['a'] ^ p['b'] ^ p['c'],
+        'carry': L.add(L.add(p['a'], p['b']), p['c']) >> 1 & L.low},
+    'Add16': lambda L, p: {'out': L.add(p['a'], p['b'])},
+    'Inc16': lambda L, p: {'out': L.add(p['in'], L.low)},
+    'ALU': reference_alu
+}
+
+
+class VectorSimulator(Simulator):
+    # a combinational chip evaluated for n vectors at once, pins are set
+    # and read as lanes
+    n = 0
+    lanes = None
+
+    def __init__(self, chip, n):
+        if chip.dff_in or chip.builtins:
+            raise Exception(f'{chip.name} is not combinational')
+        super().__init__(chip)
+        self.n = n
+        self.lanes = Lanes(n)
+        self.v[TRUE] = (1 << n) - 1
+
+    def set(self, pin, lanes):
+        nets = self.chip.pins[pin]
+        for net, x in zip(nets, lanes_to_slices(lanes, len(nets), self.n)):
+            self.v[net] = x
+
+    def get(self, pin):
+        return slices_to_lanes([self.v[net] for net in self.chip.pins[pin]],
+            self.n)
+
+    def eval(self):
+        self.chip.evaluate(self.v, self.state, self.builtins, self.v[TRUE])
+
+
+def random_lanes(chip, n, rng):
+    L = Lanes(n)
+    return {pin: rng.getrandbits(16 * n) & L.low * ((1 << width) - 1)
+        for pin, width in chip.inputs}
+
+
+# --exhaustive tries 2^n inputs, a two input 16 bit chip has 2^32
+max_exhaustive_bits = 20
+
+
+def exhaustive_lanes(chip):
+    # every combination of the input bits, n of them
+    input_bits = sum(width for _, width in chip.inputs)
+    if input_bits > max_exhaustive_bits:
+        raise Exception(f'{chip.name} has {input_bits} input bits, too many '
+            f'to try all {1 << input_bits} inputs (at most '
+            f'{max_exhaustive_bits}), use --verify N instead')
+    n = 1 << input_bits
+    lanes = {}
+    shift = 0
+    for pin, width in chip.inputs:
+        lanes[pin] = words_to_lanes(j >> shift & ((1 << width) - 1)
+            for j in range(n))
+        shift += width
+    return lanes, n
+
+
+def verify_chip(chip, inputs, n, reference=None):
+    # evaluates n vectors on the chip and its reference model, returns None
+    # or the first vector they differ on as (inputs, outputs, expected)
+    reference = reference or reference_models[chip.name]
+    sim = VectorSimulator(chip, n)
+    for pin, lanes in inputs.items():
+        sim.set(pin, lanes)
+    sim.eval()
+    expected = reference(sim.lanes, inputs)
+
+    # compared bit slice by bit slice, turning slices back into lanes
+    # would take longer than the evaluation
+    first = None
+    for pin, width in chip.outputs:
+        nets = chip.pins[pin]
+        for net, x in zip(nets, lanes_to_slices(expected[pin], width, n)):
+            diff = sim.v[net] ^ x
+            if diff:
+                j = (diff & -diff).bit_length() - 1
+                first = j if first is None else min(first, j)
+    if first is None:
+        return None
+
+    def at(lanes):
+        return lanes >> 16 * first & 0xffff
+    outputs = {pin: sum((sim.v[net] >> first & 1) << bit
+        for bit, net in enumerate(chip.pins[pin])) for pin, _ in chip.outputs}
+    return ({p: at(x) for p, x in inputs.items()}, outputs,
+        {p: at(x) for p, x in expected.items()})
+
+
+class ModelSimulator:
+    # a behavioral model driven like a Simulator of its .hdl
+    model = None
+    builtins = None
+    values = None
+    outputs = None
+
+    def __init__(self, model):
+        self.model = model
+        self.builtins = [model]
+        self.values = {pin: 0 for pin, _ in model.inputs}
+        self.outputs = {pin: 0 for pin, _ in model.outputs}
+
+    def set(self, pin, value):
+        self.values[pin] = value & (1 << dict(self.model.inputs)[pin]) - 1
+
+    def get(self, pin):
+        return self.outputs[pin]
+
+    def eval(self):
+        values = self.model.comb(*[self.values[pin]
+            for pin in self.model.comb_inputs])
+        self.outputs = {pin: value
+            for (pin, _), value in zip(self.model.outputs, values)}
+
+    def tick(self):
+        self.eval()
+        if self.model.clocked:
+            self.model.tick(*[self.values[pin] for pin, _ in self.model.inputs])
+
+    def tock(self):
+        self.model.tock()
+        self.eval()
+
+
+def equivalence_check(filename, cycles, seed=0, cache=None, structural=False):
+    # runs the chip built from its parts' .hdl and its behavioral version on
+    # the same random trace. A chip with a model is compared with the model,
+    # its parts being models too unless structural. Any other chip is
+    # compared built fully structurally and with models for its parts.
+    # Returns None or the first difference as (cycle, phase, pin, value of
+    # the .hdl, value of the behavioral version)
+    name = Library().load(os.path.realpath(filename)).name
+    model = behavioral_models.get(name)
+    if model is None:
+        hdl = Simulator(load_chip(filename, cache, Library(structural=True)))
+        behavioral = Simulator(load_chip(filename, cache, Library()))
+    else:
+        hdl = Simulator(load_chip(filename, cache,
+            Library(structural=structural)))
+        behavioral = ModelSimulator(model())
+    chip = hdl.chip
+    sims = (hdl, behavioral)
+
+    rng = random.Random(seed)
+    # the same random program in both ROMs
+    program = [rng.getrandbits(16) for _ in range(32768)]
+    for sim in sims:
+        for part in sim.builtins:
+            if isinstance(part, ROM32K):
+                part.memory = list(program)
+
+    # inputs often repeat a recent value, so that e.g. a RAM reads back
+    # the addresses it was written at
+    pools = {pin: [rng.getrandbits(width) for _ in range(4)]
+        for pin, width in chip.inputs}
+    for cycle in range(cycles):
+        for pin, width in chip.inputs:
+            if rng.random() < 0.5:
+                value = rng.choice(pools[pin])
+            else:
+                value = rng.getrandbits(width)
+                pools[pin][rng.randrange(4)] = value
+            for sim in sims:
+                sim.set(pin, value)
+        key = rng.getrandbits(7)
+        for sim in sims:
+            for part in sim.builtins:
+                if isinstance(part, Keyboard):
+                    part.key = key
+            if isinstance(sim, Simulator):
+                sim.dirty = True
+
+        for phase in ('eval', 'tick', 'tock'):
+            for sim in sims:
+                getattr(sim, phase)()
+            for pin, _ in chip.outputs:
+                a, b = hdl.get(pin), behavioral.get(pin)
+                if a != b:
+                    return cycle, phase, pin, a, b
+    return None
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description='Compile .hdl chips to straight-line Python and '
+            'evaluate them')
+    arg_parser.add_argument('chip', help='.hdl file')
+    arg_parser.add_argument('pins', nargs='*', metavar='pin=value',
+        help='input values to evaluate the chip with')
+    arg_parser.add_argument('--verify', type=int, default=0, metavar='N',
+        help='compare the chip with its reference model on N random '
+            'vectors, all evaluated at once')
+    arg_parser.add_argument('--exhaustive', action='store_true',
+        help='compare the chip with its reference model on every input')
+    arg_parser.add_argument('--equivalence', type=int, default=0,
+        metavar='N', help='compare the chip with its behavioral version '
+            'over N clock cycles of random inputs')
+    arg_parser.add_argument('--structural', action='store_true',
+        help='build every part from its .hdl instead of using the '
+            'behavioral models of registers and memories')
+    arg_parser.add_argument('--seed', type=int, default=0,
+        help='random seed for --verify and --equivalence')
+    arg_parser.add_argument('--cache', action='store_true',
+        help='reuse the compiled chip while no .hdl it uses changed')
+    arg_parser.add_argument('--cache-dir', default=default_cache_dir(),
+        help='build cache directory (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+    cache = BuildCache(args.cache_dir) if args.cache else None
+
+    start = time.perf_counter()
+    chip = load_chip(args.chip, cache, Library(structural=args.structural))
+    elapsed = time.perf_counter() - start
+    stats = chip.stats
+    print(f'{chip.name}: {stats["nands"]} Nands, {stats["dffs"]} DFFs, '
+        f'{stats["builtins"]} builtin chips, {stats["gates"]} gates after '
+        f'simplifying, loaded in {elapsed * 1000:.1f} ms')
+
+    if args.verify or args.exhaustive:
+        if args.exhaustive:
+            try:
+                inputs, n = exhaustive_lanes(chip)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                return 2
+        else:
+            n = args.verify
+            inputs = random_lanes(chip, n, random.Random(args.seed))
+        start = time.perf_counter()
+        failure = verify_chip(chip, inputs, n)
+        elapsed = time.perf_counter() - start
+        if failure is not None:
+            print(f'FAIL {chip.name}: inputs {failure[0]} gave {failure[1]}, '
+                f'expected {failure[2]}')
+            return 1
+        print(f'ok {chip.name}: {n} vectors in {elapsed * 1000:.1f} ms')
+
+    if args.equivalence:
+        start = time.perf_counter()
+        difference = equivalence_check(args.chip, args.equivalence,
+            args.seed, cache, args.structural)
+        elapsed = time.perf_counter() - start
+        if difference is not None:
+            cycle, phase, pin, value, expected = difference
+            print(f'FAIL {chip.name}: {pin}={value} at {phase} of cycle '
+                f'{cycle}, behavioral version gave {expected}')
+            return 1
+        print(f'ok {chip.name}: same as the behavioral version over '
+            f'{args.equivalence} cycles in {elapsed * 1000:.1f} ms')
+
+    if args.pins:
+        sim = Simulator(chip)
+        for assignment in args.pins:
+            pin, value = assignment.split('=')
+            sim.set(pin, int(value, 0))
+        sim.eval()
+        print(' '.join(f'{pin}={sim.get(pin)}' for pin, _ in chip.outputs))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,635 @@
+import argparse
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(script_dir)
+sys.path.append(os.path.join(script_dir, '06'))
+sys.path.append(os.path.join(script_dir, '08'))
+
+from build_cache import BuildCache, default_cache_dir
+from hdl_simulator import Keyboard, Library, Simulator, load_chip
+from assembler import assemble_single_pass
+from emulator import Emulator, load_rom, wrap16
+from vm_interpreter import VirtualMachine, folder_commands
+from translator import file_commands
+
+
+tst_token_pattern = re.compile(
+    r'\s+|//[^\n]*|/\*[\s\S]*?\*/'
+    r'|"(?P<string>[^"]*)"|(?P<sep>[,;!{}])|(?P<word>[^\s,;!{}"]+)')
+
+# the commands a repeat block of which runs in one call to the backend
+batched_commands = ('ticktock', 'vmstep')
+
+# how many times a while loop may run before the script counts as stuck
+max_while_iterations = 100000
+
+conditions = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b
+}
+
+
+class Mismatch(Exception):
+    pass
+
+
+class Skip(Exception):
+    pass
+
+
+class Command:
+    # words of one command up to its , ; or !, repeat and while commands
+    # also have the commands of their block
+    words = None
+    line = 0
+    body = None
+
+    def __init__(self, words, line, body=None):
+        self.words = words
+        self.line = line
+        self.body = body
+
+
+def tokenize_tst(text):
+    line = 1
+    for m in tst_token_pattern.finditer(text):
+        if m.group('string') is not None:
+            yield 'word', m.group('string'), line
+        elif m.group('sep') is not None:
+            yield 'sep', m.group('sep'), line
+        elif m.group('word') is not None:
+            yield 'word', m.group('word'), line
+        line += m.group().count('\n')
+
+
+def parse_block(tokens, filename, nested=False):
+    commands = []
+    words = []
+    line = 0
+    for kind, text, token_line in tokens:
+        if kind == 'word':
+            if not words:
+                line = token_line
+            words.append(text)
+        elif text == '{':
+            if not words or words[0] not in ('repeat', 'while'):
+                raise Exception(f'{filename}:{token_line}: unexpected {{')
+            commands.append(Command(words, line,
+                parse_block(tokens, filename, True)))
+            words = []
+        elif text == '}':
+            if not nested:
+                raise Exception(f'{filename}:{token_line}: unexpected }}')
+            if words:
+                commands.append(Command(words, line))
+            return commands
+        elif words:
+            commands.append(Command(words, line))
+            words = []
+    if nested:
+        raise Exception(f'{filename}: missing }}')
+    if words:
+        commands.append(Command(words, line))
+    return commands
+
+
+def parse_tst(filename):
+    with open(filename, 'r') as f:
+        return parse_block(tokenize_tst(f.read()), filename)
+
+
+def parse_value(text):
+    if text.startswith('%B'):
+        return int(text[2:], 2)
+    if text.startswith('%X'):
+        return int(text[2:], 16)
+    if text.startswith('%D'):
+        return int(text[2:])
+    return int(text)
+
+
+def signed(value, width):
+    # pins of 16 bits show as signed decimals, narrower ones as unsigned
+    if width == 16 and value & 0x8000:
+        return value - 0x10000
+    return value
+
+
+class Column:
+    name = ''
+    fmt = ''
+    left = 0
+    width = 0
+    right = 0
+
+    def __init__(self, spec):
+        m = re.fullmatch(r'(.+?)%([BDXS])(\d+)\.(\d+)\.(\d+)', spec)
+        if m is None:
+            # a bare name prints as a padded decimal
+            m = re.fullmatch(r'(.+)()()()()', spec)
+        self.name = m.group(1)
+        self.fmt = m.group(2) or 'D'
+        self.left = int(m.group(3) or 1)
+        self.width = int(m.group(4) or 6)
+        self.right = int(m.group(5) or 1)
+
+    def header(self):
+        total = self.left + self.width + self.right
+        name = self.name[:total]
+        pad = (total - len(name)) // 2
+        return ' ' * pad + name + ' ' * (total - len(name) - pad)
+
+    def cell(self, value):
+        w = self.width
+        if self.fmt == 'S':
+            text = str(value).ljust(w)
+        elif self.fmt == 'B':
+            text = format(value & (1 << w) - 1, f'0{w}b')
+        elif self.fmt == 'X':
+            text = format(value & (1 << 4 * w) - 1, f'0{w}X')
+        else:
+            text = str(value).rjust(w)
+        return ' ' * self.left + text[-w:] + ' ' * self.right
+
+
+def cmp_matches(expected, line):
+    # a * in the .cmp file matches any character
+    return len(expected) == len(line) and all(e == '*' or e == c
+        for e, c in zip(expected, line))
+
+
+def bracket(name):
+    # 'RAM[12]' -> ('RAM', 12), 'PC[]' -> ('PC', None), 'out' -> ('out', -1)
+    m = re.fullmatch(r'([^\[]+)\[(\d*)\]', name)
+    if m is None:
+        return name, -1
+    return m.group(1), int(m.group(2)) if m.group(2) else None
+
+
+class HardwareBackend:
+    # a chip compiled by hdl_simulator, with a clock and time counter
+    sim = None
+    folder = ''
+    time = 0
+    half = False
+
+    def __init__(self, filename, cache=None, structural=False):
+        self.sim = Simulator(load_chip(filename, cache,
+            Library(structural=structural)))
+        self.folder = os.path.dirname(filename)
+        self.time = 0
+        self.half = False
+
+    def pin_width(self, name):
+        return len(self.sim.chip.pins[name])
+
+    def get(self, name):
+        if name == 'time':
+            return f'{self.time}+' if self.half else str(self.time)
+        sim = self.sim
+        if name in sim.chip.pins:
+            return signed(sim.get(name), self.pin_width(name))
+        base, index = bracket(name)
+        if base in sim.chip.pins and index is not None and index >= 0:
+            return sim.get(base) >> index & 1
+        if base not in sim.chip.parts:
+            raise Exception(f'{sim.chip.name} has no pin or part {name}')
+        kind, value = sim.chip.parts[base]
+        if kind == 'builtin':
+            return signed(sim.builtins[value][index or 0], 16)
+        return signed(sim.part_value(base), 16)
+
+    def set(self, name, value):
+        sim = self.sim
+        if name in sim.chip.pins:
+            sim.set(name, value)
+            return
+        base, index = bracket(name)
+        if base in sim.chip.parts and sim.chip.parts[base][0] == 'builtin':
+            sim.part(base)[index or 0] = value
+            return
+        raise Exception(f'cannot set {name} of {sim.chip.name}')
+
+    def press(self, key):
+        for model in self.sim.builtins:
+            if isinstance(model, Keyboard):
+                model.key = key
+        self.sim.dirty = True
+
+    def command(self, words):
+        cmd = words[0]
+        if cmd == 'eval':
+            self.sim.eval()
+        elif cmd == 'tick':
+            self.sim.tick()
+            self.half = True
+        elif cmd == 'tock':
+            self.sim.tock()
+            self.time += 1
+            self.half = False
+        elif len(words) == 3 and words[1] == 'load':
+            # e.g. ROM32K load Add.hack
+            self.sim.part(words[0]).load(os.path.join(self.folder, words[2]))
+        else:
+            raise Exception(f'unknown command {cmd}')
+
+    def run(self, cmd, n):
+        raise Exception(f'unknown command {cmd}')
+
+
+class CpuBackend:
+    # a .hack or .asm program on the 06 emulator
+    emulator = None
+
+    def __init__(self, filename):
+        if filename.endswith('.asm'):
+            rom = assemble_single_pass(filename)
+        else:
+            rom = load_rom(filename)
+        self.emulator = Emulator(rom)
+
+    def get(self, name):
+        emulator = self.emulator
+        base, index = bracket(name)
+        if base == 'RAM' and index is not None and index >= 0:
+            return emulator.ram[index]
+        if name in ('A', 'D', 'PC'):
+            return wrap16(getattr(emulator, name.lower()))
+        if name == 'time':
+            return str(emulator.cycles)
+        raise Exception(f'unknown CPU variable {name}')
+
+    def set(self, name, value):
+        emulator = self.emulator
+        base, index = bracket(name)
+        if base == 'RAM' and index is not None and index >= 0:
+            emulator.ram[index] = wrap16(value)
+        elif name in ('A', 'D', 'PC'):
+            setattr(emulator, name.lower(), value & 0xffff)
+        else:
+            raise Exception(f'unknown CPU variable {name}')
+
+    def press(self, key):
+        self.emulator.set_key(key)
+
+    def command(self, words):
+        if words[0] != 'ticktock':
+            raise Exception(f'unknown command {words[0]}')
+        self.emulator.step()
+
+    def run(self, cmd, n):
+        if cmd != 'ticktock':
+            raise Exception(f'unknown command {cmd}')
+        self.emulator.run(n)
+
+
+class VmBackend:
+    # .vm files on the 08 interpreter. Like the course's VM emulator it
+    # starts at Sys.init when there is one but does not call it, the
+    # scripts set up the stack themselves
+    vm = None
+    pointers = {'sp': 0, 'local': 1, 'argument': 2, 'this': 3, 'that': 4}
+
+    def __init__(self, target):
+        if os.path.isdir(target):
+            commands = folder_commands(target)
+            if not commands:
+                raise Skip(f'no .vm files in {target}, compile it first')
+        else:
+            commands = list(file_commands(target))
+        self.vm = VirtualMachine(commands, bootstrap=False)
+        self.vm.pc = self.vm.labels.get('Sys.init', 0)
+
+    def address(self, name):
+        ram = self.vm.ram
+        base, index = bracket(name)
+        if base == 'RAM' and index is not None and index >= 0:
+            return index
+        if base in self.pointers:
+            if index == -1:
+                return self.pointers[base]
+            if base != 'sp' and index is not None:
+                return ram[self.pointers[base]] + index
+        if base == 'temp' and index is not None and index >= 0:
+            return 5 + index
+        raise Exception(f'unknown VM variable {name}')
+
+    def get(self, name):
+        return self.vm.ram[self.address(name)]
+
+    def set(self, name, value):
+        self.vm.ram[self.address(name)] = wrap16(value)
+
+    def press(self, key):
+        self.vm.ram[0x6000] = key
+
+    def command(self, words):
+        self.run(words[0], 1)
+
+    def run(self, cmd, n):
+        if cmd != 'vmstep':
+            raise Exception(f'unknown command {cmd}')
+        self.vm.run(n)
+
+
+class ScriptRunner:
+    # runs one .tst script, comparing each output line with the .cmp file
+    # as it is produced so that a failing script stops at its first
+    # mismatch
+    filename = ''
+    folder = ''
+    backend = None
+    cache = None
+    structural = False
+    write_out = False
+    columns = None
+    out = None
+    compare = None
+    compared = 0
+
+    def __init__(self, filename, cache=None, write_out=False,
+            structural=False):
+        self.filename = filename
+        self.folder = os.path.dirname(os.path.realpath(filename))
+        self.cache = cache
+        self.structural = structural
+        self.write_out = write_out
+        self.columns = []
+        self.compared = 0
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def load(self, words):
+        target = self.path(words[1]) if len(words) > 1 else self.folder
+        if target.endswith('.hdl'):
+            self.backend = HardwareBackend(target, self.cache,
+                self.structural)
+        elif target.endswith('.hack') or target.endswith('.asm'):
+            self.backend = CpuBackend(target)
+        elif target.endswith('.vm') or os.path.isdir(target):
+            self.backend = VmBackend(target)
+        else:
+            raise Exception(f'cannot load {words[1]}')
+
+    def emit(self, line):
+        if self.out is not None:
+            self.out.write(line + '\n')
+        if self.compare is None:
+            return
+        expected = self.compare.readline().rstrip('\r\n')
+        self.compared += 1
+        if not cmp_matches(expected, line):
+            raise Mismatch(f'comparison failure at line {self.compared}:\n'
+                f'  expected: {expected}\n  got:      {line}')
+
+    def output(self):
+        backend = self.backend
+        self.emit('|' + '|'.join(column.cell(backend.get(column.name))
+            for column in self.columns) + '|')
+
+    def condition(self, words):
+        if len(words) != 3 or words[1] not in conditions:
+            raise Exception(f'cannot evaluate {" ".join(words)}')
+
+        def value(text):
+            try:
+                return parse_value(text)
+            except ValueError:
+                return self.backend.get(text)
+        return conditions[words[1]](value(words[0]), value(words[2]))
+
+    def echo(self, text):
+        # interactive scripts ask to hold down a key, e.g. 05/Memory.tst
+        # waits in a while loop for 'K'. The runner presses it for them
+        m = re.search(r"hold down (?:the )?'(.)'", text, re.IGNORECASE)
+        if m is not None and self.backend is not None:
+            self.backend.press(ord(m.group(1)))
+
+    def repeat(self, command):
+        words = command.words
+        if len(words) < 2:
+            raise Skip(f'line {command.line}: endless repeat, interactive '
+                f'script')
+        n = int(words[1])
+        body = command.body
+        if len(body) == 1 and body[0].words == [body[0].words[0]] and \
+                body[0].words[0] in batched_commands:
+            self.backend.run(body[0].words[0], n)
+            return
+        for _ in range(n):
+            self.run_commands(body)
+
+    def run_command(self, command):
+        words = command.words
+        cmd = words[0]
+        if command.body is not None:
+            if cmd == 'repeat':
+                self.repeat(command)
+                return
+            for _ in range(max_while_iterations):
+                if not self.condition(words[1:]):
+                    return
+                self.run_commands(command.body)
+            raise Exception(f'line {command.line}: while loop did not end')
+        elif cmd == 'load':
+            self.load(words)
+        elif cmd == 'output-file':
+            if self.write_out:
+                self.out = open(self.path(words[1]), 'w')
+        elif cmd == 'compare-to':
+            self.compare = open(self.path(words[1]), 'r')
+        elif cmd == 'output-list':
+            self.columns = [Column(spec) for spec in words[1:]]
+            self.emit('|' + '|'.join(column.header()
+                for column in self.columns) + '|')
+        elif cmd == 'output':
+            self.output()
+        elif cmd == 'set':
+            self.backend.set(words[1], parse_value(words[2]))
+        elif cmd == 'echo':
+            self.echo(' '.join(words[1:]))
+        elif cmd == 'clear-echo':
+            if self.backend is not None:
+                self.backend.press(0)
+        elif cmd in ('breakpoint', 'clear-breakpoints'):
+            pass
+        elif self.backend is None:
+            raise Exception(f'{cmd} before load')
+        else:
+            self.backend.command(words)
+
+    def run_commands(self, commands):
+        for command in commands:
+            try:
+                self.run_command(command)
+            except (Mismatch, Skip):
+                raise
+            except Exception as e:
+                if str(e).startswith('line '):
+                    raise
+                raise Exception(f'line {command.line}: {e}') from e
+
+    def run(self):
+        try:
+            self.run_commands(parse_tst(self.filename))
+        finally:
+            for f in (self.out, self.compare):
+                if f is not None:
+                    f.close()
+        return self.compared
+
+
+def run_script(filename, cache_dir=None, write_out=False, structural=False):
+    # result of one script as a dict, safe to send back from a worker
+    cache = BuildCache(cache_dir) if cache_dir else None
+    start = time.perf_counter()
+    status, message, compared = 'passed', '', 0
+    runner = ScriptRunner(filename, cache, write_out, structural)
+    try:
+        compared = runner.run()
+    except Mismatch as e:
+        status, message = 'failed', str(e)
+    except Skip as e:
+        status, message = 'skipped', str(e)
+    except Exception as e:
+        status, message = 'error', str(e) or type(e).__name__
+    return {
+        'script': filename,
+        'status': status,
+        'message': message,
+        'lines': compared or runner.compared,
+        'seconds': time.perf_counter() - start
+    }
+
+
+def find_scripts(paths):
+    scripts = []
+    for path in paths:
+        if os.path.isfile(path):
+            scripts.append(path)
+            continue
+        for folder, dirs, files in os.walk(path):
+            dirs.sort()
+            scripts += [os.path.join(folder, name) for name in sorted(files)
+                if name.endswith('.tst')]
+    return scripts
+
+
+def run_scripts(scripts, jobs=0, cache_dir=None, write_out=False,
+        report=None, structural=False):
+    # runs the scripts in that many workers, 0 meaning one per cpu and None
+    # in this process, calling report with each result as it finishes.
+    # Returns the results in the order of scripts
+    results = {}
+    if jobs is None or len(scripts) < 2:
+        for filename in scripts:
+            results[filename] = run_script(filename, cache_dir, write_out,
+                structural)
+            if report:
+                report(results[filename])
+    else:
+        with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+            futures = {executor.submit(run_script, filename, cache_dir,
+                write_out, structural): filename for filename in scripts}
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # e.g. a worker killed for running out of memory
+                    result = {'script': filename, 'status': 'error',
+                        'message': f'{type(e).__name__}: {e}', 'lines': 0,
+                        'seconds': 0.0}
+                results[filename] = result
+                if report:
+                    report(result)
+    return [results[filename] for filename in scripts]
+
+
+def write_junit(results, filename, root, elapsed):
+    counts = {status: sum(r['status'] == status for r in results)
+        for status in ('failed', 'error', 'skipped')}
+    suite = ET.Element('testsuite', name='nand2tetris',
+        tests=str(len(results)), failures=str(counts['failed']),
+        errors=str(counts['error']), skipped=str(counts['skipped']),
+        time=f'{elapsed:.3f}')
+    for r in results:
+        relative = os.path.relpath(r['script'], root)
+        folder, name = os.path.split(relative)
+        case = ET.SubElement(suite, 'testcase',
+            classname=folder.replace(os.sep, '.') or '.',
+            name=os.path.splitext(name)[0], time=f'{r["seconds"]:.3f}')
+        if r['status'] == 'failed':
+            ET.SubElement(case, 'failure',
+                message=r['message'].split('\n')[0]).text = r['message']
+        elif r['status'] == 'error':
+            ET.SubElement(case, 'error', message=r['message'])
+        elif r['status'] == 'skipped':
+            ET.SubElement(case, 'skipped', message=r['message'])
+    ET.indent(suite)
+    ET.ElementTree(suite).write(filename, encoding='utf-8',
+        xml_declaration=True)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description='Run .tst scripts against their .cmp files')
+    arg_parser.add_argument('paths', nargs='*', default=[script_dir],
+        help='.tst files or folders to search for them (default: all '
+            'projects)')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=0,
+        help='worker processes, 0 for one per cpu (default)')
+    arg_parser.add_argument('--junit', metavar='FILE',
+        help='write a JUnit XML summary to FILE')
+    arg_parser.add_argument('--write-out', action='store_true',
+        help='write the .out file each script names')
+    arg_parser.add_argument('--structural', action='store_true',
+        help='simulate every part from its .hdl instead of the behavioral '
+            'models of registers and memories')
+    arg_parser.add_argument('--cache', action='store_true',
+        help='reuse compiled chips while no .hdl they use changed')
+    arg_parser.add_argument('--cache-dir', default=default_cache_dir(),
+        help='build cache directory (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+
+    scripts = find_scripts(args.paths)
+    root = os.path.commonpath([os.path.realpath(p) for p in args.paths])
+    if os.path.isfile(root):
+        root = os.path.dirname(root)
+
+    def report(result):
+        relative = os.path.relpath(os.path.realpath(result['script']), root)
+        line = f'{result["status"]:7} {relative} ({result["seconds"]:.2f} s)'
+        if result['status'] != 'passed':
+            line += '\n    ' + result['message'].replace('\n', '\n    ')
+        print(line, flush=True)
+
+    start = time.perf_counter()
+    results = run_scripts(scripts, args.jobs,
+        args.cache_dir if args.cache else None, args.write_out, report,
+        args.structural)
+    elapsed = time.perf_counter() - start
+
+    counts = {status: sum(r['status'] == status for r in results)
+        for status in ('passed', 'failed', 'error', 'skipped')}
+    print(', '.join(f'{n} {status}' for status, n in counts.items()) +
+        f' in {elapsed:.2f} s')
+    if args.junit:
+        write_junit(results, args.junit, root, elapsed)
+    return 1 if counts['failed'] or counts['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())